@@ -3,6 +3,8 @@ version = "0.1.0"
 from .tokenization import BertTokenizer, BasicTokenizer, WordpieceTokenizer
 from .optimization import BertAdam, WarmupLinearSchedule
 from .modeling import ZenConfig, ZenForPreTraining, ZenForTokenClassification, ZenForSequenceClassification
+from .modeling import build_ngram_position_matrix
 from .file_utils import WEIGHTS_NAME, CONFIG_NAME, PYTORCH_PRETRAINED_BERT_CACHE
-from .ngram_utils import ZenNgramDict, NGRAM_DICT_NAME
+from .ngram_utils import (ZenNgramDict, NGRAM_DICT_NAME, NGRAM_BINARY_NAME, convert_ngram_file_to_binary,
+                          encode_dna_ngram, decode_dna_ngram)
 
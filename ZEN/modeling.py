@@ -194,6 +194,79 @@ def swish(x):
 ACT2FN = {"gelu": gelu, "relu": torch.nn.functional.relu, "swish": swish}
 
 
+def build_ngram_position_matrix(ngram_starts, ngram_lengths, seq_len, dtype=torch.float):
+    """Builds the ngram position matrix of a batch from the start and length of every ngram.
+
+    Entry [b, i, j] is 1 when token i of sequence b lies in its ngram j. Padding ngrams have length 0 and so an all
+    zero column. The matrix is created on the device of the inputs, so only the starts and lengths need to be
+    stored and copied.
+
+    Args:
+        ngram_starts: torch.LongTensor of shape [batch_size, max_ngram_in_seq]
+        ngram_lengths: torch.LongTensor of shape [batch_size, max_ngram_in_seq]
+        seq_len: number of tokens per sequence
+        dtype: dtype of the matrix
+
+    Returns:
+        tensor of shape [batch_size, seq_len, max_ngram_in_seq]
+    """
+    token_positions = torch.arange(seq_len, device=ngram_starts.device).view(1, -1, 1)
+    ngram_starts = ngram_starts.unsqueeze(1)
+    ngram_ends = ngram_starts + ngram_lengths.unsqueeze(1)
+    return ((token_positions >= ngram_starts) & (token_positions < ngram_ends)).to(dtype)
+
+
+def ngram_fusion_index(ngram_position_matrix, seq_len, num_ngrams):
+    """Lists the (character, ngram) pairs of a batch where a character lies in an ngram.
+
+    Args:
+        ngram_position_matrix: the [batch_size, seq_len, max_ngram_in_seq] position matrix, or a
+            (ngram_starts, ngram_lengths) tuple of torch.LongTensor of shape [batch_size, max_ngram_in_seq]
+        seq_len: number of tokens per sequence
+        num_ngrams: number of ngrams per sequence
+
+    Returns:
+        (token_index, ngram_index): torch.LongTensor of the same length, holding indices into the batch's
+        [batch_size * seq_len] characters and [batch_size * max_ngram_in_seq] ngrams
+    """
+    if isinstance(ngram_position_matrix, (tuple, list)):
+        ngram_starts, ngram_lengths = ngram_position_matrix
+        ngram_lengths = ngram_lengths.reshape(-1).long()
+        ngram_index = torch.repeat_interleave(torch.arange(ngram_lengths.numel(), device=ngram_lengths.device),
+                                              ngram_lengths)
+        # offset of every character within its ngram
+        first = torch.cumsum(ngram_lengths, 0) - ngram_lengths
+        offsets = torch.arange(ngram_index.numel(), device=ngram_lengths.device) - first[ngram_index]
+        tokens = ngram_starts.reshape(-1).long()[ngram_index] + offsets
+        batch = ngram_index // num_ngrams
+    else:
+        batch, tokens, ngrams = ngram_position_matrix.nonzero(as_tuple=True)
+        ngram_index = batch * num_ngrams + ngrams
+    return batch * seq_len + tokens, ngram_index
+
+
+def packed_segment_index(segment_starts, segment_lengths, seq_len):
+    """Locates the tokens of a batch of packed sequences, each holding several instances one after another.
+
+    Args:
+        segment_starts: torch.LongTensor of shape [batch_size, max_segments] with the first token of every segment
+        segment_lengths: torch.LongTensor of shape [batch_size, max_segments], 0 for padding segments
+        seq_len: number of tokens per sequence
+
+    Returns:
+        (token_segments, position_ids): torch.LongTensor of shape [batch_size, seq_len] with the 1-based index of
+        the segment holding each token (0 for padding), and the position of each token within its segment
+    """
+    token_positions = torch.arange(seq_len, device=segment_starts.device).view(1, -1, 1)
+    segment_starts = segment_starts.long().unsqueeze(1)
+    segment_ends = segment_starts + segment_lengths.long().unsqueeze(1)
+    inside = ((token_positions >= segment_starts) & (token_positions < segment_ends)).long()
+    segment_numbers = torch.arange(1, inside.size(2) + 1, device=inside.device)
+    token_segments = (inside * segment_numbers).sum(2)
+    position_ids = (inside * (token_positions - segment_starts)).sum(2)
+    return token_segments, position_ids
+
+
 class ZenConfig(object):
 
     """Configuration class to store the configuration of a `ZenModel`.
@@ -213,7 +286,8 @@ class ZenConfig(object):
                  type_vocab_size=2,
                  initializer_range=0.02,
                  layer_norm_eps=1e-12,
-                 num_hidden_word_layers=6):
+                 num_hidden_word_layers=6,
+                 ngram_fusion="dense"):
         """Constructs ZenConfig.
 
         Args:
@@ -238,6 +312,11 @@ class ZenConfig(object):
             initializer_range: The sttdev of the truncated_normal_initializer for
                 initializing all weight matrices.
             layer_norm_eps: The epsilon used by LayerNorm.
+            num_hidden_word_layers: Number of hidden layers in the ngram encoder.
+            ngram_fusion: How the ngram hidden states are added to the character hidden states. "dense"
+                multiplies them by the ngram position matrix; "sparse" gathers the ngram states covering each
+                character and accumulates them with index_add, in the model's dtype, which is faster when the
+                matrix is large and mostly zeros.
         """
         if isinstance(vocab_size_or_config_json_file, str) or (sys.version_info[0] == 2
                                                                and isinstance(vocab_size_or_config_json_file, unicode)):
@@ -261,6 +340,7 @@ class ZenConfig(object):
             self.initializer_range = initializer_range
             self.layer_norm_eps = layer_norm_eps
             self.num_hidden_word_layers = num_hidden_word_layers
+            self.ngram_fusion = ngram_fusion
         else:
             raise ValueError("First argument must be either a vocabulary size (int)"
                              "or the path to a pretrained model config file (str)")
@@ -335,10 +415,11 @@ class BertEmbeddings(nn.Module):
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=config.layer_norm_eps)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, input_ids, token_type_ids=None):
-        seq_length = input_ids.size(1)
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
-        position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
+    def forward(self, input_ids, token_type_ids=None, position_ids=None):
+        if position_ids is None:
+            seq_length = input_ids.size(1)
+            position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
+            position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
@@ -551,6 +632,10 @@ class ZenEncoder(nn.Module):
         self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])
         self.word_layers = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_word_layers)])
         self.num_hidden_word_layers = config.num_hidden_word_layers
+        # configs saved before ngram_fusion existed use the dense fusion
+        self.ngram_fusion = getattr(config, "ngram_fusion", "dense")
+        if self.ngram_fusion not in ("dense", "sparse"):
+            raise ValueError("ngram_fusion must be 'dense' or 'sparse', got {}".format(self.ngram_fusion))
 
     def forward(self, hidden_states, ngram_hidden_states, ngram_position_matrix, attention_mask,
                 ngram_attention_mask,
@@ -559,6 +644,19 @@ class ZenEncoder(nn.Module):
         all_encoder_layers = []
         all_attentions = []
         num_hidden_ngram_layers = self.num_hidden_word_layers
+        batch_size, seq_len, hidden_size = hidden_states.size()
+        num_ngrams = ngram_hidden_states.size(1)
+        if self.ngram_fusion == "sparse":
+            token_index, ngram_index = ngram_fusion_index(ngram_position_matrix, seq_len, num_ngrams)
+        else:
+            if isinstance(ngram_position_matrix, (tuple, list)):
+                ngram_position_matrix = build_ngram_position_matrix(ngram_position_matrix[0],
+                                                                    ngram_position_matrix[1], seq_len)
+            # cast once per forward rather than in every layer
+            ngram_position_matrix = ngram_position_matrix.float()
+        # what the ngrams add to the characters; it only changes while the ngram layers update the ngram states,
+        # after that the one from the last ngram layer is reused
+        ngram_contribution = None
         for i, layer_module in enumerate(self.layer):
             hidden_states = layer_module(hidden_states, attention_mask, head_mask[i])
             if i < num_hidden_ngram_layers:
@@ -568,7 +666,18 @@ class ZenEncoder(nn.Module):
             if self.output_attentions:
                 attentions, hidden_states = hidden_states
                 all_attentions.append(attentions)
-            hidden_states += torch.bmm(ngram_position_matrix.float(), ngram_hidden_states.float())
+            if ngram_contribution is None or i < num_hidden_ngram_layers:
+                if self.ngram_fusion == "sparse":
+                    ngram_contribution = ngram_hidden_states.reshape(-1, hidden_size).index_select(
+                        0, ngram_index).to(hidden_states.dtype)
+                else:
+                    ngram_contribution = torch.bmm(ngram_position_matrix, ngram_hidden_states.float())
+            if self.ngram_fusion == "sparse":
+                # add every ngram's state to each character it covers, without the mostly zero matrix
+                hidden_states = hidden_states.reshape(-1, hidden_size).index_add(
+                    0, token_index, ngram_contribution).view(batch_size, seq_len, hidden_size)
+            else:
+                hidden_states += ngram_contribution
             if output_all_encoded_layers:
                 all_encoder_layers.append(hidden_states)
         if not output_all_encoded_layers:
@@ -885,7 +994,11 @@ class ZenModel(ZenPreTrainedModel):
         `input_ngram_ids`: input_ids of ngrams.
         `ngram_token_type_ids`: token_type_ids of ngrams.
         `ngram_attention_mask`: attention_mask of ngrams.
-        `ngram_position_matrix`: position matrix of ngrams.
+        `ngram_position_matrix`: position matrix of ngrams, of shape [batch_size, sequence_length, max_ngram_in_seq],
+            or a (ngram_starts, ngram_lengths) tuple of torch.LongTensor of shape [batch_size, max_ngram_in_seq].
+        `packed_segments`: an optional (segment_starts, segment_lengths) tuple of torch.LongTensor of shape
+            [batch_size, max_segments] for sequences that pack several instances one after another. Padding
+            segments have length 0. Tokens and ngrams then only attend within their own segment.
 
 
     Outputs: Tuple of (encoded_layers, pooled_output)
@@ -897,7 +1010,8 @@ class ZenModel(ZenPreTrainedModel):
                 to the last attention block of shape [batch_size, sequence_length, hidden_size],
         `pooled_output`: a torch.FloatTensor of size [batch_size, hidden_size] which is the output of a
             classifier pretrained on top of the hidden state associated to the first character of the
-            input (`CLS`) to train on the Next-Sentence task (see BERT's paper).
+            input (`CLS`) to train on the Next-Sentence task (see BERT's paper). With `packed_segments`, it is
+            of size [batch_size, max_segments, hidden_size], one for the first character of every segment.
 
     """
 
@@ -932,7 +1046,8 @@ class ZenModel(ZenPreTrainedModel):
                 attention_mask=None,
                 ngram_attention_mask=None,
                 output_all_encoded_layers=True,
-                head_mask=None):
+                head_mask=None,
+                packed_segments=None):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
@@ -943,13 +1058,30 @@ class ZenModel(ZenPreTrainedModel):
         if ngram_token_type_ids is None:
             ngram_token_type_ids = torch.zeros_like(input_ngram_ids)
 
-        # We create a 3D attention mask from a 2D tensor mask.
-        # Sizes are [batch_size, 1, 1, to_seq_length]
-        # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
-        # this attention mask is more simple than the triangular masking of causal attention
-        # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
-        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
-        extended_ngram_attention_mask = ngram_attention_mask.unsqueeze(1).unsqueeze(2)
+        position_ids = None
+        if packed_segments is None:
+            # We create a 3D attention mask from a 2D tensor mask.
+            # Sizes are [batch_size, 1, 1, to_seq_length]
+            # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
+            # this attention mask is more simple than the triangular masking of causal attention
+            # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
+            extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+            extended_ngram_attention_mask = ngram_attention_mask.unsqueeze(1).unsqueeze(2)
+        else:
+            # Several instances are packed in each sequence: the masks are block diagonal of size
+            # [batch_size, 1, from_seq_length, to_seq_length], so that a token (or ngram) only attends to the
+            # tokens (or ngrams) of its own segment, and the positions restart at every segment.
+            token_segments, position_ids = packed_segment_index(packed_segments[0], packed_segments[1],
+                                                                input_ids.size(1))
+            if isinstance(ngram_position_matrix, (tuple, list)):
+                ngram_first_tokens = ngram_position_matrix[0].long()
+            else:
+                ngram_first_tokens = ngram_position_matrix.argmax(1)
+            ngram_segments = token_segments.gather(1, ngram_first_tokens)
+            extended_attention_mask = ((token_segments.unsqueeze(2) == token_segments.unsqueeze(1))
+                                       & attention_mask.unsqueeze(1).bool()).unsqueeze(1)
+            extended_ngram_attention_mask = ((ngram_segments.unsqueeze(2) == ngram_segments.unsqueeze(1))
+                                             & ngram_attention_mask.unsqueeze(1).bool()).unsqueeze(1)
 
         # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
         # masked positions, this operation will create a tensor which is 0.0 for
@@ -979,7 +1111,7 @@ class ZenModel(ZenPreTrainedModel):
         else:
             head_mask = [None] * self.config.num_hidden_layers
 
-        embedding_output = self.embeddings(input_ids, token_type_ids)
+        embedding_output = self.embeddings(input_ids, token_type_ids, position_ids)
         ngram_embedding_output = self.word_embeddings(input_ngram_ids, ngram_token_type_ids)
 
         encoded_layers = self.encoder(embedding_output,
@@ -992,7 +1124,15 @@ class ZenModel(ZenPreTrainedModel):
         if self.output_attentions:
             all_attentions, encoded_layers = encoded_layers
         sequence_output = encoded_layers[-1]
-        pooled_output = self.pooler(sequence_output)
+        if packed_segments is None:
+            pooled_output = self.pooler(sequence_output)
+        else:
+            # pool the first token (`CLS`) of every segment
+            hidden_size = sequence_output.size(-1)
+            segment_starts = packed_segments[0].long()
+            first_token_tensor = sequence_output.gather(1, segment_starts.unsqueeze(-1).expand(-1, -1, hidden_size))
+            pooled_output = self.pooler(first_token_tensor.view(-1, 1, hidden_size)).view(
+                segment_starts.size(0), segment_starts.size(1), hidden_size)
         if not output_all_encoded_layers:
             encoded_layers = encoded_layers[-1]
         if self.output_attentions:
@@ -1028,12 +1168,16 @@ class ZenForPreTraining(ZenPreTrainedModel):
         `next_sentence_label`: optional next sentence classification loss: torch.LongTensor of shape [batch_size]
             with indices selected in [0, 1].
             0 => next sentence is the continuation, 1 => next sentence is a random sentence.
+            With `packed_segments` it is of shape [batch_size, max_segments], set to -1 for padding segments.
         `head_mask`: an optional torch.Tensor of shape [num_heads] or [num_layers, num_heads] with indices between 0 and 1.
             It's a mask to be used to nullify some heads of the transformer. 1.0 => head is fully masked, 0.0 => head is not masked.
         `input_ngram_ids`: input_ids of ngrams.
         `ngram_token_type_ids`: token_type_ids of ngrams.
         `ngram_attention_mask`: attention_mask of ngrams.
-        `ngram_position_matrix`: position matrix of ngrams.
+        `ngram_position_matrix`: position matrix of ngrams, of shape [batch_size, sequence_length, max_ngram_in_seq],
+            or a (ngram_starts, ngram_lengths) tuple of torch.LongTensor of shape [batch_size, max_ngram_in_seq].
+        `packed_segments`: an optional (segment_starts, segment_lengths) tuple of torch.LongTensor of shape
+            [batch_size, max_segments] for sequences that pack several instances, see `ZenModel`.
 
     Outputs:
         if `masked_lm_labels` and `next_sentence_label` are not `None`:
@@ -1042,7 +1186,8 @@ class ZenForPreTraining(ZenPreTrainedModel):
         if `masked_lm_labels` or `next_sentence_label` is `None`:
             Outputs a tuple comprising
             - the masked language modeling logits of shape [batch_size, sequence_length, vocab_size], and
-            - the next sentence classification logits of shape [batch_size, 2].
+            - the next sentence classification logits of shape [batch_size, 2] ([batch_size, max_segments, 2] with
+              `packed_segments`).
 
     """
 
@@ -1059,7 +1204,7 @@ class ZenForPreTraining(ZenPreTrainedModel):
                 attention_mask=None,
                 ngram_attention_mask=None,
                 masked_lm_labels=None,
-                next_sentence_label=None, head_mask=None):
+                next_sentence_label=None, head_mask=None, packed_segments=None):
         outputs = self.bert(input_ids,
                             input_ngram_ids,
                             ngram_position_matrix,
@@ -1067,7 +1212,7 @@ class ZenForPreTraining(ZenPreTrainedModel):
                             ngram_token_type_ids,
                             attention_mask,
                             ngram_attention_mask,
-                            output_all_encoded_layers=False, head_mask=head_mask)
+                            output_all_encoded_layers=False, head_mask=head_mask, packed_segments=packed_segments)
         if self.output_attentions:
             all_attentions, sequence_output, pooled_output = outputs
         else:
@@ -1117,7 +1262,8 @@ class ZenForMaskedLM(ZenPreTrainedModel):
         `input_ngram_ids`: input_ids of ngrams.
         `ngram_token_type_ids`: token_type_ids of ngrams.
         `ngram_attention_mask`: attention_mask of ngrams.
-        `ngram_position_matrix`: position matrix of ngrams.
+        `ngram_position_matrix`: position matrix of ngrams, of shape [batch_size, sequence_length, max_ngram_in_seq],
+            or a (ngram_starts, ngram_lengths) tuple of torch.LongTensor of shape [batch_size, max_ngram_in_seq].
 
     Outputs:
         if `masked_lm_labels` is  not `None`:
@@ -1182,7 +1328,8 @@ class ZenForNextSentencePrediction(ZenPreTrainedModel):
         `input_ngram_ids`: input_ids of ngrams.
         `ngram_token_type_ids`: token_type_ids of ngrams.
         `ngram_attention_mask`: attention_mask of ngrams.
-        `ngram_position_matrix`: position matrix of ngrams.
+        `ngram_position_matrix`: position matrix of ngrams, of shape [batch_size, sequence_length, max_ngram_in_seq],
+            or a (ngram_starts, ngram_lengths) tuple of torch.LongTensor of shape [batch_size, max_ngram_in_seq].
 
     Outputs:
         if `next_sentence_label` is not `None`:
@@ -1250,7 +1397,8 @@ class ZenForSequenceClassification(ZenPreTrainedModel):
         `input_ngram_ids`: input_ids of ngrams.
         `ngram_token_type_ids`: token_type_ids of ngrams.
         `ngram_attention_mask`: attention_mask of ngrams.
-        `ngram_position_matrix`: position matrix of ngrams.
+        `ngram_position_matrix`: position matrix of ngrams, of shape [batch_size, sequence_length, max_ngram_in_seq],
+            or a (ngram_starts, ngram_lengths) tuple of torch.LongTensor of shape [batch_size, max_ngram_in_seq].
 
     Outputs:
         if `labels` is not `None`:
@@ -1318,7 +1466,8 @@ class ZenForTokenClassification(ZenPreTrainedModel):
         `input_ngram_ids`: input_ids of ngrams.
         `ngram_token_type_ids`: token_type_ids of ngrams.
         `ngram_attention_mask`: attention_mask of ngrams.
-        `ngram_position_matrix`: position matrix of ngrams.
+        `ngram_position_matrix`: position matrix of ngrams, of shape [batch_size, sequence_length, max_ngram_in_seq],
+            or a (ngram_starts, ngram_lengths) tuple of torch.LongTensor of shape [batch_size, max_ngram_in_seq].
 
     Outputs:
         if `labels` is not `None`:
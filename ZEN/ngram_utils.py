@@ -15,9 +15,25 @@
 """utils for ngram for ZEN model."""
 
 import os
+import json
+import struct
 import logging
+import collections
+from collections import deque
+from collections.abc import Mapping, Sequence
+
+import numpy as np
 
 NGRAM_DICT_NAME = 'ngram.txt'
+NGRAM_BINARY_NAME = 'ngram.bin'
+
+_NGRAM_BINARY_MAGIC = b'ZENNGRAM'
+_NGRAM_BINARY_VERSION = 1
+
+# 2-bit codes of the nucleotides, used to pack DNA ngrams into integers
+DNA_BASE_CODES = {"a": 0, "c": 1, "g": 2, "t": 3, "A": 0, "C": 1, "G": 2, "T": 3}
+# a packed ngram keeps a leading 1 bit to record its length, so 31 bases is the most an int64 can hold
+MAX_DNA_NGRAM_LEN = 31
 
 logger = logging.getLogger(__name__)
 
@@ -25,15 +41,49 @@ class ZenNgramDict(object):
     """
     Dict class to store the ngram
     """
-    def __init__(self, ngram_freq_path, tokenizer, max_ngram_in_seq=128):
+    def __init__(self, ngram_freq_path, tokenizer=None, max_ngram_in_seq=128, min_ngram_len=None,
+                 max_ngram_len=None, dna=False):
         """Constructs ZenNgramDict
 
-        :param ngram_freq_path: ngrams with frequency
+        :param ngram_freq_path: ngrams with frequency, either the text file or a binary file written by
+            `convert_ngram_file_to_binary`. A directory is resolved to its binary file if it has one.
+        :param tokenizer: tokenizer for the text file, not needed for the binary file or in DNA mode
+        :param min_ngram_len: shortest ngram (in tokens) to match, defaults to the shortest one in the lexicon
+        :param max_ngram_len: longest ngram (in tokens) to match, defaults to the longest one in the lexicon
+        :param dna: the text file holds DNA k-mers; store each one packed into an integer (2 bits per base) and
+            match them with a rolling hash. Binary files record this themselves.
         """
         if os.path.isdir(ngram_freq_path):
-            ngram_freq_path = os.path.join(ngram_freq_path, NGRAM_DICT_NAME)
+            if os.path.isfile(os.path.join(ngram_freq_path, NGRAM_BINARY_NAME)):
+                ngram_freq_path = os.path.join(ngram_freq_path, NGRAM_BINARY_NAME)
+            else:
+                ngram_freq_path = os.path.join(ngram_freq_path, NGRAM_DICT_NAME)
         self.ngram_freq_path = ngram_freq_path
         self.max_ngram_in_seq = max_ngram_in_seq
+        # ngram length -> ids of the ngrams with that length
+        self.ngram_ids_by_length = {}
+        self.binary = _is_ngram_binary_file(ngram_freq_path)
+        if self.binary:
+            logger.info("loading binary ngram file {}".format(ngram_freq_path))
+            arrays, key_type = _read_ngram_binary(ngram_freq_path)
+            self._init_packed(arrays, key_type, min_ngram_len, max_ngram_len)
+        elif dna:
+            logger.info("loading DNA ngram frequency file {}".format(ngram_freq_path))
+            arrays, key_type = _pack_ngram_file(ngram_freq_path, None, dna=True)
+            self._init_packed(arrays, key_type, min_ngram_len, max_ngram_len)
+        else:
+            self.packed = False
+            self.dna = False
+            self._load_text(ngram_freq_path, tokenizer, min_ngram_len, max_ngram_len)
+        self.ngram_lengths = sorted(self.ngram_ids_by_length)
+        self.min_ngram_len = self.ngram_lengths[0] if self.ngram_lengths else 0
+        self.max_ngram_len = self.ngram_lengths[-1] if self.ngram_lengths else 0
+        logger.info("ngram lengths in lexicon: {}".format(
+            ", ".join("{}: {}".format(length, len(self.ngram_ids_by_length[length])) for length in self.ngram_lengths)))
+        self._matcher = None
+        self._batch_matcher = None
+
+    def _load_text(self, ngram_freq_path, tokenizer, min_ngram_len, max_ngram_len):
         self.id_to_ngram_list = ["[pad]"]
         self.ngram_to_id_dict = {"[pad]": 0}
         self.ngram_to_freq_dict = {}
@@ -55,8 +105,575 @@ class ZenNgramDict(object):
                 self.ngram_to_freq_dict[ngram] = freq
                 self.id_to_ngram_list.append(tokens)
                 self.ngram_to_id_dict[tokens] = i + 1
+                if (min_ngram_len is None or len(tokens) >= min_ngram_len) and \
+                        (max_ngram_len is None or len(tokens) <= max_ngram_len):
+                    self.ngram_ids_by_length.setdefault(len(tokens), []).append(i + 1)
+
+    def _init_packed(self, arrays, key_type, min_ngram_len, max_ngram_len):
+        # keys/ids/freqs/lengths are sorted by key; key_index maps ngram id - 1 to its row in them
+        self.packed = True
+        self.dna = key_type == "dna"
+        codec = _DNA_KEY_CODEC if self.dna else _TOKEN_KEY_CODEC
+        self.ngram_keys = arrays["keys"]
+        self.ngram_key_ids = arrays["ids"]
+        self.ngram_key_freqs = arrays["freqs"]
+        self.ngram_key_lengths = arrays["lengths"]
+        self.id_to_ngram_list = _PackedNgramList(self.ngram_keys, arrays["key_index"], codec)
+        self.ngram_to_id_dict = _PackedNgramIdDict(self.ngram_keys, self.ngram_key_ids, codec)
+        self.ngram_to_freq_dict = _PackedNgramFreqDict(self.ngram_keys, self.ngram_key_freqs, codec)
+        for length in np.unique(self.ngram_key_lengths).tolist():
+            if (min_ngram_len is None or length >= min_ngram_len) and \
+                    (max_ngram_len is None or length <= max_ngram_len):
+                self.ngram_ids_by_length[length] = self.ngram_key_ids[self.ngram_key_lengths == length]
+
+    @property
+    def matcher(self):
+        """The compiled ngram matcher for this dict, built on first use.
+
+        Packed lexicons are matched by binary search over their sorted keys, so they have nothing to build.
+        """
+        if self._matcher is None:
+            if self.dna:
+                self._matcher = ZenDnaNgramMatcher(self.ngram_keys, self.ngram_key_ids, self.ngram_lengths)
+            elif self.packed:
+                self._matcher = ZenSortedNgramMatcher(self.ngram_keys, self.ngram_key_ids, self.ngram_lengths)
+            else:
+                self._matcher = ZenNgramMatcher(
+                    (self.id_to_ngram_list[ngram_id], ngram_id)
+                    for length in self.ngram_lengths for ngram_id in self.ngram_ids_by_length[length])
+        return self._matcher
+
+    def batch_matcher(self, vocab):
+        """The `ZenBatchNgramMatcher` of this dict over token ids of `vocab`, built on first use.
+
+        :param vocab: token -> id mapping of the tokenizer that produces the ids to match
+        """
+        if self._batch_matcher is None or self._batch_matcher.vocab is not vocab:
+            self._batch_matcher = ZenBatchNgramMatcher(self, vocab)
+        return self._batch_matcher
 
     def save(self, ngram_freq_path):
         with open(ngram_freq_path, "w", encoding="utf-8") as fout:
             for ngram,freq in self.ngram_to_freq_dict.items():
-                fout.write("{},{}\n".format(ngram, freq))
\ No newline at end of file
+                fout.write("{},{}\n".format(ngram, freq))
+
+
+def _ngram_key(tokens):
+    # tokens never contain whitespace, so joining on a space keeps multi-character tokens unambiguous
+    return " ".join(tokens).encode("utf-8")
+
+
+def encode_dna_ngram(bases):
+    """Packs a DNA k-mer into an integer: a leading 1 bit followed by 2 bits per base.
+
+    Raises KeyError for anything but a/c/g/t.
+    """
+    code = 1
+    for base in bases:
+        code = (code << 2) | DNA_BASE_CODES[base]
+    return code
+
+
+def decode_dna_ngram(code):
+    """Unpacks an integer made by `encode_dna_ngram` into a tuple of bases."""
+    code = int(code)
+    length = (code.bit_length() - 1) // 2
+    return tuple("acgt"[(code >> (2 * (length - 1 - i))) & 3] for i in range(length))
+
+
+# (key type, ngram token tuple -> key, key -> ngram token tuple) of the packed lexicon formats
+_TOKEN_KEY_CODEC = ("tokens", _ngram_key, lambda key: tuple(key.decode("utf-8").split(" ")))
+_DNA_KEY_CODEC = ("dna", encode_dna_ngram, decode_dna_ngram)
+
+
+def _pack_ngram_file(ngram_freq_path, tokenizer, dna=False):
+    if os.path.isdir(ngram_freq_path):
+        ngram_freq_path = os.path.join(ngram_freq_path, NGRAM_DICT_NAME)
+    keys, freqs, lengths = [], [], []
+    with open(ngram_freq_path, "r", encoding="utf-8") as fin:
+        for i, line in enumerate(fin):
+            ngram, freq = line.split(" ")
+            if dna:
+                if len(ngram) > MAX_DNA_NGRAM_LEN:
+                    raise ValueError("DNA ngram on line {} of {} is longer than {} bases".format(
+                        i + 1, ngram_freq_path, MAX_DNA_NGRAM_LEN))
+                try:
+                    keys.append(encode_dna_ngram(ngram))
+                except KeyError:
+                    raise ValueError("Line {} of {} is not a DNA ngram: {}".format(i + 1, ngram_freq_path, ngram))
+                lengths.append(len(ngram))
+            else:
+                tokens = tokenizer.tokenize(ngram)
+                keys.append(_ngram_key(tokens))
+                lengths.append(len(tokens))
+            freqs.append(int(freq))
+    keys = np.array(keys, dtype=np.int64 if dna else np.bytes_)
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    # the text loader lets a later line override an earlier one with the same tokens, so keep the last of each run
+    last = np.ones(len(sorted_keys), dtype=bool)
+    last[:-1] = sorted_keys[1:] != sorted_keys[:-1]
+    key_index = np.empty(len(keys), dtype=np.int32)
+    key_index[order] = np.cumsum(last) - last
+    kept = order[last]
+    arrays = collections.OrderedDict([
+        ("keys", sorted_keys[last]),
+        ("ids", (kept + 1).astype(np.int32)),
+        ("freqs", np.array(freqs, dtype=np.int64)[kept]),
+        ("lengths", np.array(lengths, dtype=np.uint8)[kept]),
+        ("key_index", key_index),
+    ])
+    return arrays, "dna" if dna else "tokens"
+
+
+def convert_ngram_file_to_binary(ngram_freq_path, ngram_binary_path, tokenizer, dna=False):
+    """Compiles a text ngram frequency file into the binary format read by `ZenNgramDict`.
+
+    The binary file holds the tokenized ngrams as sorted fixed-width keys together with their ids, frequencies
+    and lengths, so that loading it needs neither the tokenizer nor building any Python containers.
+
+    :param ngram_freq_path: ngram text file with one "ngram frequency" pair per line
+    :param ngram_binary_path: file to write
+    :param tokenizer: the tokenizer `ZenNgramDict` would use on the text file, not needed with `dna`
+    :param dna: the ngrams are DNA k-mers; store them as packed 2-bit integer keys
+    :return: number of ngrams written
+    """
+    arrays, key_type = _pack_ngram_file(ngram_freq_path, tokenizer, dna=dna)
+    _write_ngram_binary(ngram_binary_path, arrays, key_type)
+    logger.info("wrote {} ngrams to {}".format(len(arrays["key_index"]), ngram_binary_path))
+    return len(arrays["key_index"])
+
+
+def _is_ngram_binary_file(path):
+    with open(path, "rb") as fin:
+        return fin.read(len(_NGRAM_BINARY_MAGIC)) == _NGRAM_BINARY_MAGIC
+
+
+def _write_ngram_binary(path, arrays, key_type):
+    # layout: magic, little-endian uint32 header size, json header, then every array at a 64-byte aligned offset
+    header = {"version": _NGRAM_BINARY_VERSION, "key_type": key_type, "arrays": collections.OrderedDict()}
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = [array.dtype.str, len(array), offset]
+        offset += -(-array.nbytes // 64) * 64
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = -(-(len(_NGRAM_BINARY_MAGIC) + 4 + len(header_bytes)) // 64) * 64
+    with open(path, "wb") as fout:
+        fout.write(_NGRAM_BINARY_MAGIC)
+        fout.write(struct.pack("<I", len(header_bytes)))
+        fout.write(header_bytes)
+        for name, array in arrays.items():
+            fout.seek(data_start + header["arrays"][name][2])
+            fout.write(np.ascontiguousarray(array).tobytes())
+        fout.truncate(data_start + offset)
+
+
+def _read_ngram_binary(path):
+    with open(path, "rb") as fin:
+        if fin.read(len(_NGRAM_BINARY_MAGIC)) != _NGRAM_BINARY_MAGIC:
+            raise ValueError("{} is not a binary ngram file".format(path))
+        header_size, = struct.unpack("<I", fin.read(4))
+        header = json.loads(fin.read(header_size).decode("utf-8"))
+    if header["version"] != _NGRAM_BINARY_VERSION:
+        raise ValueError("Unsupported binary ngram file version {} in {}".format(header["version"], path))
+    data_start = -(-(len(_NGRAM_BINARY_MAGIC) + 4 + header_size) // 64) * 64
+    arrays = {}
+    for name, (dtype, size, offset) in header["arrays"].items():
+        # read-only maps share one copy of the pages between every process that opens the file
+        arrays[name] = np.memmap(path, dtype=np.dtype(dtype), mode="r", offset=data_start + offset, shape=(size,))
+    return arrays, header.get("key_type", "tokens")
+
+
+def _search_sorted_keys(keys, candidates):
+    """Looks `candidates` up in the sorted `keys`, returning the candidates found and their rows in `keys`."""
+    rows = np.searchsorted(keys, candidates)
+    rows[rows == len(keys)] = 0
+    found = np.flatnonzero(keys[rows] == candidates)
+    return found, rows[found]
+
+
+class _PackedNgramList(Sequence):
+    """`id_to_ngram_list` of a packed lexicon: ngram id -> token tuple."""
+    def __init__(self, keys, key_index, codec):
+        self._keys = keys
+        self._key_index = key_index
+        self._decode = codec[2]
+
+    def __len__(self):
+        return len(self._key_index) + 1
+
+    def __getitem__(self, ngram_id):
+        if ngram_id == 0:
+            return "[pad]"
+        return self._decode(self._keys[self._key_index[ngram_id - 1]])
+
+
+class _PackedNgramIdDict(Mapping):
+    """`ngram_to_id_dict` of a packed lexicon: token tuple -> ngram id, looked up by binary search."""
+    def __init__(self, keys, ids, codec):
+        self._keys = keys
+        self._ids = ids
+        self._encode = codec[1]
+        self._decode = codec[2]
+
+    def __getitem__(self, ngram):
+        if ngram == "[pad]":
+            return 0
+        try:
+            key = self._encode(ngram) if isinstance(ngram, tuple) else None
+        except KeyError:
+            key = None
+        row = np.searchsorted(self._keys, key) if key is not None else len(self._keys)
+        if row >= len(self._keys) or self._keys[row] != key:
+            raise KeyError(ngram)
+        return int(self._ids[row])
+
+    def __len__(self):
+        return len(self._keys) + 1
+
+    def __iter__(self):
+        yield "[pad]"
+        for key in self._keys:
+            yield self._decode(key)
+
+
+class _PackedNgramFreqDict(Mapping):
+    """`ngram_to_freq_dict` of a packed lexicon: ngram text -> frequency."""
+    def __init__(self, keys, freqs, codec):
+        self._keys = keys
+        self._freqs = freqs
+        self._encode = codec[1]
+        self._decode = codec[2]
+
+    def __getitem__(self, ngram):
+        try:
+            key = self._encode(tuple(ngram))
+        except KeyError:
+            raise KeyError(ngram)
+        row = np.searchsorted(self._keys, key)
+        if row >= len(self._keys) or self._keys[row] != key:
+            raise KeyError(ngram)
+        return int(self._freqs[row])
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        for key in self._keys:
+            yield "".join(self._decode(key))
+
+
+class ZenNgramMatcher(object):
+    """
+    Aho-Corasick automaton over the ngram lexicon.
+
+    Finds every ngram occurring in a token sequence in a single left-to-right pass, instead of slicing and
+    hashing a tuple for every window of every length.
+    """
+    def __init__(self, ngrams):
+        """Constructs ZenNgramMatcher
+
+        :param ngrams: iterable of (ngram token tuple, ngram id) pairs to match
+        """
+        # node 0 is the root; every node stores its outgoing edges, failure link, depth and the id of the ngram
+        # ending exactly at it (-1 if none)
+        self._goto = [{}]
+        self._fail = [0]
+        self._depth = [0]
+        self._output = [-1]
+        for ngram, ngram_id in ngrams:
+            node = 0
+            for token in ngram:
+                child = self._goto[node].get(token)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto[node][token] = child
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._depth.append(self._depth[node] + 1)
+                    self._output.append(-1)
+                node = child
+            self._output[node] = ngram_id
+        self._build_links()
+
+    def _build_links(self):
+        goto, fail, output = self._goto, self._fail, self._output
+        # dict link: the longest proper suffix of a node that is itself an ngram, so that every match ending at a
+        # position can be reported without walking the whole failure chain
+        dict_link = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for token, child in goto[node].items():
+                queue.append(child)
+                if node == 0:
+                    continue
+                state = fail[node]
+                while state and token not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(token, 0)
+                suffix = fail[child]
+                dict_link[child] = suffix if output[suffix] != -1 else dict_link[suffix]
+        self._dict_link = dict_link
+
+    def match(self, tokens):
+        """Finds all ngrams in `tokens`.
+
+        :param tokens: sequence of tokens
+        :return: parallel lists (ngram_ids, starts, lengths), ordered by length and then by start position
+        """
+        goto, fail, depth, output, dict_link = self._goto, self._fail, self._depth, self._output, self._dict_link
+        matches = []
+        node = 0
+        for end, token in enumerate(tokens):
+            while node and token not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(token, 0)
+            state = node if output[node] != -1 else dict_link[node]
+            while state:
+                length = depth[state]
+                matches.append((length, end - length + 1, output[state]))
+                state = dict_link[state]
+        matches.sort()
+        return [m[2] for m in matches], [m[1] for m in matches], [m[0] for m in matches]
+
+
+class ZenSortedNgramMatcher(object):
+    """
+    Ngram matcher over the sorted keys of a binary lexicon.
+
+    Every window whose length occurs in the lexicon is looked up with a single vectorized binary search per
+    sequence, straight against the memory-mapped keys.
+    """
+    def __init__(self, keys, ids, ngram_lengths):
+        """Constructs ZenSortedNgramMatcher
+
+        :param keys: sorted packed ngram keys
+        :param ids: ngram id of every key
+        :param ngram_lengths: ngram lengths to match
+        """
+        self._keys = keys
+        self._ids = ids
+        self.ngram_lengths = list(ngram_lengths)
+
+    def match(self, tokens):
+        """Finds all ngrams in `tokens`.
+
+        :param tokens: sequence of tokens
+        :return: parallel lists (ngram_ids, starts, lengths), ordered by length and then by start position
+        """
+        # every window key is a slice of the space-joined sequence, so no window is joined on its own
+        text = _ngram_key(tokens)
+        offsets = [0]
+        for token in tokens:
+            offsets.append(offsets[-1] + len(token.encode("utf-8")) + 1)
+        key_width = self._keys.dtype.itemsize
+        windows, starts, lengths = [], [], []
+        for length in self.ngram_lengths:
+            for start in range(len(tokens) - length + 1):
+                begin, end = offsets[start], offsets[start + length] - 1
+                if end - begin <= key_width:
+                    windows.append(text[begin:end])
+                    starts.append(start)
+                    lengths.append(length)
+        if not windows:
+            return [], [], []
+        found, rows = _search_sorted_keys(self._keys, np.array(windows, dtype=self._keys.dtype))
+        return self._ids[rows].tolist(), np.array(starts)[found].tolist(), np.array(lengths)[found].tolist()
+
+
+class ZenDnaNgramMatcher(object):
+    """
+    Ngram matcher over a lexicon of DNA k-mers packed by `encode_dna_ngram`.
+
+    The packed code of every k-mer ending at a position is updated from the previous position with a shift and a
+    mask, for the lexicon lengths only, and all of them are then looked up in one vectorized binary search.
+    Anything but a/c/g/t (special tokens, [MASK], N) breaks the run of bases, so no k-mer spans it.
+    """
+    def __init__(self, codes, ids, ngram_lengths):
+        """Constructs ZenDnaNgramMatcher
+
+        :param codes: sorted packed k-mer codes
+        :param ids: ngram id of every code
+        :param ngram_lengths: k-mer lengths to match
+        """
+        self._codes = codes
+        self._ids = ids
+        self.ngram_lengths = list(ngram_lengths)
+        self.max_ngram_len = max(self.ngram_lengths) if self.ngram_lengths else 0
+        # (length, length marker bit, mask of the length's bases)
+        self._length_masks = [(length, 1 << (2 * length), (1 << (2 * length)) - 1) for length in self.ngram_lengths]
+
+    def match(self, tokens):
+        """Finds all ngrams in `tokens`.
+
+        :param tokens: sequence of tokens
+        :return: parallel lists (ngram_ids, starts, lengths), ordered by length and then by start position
+        """
+        window_mask = (1 << (2 * self.max_ngram_len)) - 1
+        codes, starts, lengths = [], [], []
+        window = 0
+        run = 0
+        for end, token in enumerate(tokens):
+            base = DNA_BASE_CODES.get(token)
+            if base is None:
+                run = 0
+                continue
+            window = ((window << 2) | base) & window_mask
+            run += 1
+            for length, marker, mask in self._length_masks:
+                if length > run:
+                    break
+                codes.append(marker | (window & mask))
+                starts.append(end - length + 1)
+                lengths.append(length)
+        if not codes:
+            return [], [], []
+        found, rows = _search_sorted_keys(self._codes, np.array(codes, dtype=np.int64))
+        starts = np.array(starts)[found]
+        lengths = np.array(lengths)[found]
+        order = np.lexsort((starts, lengths))
+        return self._ids[rows[order]].tolist(), starts[order].tolist(), lengths[order].tolist()
+
+
+class ZenBatchNgramMatcher(object):
+    """
+    Ngram matcher over whole batches of token id sequences.
+
+    For every lexicon length the code of each window of the N x L id array is computed with NumPy, rolling it one
+    token longer per length, and all windows are looked up at once with `np.searchsorted` on the sorted lexicon
+    codes. DNA lexicons use their exact 2-bit k-mer codes. Other lexicons use a 64-bit polynomial hash of the token
+    ids, chosen to be unique over the lexicon, and the windows whose hash is found are checked token by token, so
+    the result is exactly that of the per-sequence matchers.
+    """
+    # multipliers tried in turn until the hash has no collision within the lexicon
+    _HASH_MULTIPLIERS = (1000003, 2654435761, 11400714819323198485, 6364136223846793005, 1442695040888963407)
+
+    def __init__(self, ngram_dict, vocab):
+        """Constructs ZenBatchNgramMatcher
+
+        :param ngram_dict: the `ZenNgramDict` to match
+        :param vocab: token -> id mapping of the tokenizer that produces the ids to match
+        """
+        self.vocab = vocab
+        self.ngram_lengths = list(ngram_dict.ngram_lengths)
+        self.max_ngram_len = ngram_dict.max_ngram_len
+        self.dna = ngram_dict.dna
+        if self.dna:
+            # id -> 2-bit base code, -1 for every token that is not a base
+            self._base_codes = np.full(max(vocab.values()) + 1, -1, dtype=np.int64)
+            for token, token_id in vocab.items():
+                if token in DNA_BASE_CODES:
+                    self._base_codes[token_id] = DNA_BASE_CODES[token]
+            self._keys = np.asarray(ngram_dict.ngram_keys)
+            self._ids = np.asarray(ngram_dict.ngram_key_ids)
+            return
+        # one row per distinct ngram, with the id the lexicon maps it to (the last of duplicate entries). Ngrams with a
+        # token missing from vocab can never occur in the ids, so they are left out.
+        lengths = set(self.ngram_lengths)
+        rows = []
+        for tokens, ngram_id in ngram_dict.ngram_to_id_dict.items():
+            if isinstance(tokens, tuple) and len(tokens) in lengths and tokens and \
+                    all(token in vocab for token in tokens):
+                rows.append((ngram_id, [vocab[token] for token in tokens]))
+        ngram_ids = np.array([ngram_id for ngram_id, _ in rows], dtype=np.int32)
+        # token ids of every lexicon ngram, padded with -1
+        ngram_token_ids = np.full((len(rows), max(self.max_ngram_len, 1)), -1, dtype=np.int64)
+        for row, (_, token_ids) in enumerate(rows):
+            ngram_token_ids[row, :len(token_ids)] = token_ids
+        ngram_lengths = (ngram_token_ids >= 0).sum(axis=1)
+        for multiplier in self._HASH_MULTIPLIERS:
+            self._multiplier = np.uint64(multiplier)
+            keys = np.zeros(len(ngram_ids), dtype=np.uint64)
+            for position in range(ngram_token_ids.shape[1]):
+                in_ngram = position < ngram_lengths
+                keys[in_ngram] = self._roll(keys[in_ngram], ngram_token_ids[in_ngram, position])
+            keys = self._finish(keys, ngram_lengths)
+            order = np.argsort(keys, kind="stable")
+            keys = keys[order]
+            if not np.any(keys[1:] == keys[:-1]):
+                break
+        else:
+            raise ValueError("Could not find a collision-free hash for the ngram lexicon")
+        self._keys = keys
+        self._ids = ngram_ids[order]
+        self._ngram_token_ids = ngram_token_ids[order]
+
+    def _roll(self, codes, token_ids):
+        # the wrap-around of uint64 arithmetic is the hash's modulus
+        with np.errstate(over="ignore"):
+            return codes * self._multiplier + (token_ids.astype(np.uint64) + np.uint64(1))
+
+    def _finish(self, codes, lengths):
+        with np.errstate(over="ignore"):
+            return codes ^ (np.asarray(lengths, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+
+    def match(self, input_ids, seq_lengths):
+        """Finds all ngrams in every sequence of a batch.
+
+        :param input_ids: N x L int array of token ids
+        :param seq_lengths: number of real (not padding) tokens in each sequence; windows past it are ignored
+        :return: (ngram_ids, starts, lengths, num_matches). The first three are N x K int arrays, where K is the most
+            matches of any sequence, padded with 0 after each sequence's `num_matches`; each row is ordered by length
+            and then by start position, as `ZenNgramMatcher.match` orders them.
+        """
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        seq_lengths = np.asarray(seq_lengths, dtype=np.int64)
+        num_seqs, seq_len = input_ids.shape
+        if self.dna:
+            bases = self._base_codes[np.clip(input_ids, 0, len(self._base_codes) - 1)]
+            bases[input_ids >= len(self._base_codes)] = -1
+            is_token = bases >= 0
+            codes = np.zeros_like(input_ids)
+        else:
+            is_token = np.ones(input_ids.shape, dtype=bool)
+            codes = np.zeros(input_ids.shape, dtype=np.uint64)
+        starts = np.arange(seq_len)
+        # codes[:, s] and valid[:, s] describe the window of the current length starting at s
+        valid = np.ones(input_ids.shape, dtype=bool)
+        found_seqs, found_ids, found_starts, found_lengths = [], [], [], []
+        for length in range(1, min(self.max_ngram_len, seq_len) + 1):
+            num_windows = seq_len - length + 1
+            last = slice(length - 1, seq_len)
+            valid = valid[:, :num_windows] & is_token[:, last]
+            if self.dna:
+                codes = (codes[:, :num_windows] << 2) | np.maximum(bases[:, last], 0)
+            else:
+                codes = self._roll(codes[:, :num_windows], input_ids[:, last])
+            if length not in self.ngram_lengths:
+                continue
+            in_seq = valid & (starts[None, :num_windows] + length <= seq_lengths[:, None])
+            seq_index, start = np.nonzero(in_seq)
+            if self.dna:
+                candidates = codes[seq_index, start] | (1 << (2 * length))
+            else:
+                candidates = self._finish(codes[seq_index, start], length)
+            found, rows = _search_sorted_keys(self._keys, candidates)
+            seq_index, start = seq_index[found], start[found]
+            if not self.dna:
+                windows = input_ids[seq_index[:, None], start[:, None] + np.arange(length)]
+                same = np.all(windows == self._ngram_token_ids[rows, :length], axis=1)
+                seq_index, start, rows = seq_index[same], start[same], rows[same]
+            found_seqs.append(seq_index)
+            found_ids.append(self._ids[rows])
+            found_starts.append(start)
+            found_lengths.append(np.full(len(start), length, dtype=np.int64))
+        num_matches = np.zeros(num_seqs, dtype=np.int64)
+        if not found_seqs:
+            empty = np.zeros((num_seqs, 0), dtype=np.int64)
+            return empty, empty.copy(), empty.copy(), num_matches
+        seq_index = np.concatenate(found_seqs)
+        ngram_ids = np.concatenate(found_ids)
+        start = np.concatenate(found_starts)
+        lengths = np.concatenate(found_lengths)
+        order = np.lexsort((start, lengths, seq_index))
+        seq_index = seq_index[order]
+        num_matches += np.bincount(seq_index, minlength=num_seqs)
+        # column of every match within its sequence's row
+        column = np.arange(len(seq_index)) - (np.cumsum(num_matches) - num_matches)[seq_index]
+        width = int(num_matches.max()) if num_seqs else 0
+        out_ids, out_starts, out_lengths = (np.zeros((num_seqs, width), dtype=np.int64) for _ in range(3))
+        out_ids[seq_index, column] = ngram_ids[order]
+        out_starts[seq_index, column] = start[order]
+        out_lengths[seq_index, column] = lengths[order]
+        return out_ids, out_starts, out_lengths, num_matches
@@ -25,8 +25,12 @@ import collections
 import logging
 import os
 import unicodedata
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from io import open
 
+import numpy as np
+
 from .file_utils import cached_path
 
 logger = logging.getLogger(__name__)
@@ -76,6 +80,35 @@ PRETRAINED_VOCAB_POSITIONAL_EMBEDDINGS_SIZE_MAP = {
 }
 VOCAB_NAME = 'vocab.txt'
 
+# DNA模式下的碱基：a/c/g/t（u视为t），IUPAC模糊碱基（n, r, y等）都映射为n，其余字符（空白、标点、gap等）丢弃
+DNA_BASES = "acgt"
+DNA_AMBIGUITY_CODES = "nrykmswbdhv"
+DNA_UNKNOWN_BASE = "n"
+
+# WordpieceTokenizer默认缓存的单词数
+WORDPIECE_CACHE_SIZE = 100000
+
+
+def _build_dna_translation():
+    """Table and deletions for `bytes.translate` that turn ASCII text into lower case bases."""
+    table = bytearray(range(256))
+    keep = set()
+    for bases, target in [(DNA_BASES, None), ("u", "t"), (DNA_AMBIGUITY_CODES, DNA_UNKNOWN_BASE)]:
+        for base in bases:
+            for char in (base, base.upper()):
+                table[ord(char)] = ord(target or base)
+                keep.add(ord(char))
+    delete = bytes(sorted(set(range(256)) - keep))
+    return bytes(table), delete
+
+
+_DNA_TRANSLATION_TABLE, _DNA_DELETE_CHARS = _build_dna_translation()
+
+
+def normalize_dna(text):
+    """Lower cases the bases of `text`, maps ambiguity codes to `DNA_UNKNOWN_BASE` and drops everything else."""
+    return text.encode("ascii", "ignore").translate(_DNA_TRANSLATION_TABLE, _DNA_DELETE_CHARS).decode("ascii")
+
 
 # 将vocab_file中的每一行看作一个token，将token作为key，index作为value存入有序字典中
 def load_vocab(vocab_file):
@@ -93,6 +126,23 @@ def load_vocab(vocab_file):
     return vocab
 
 
+def _truncate_seq_pair(tokens_a, tokens_b, max_length):
+    """Truncates a sequence pair in place to the maximum length."""
+
+    # This is a simple heuristic which will always truncate the longer sequence
+    # one token at a time. This makes more sense than truncating an equal percent
+    # of tokens from each, since if one sequence is very short then each token
+    # that's truncated likely contains more information than a longer sequence.
+    while True:
+        total_length = len(tokens_a) + len(tokens_b)
+        if total_length <= max_length:
+            break
+        if len(tokens_a) > len(tokens_b):
+            tokens_a.pop()
+        else:
+            tokens_b.pop()
+
+
 # 将text中所有空格去掉，被分割开的tokens提取出来
 def whitespace_tokenize(text):
     """Runs basic whitespace cleaning and splitting on a piece of text."""
@@ -108,7 +158,8 @@ class BertTokenizer(object):
     """Runs end-to-end tokenization: punctuation splitting + wordpiece"""
 
     def __init__(self, vocab_file, do_lower_case=True, max_len=None, do_basic_tokenize=True,
-                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]")):
+                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]"), dna=False,
+                 wordpiece_cache_size=WORDPIECE_CACHE_SIZE):
         """Constructs a BertTokenizer.
 
         Args:
@@ -122,6 +173,12 @@ class BertTokenizer(object):
                          sequence length.
           never_split: List of tokens which will never be split during tokenization.
                          Only has an effect when do_wordpiece_only=False
+          dna: Tokenize the text as a nucleotide read, one token per base, with a
+                         byte lookup table instead of the basic tokenizer. Ambiguity
+                         codes become `n` ([UNK] if the vocabulary has no `n`), and
+                         whitespace and other characters are dropped.
+          wordpiece_cache_size: Number of words whose wordpieces the wordpiece
+                         tokenizer caches, 0 to disable the cache.
         """
         if not os.path.isfile(vocab_file):
             raise ValueError(
@@ -134,10 +191,24 @@ class BertTokenizer(object):
         if do_basic_tokenize:
           self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case,
                                                 never_split=never_split)
-        self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+        self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab, cache_size=wordpiece_cache_size)
         self.max_len = max_len if max_len is not None else int(1e12)
+        self.dna = dna
+        if dna:
+            missing = [base for base in DNA_BASES if base not in self.vocab]
+            if missing:
+                raise ValueError("The vocabulary at '{}' has no token for the bases {}".format(vocab_file, missing))
+            self.dna_unknown_token = DNA_UNKNOWN_BASE if DNA_UNKNOWN_BASE in self.vocab \
+                else self.wordpiece_tokenizer.unk_token
+            # 每个字节对应的token id，只有normalize_dna留下的字节会被查到
+            self.dna_id_table = np.zeros(256, dtype=np.int64)
+            for base in DNA_BASES:
+                self.dna_id_table[ord(base)] = self.vocab[base]
+            self.dna_id_table[ord(DNA_UNKNOWN_BASE)] = self.vocab[self.dna_unknown_token]
 
     def tokenize(self, text):
+        if self.dna:
+            return self._tokenize_dna(text)
         split_tokens = []
         if self.do_basic_tokenize:
             for token in self.basic_tokenizer.tokenize(text):
@@ -148,6 +219,105 @@ class BertTokenizer(object):
             split_tokens = self.wordpiece_tokenizer.tokenize(text)
         return split_tokens
 
+    def _tokenize_dna(self, text):
+        tokens = list(normalize_dna(text))
+        if self.dna_unknown_token != DNA_UNKNOWN_BASE:
+            tokens = [self.dna_unknown_token if token == DNA_UNKNOWN_BASE else token for token in tokens]
+        return tokens
+
+    # DNA模式下直接把一条序列转换成token id，不生成中间的tokens列表
+    def convert_dna_to_ids(self, text):
+        """Converts a nucleotide read into a NumPy array of token ids, one per base.
+
+        The ids are those of `convert_tokens_to_ids(tokenize(text))`, looked up in a
+        table over the bytes of the read. Only available with `dna=True`.
+        """
+        if not self.dna:
+            raise ValueError("convert_dna_to_ids needs a tokenizer constructed with dna=True")
+        bases = np.frombuffer(normalize_dna(text).encode("ascii"), dtype=np.uint8)
+        ids = self.dna_id_table[bases]
+        if len(ids) > self.max_len:
+            logger.warning(
+                "Token indices sequence length is longer than the specified maximum "
+                " sequence length for this BERT model ({} > {}). Running this"
+                " sequence through BERT will result in indexing errors".format(len(ids), self.max_len)
+            )
+        return ids
+
+    def _tokenize_all(self, texts):
+        return [self.tokenize(text) for text in texts]
+
+    # 把多条文本分成若干块，在多个线程或进程中分词
+    def tokenize_batch(self, texts, num_workers=1, use_processes=False):
+        """Tokenizes several texts, optionally in parallel.
+
+        Args:
+          texts: List of texts.
+          num_workers: Number of threads (or processes) tokenizing chunks of the texts.
+          use_processes: Use processes instead of threads. Threads only help the parts
+                         of tokenization that release the GIL; processes pay for
+                         sending the tokenizer and the tokens between processes.
+
+        Returns:
+          The tokens of every text, in the order of `texts`.
+        """
+        texts = list(texts)
+        if num_workers <= 1 or len(texts) <= 1:
+            return self._tokenize_all(texts)
+        # a few chunks per worker, so that the workers finish at about the same time
+        chunk_size = -(-len(texts) // (num_workers * 4))
+        chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with executor_class(num_workers) as executor:
+            return [tokens for chunk in executor.map(self._tokenize_all, chunks) for tokens in chunk]
+
+    # 批量编码：分词、截断、加[CLS]和[SEP]、转换成id并padding到max_len，返回numpy数组
+    def encode_batch(self, texts, max_len, pair_texts=None, num_workers=1, use_processes=False):
+        """Encodes texts (or text pairs) into padded arrays of BERT inputs.
+
+        Every row is `[CLS] a [SEP]`, or `[CLS] a [SEP] b [SEP]` for a pair, padded
+        with zeros to `max_len`. A pair is truncated to `max_len - 3` tokens by
+        removing tokens from the end of the longer text one at a time, a single text
+        to its first `max_len - 2` tokens. An empty or None pair text encodes the text
+        alone, but still truncated as a pair.
+
+        Args:
+          texts: List of texts.
+          max_len: Length of the rows, including [CLS] and [SEP].
+          pair_texts: Optional list of second texts, one per text.
+          num_workers, use_processes: How to tokenize, see `tokenize_batch`.
+
+        Returns:
+          (input_ids, input_mask, segment_ids): int64 arrays of shape
+          [len(texts), max_len]. The mask is 1 for the real tokens and the segment
+          ids are 1 for the tokens of the second text and its [SEP].
+        """
+        tokens_a = self.tokenize_batch(texts, num_workers, use_processes)
+        tokens_b = None
+        if pair_texts is not None:
+            if len(pair_texts) != len(tokens_a):
+                raise ValueError("Got {} texts but {} pair texts".format(len(tokens_a), len(pair_texts)))
+            tokens_b = self.tokenize_batch([text or "" for text in pair_texts], num_workers, use_processes)
+        input_ids = np.zeros((len(tokens_a), max_len), dtype=np.int64)
+        input_mask = np.zeros((len(tokens_a), max_len), dtype=np.int64)
+        segment_ids = np.zeros((len(tokens_a), max_len), dtype=np.int64)
+        for i, tokens in enumerate(tokens_a):
+            pair_tokens = None
+            if tokens_b is not None and pair_texts[i]:
+                pair_tokens = tokens_b[i]
+                # Account for [CLS], [SEP], [SEP] with "- 3"
+                _truncate_seq_pair(tokens, pair_tokens, max_len - 3)
+            else:
+                # Account for [CLS] and [SEP] with "- 2"
+                tokens = tokens[:max_len - 2]
+            tokens = ["[CLS]"] + tokens + ["[SEP]"]
+            if pair_tokens:
+                segment_ids[i, len(tokens):len(tokens) + len(pair_tokens) + 1] = 1
+                tokens += pair_tokens + ["[SEP]"]
+            input_ids[i, :len(tokens)] = self.convert_tokens_to_ids(tokens)
+            input_mask[i, :len(tokens)] = 1
+        return input_ids, input_mask, segment_ids
+
     # 给定tokens，返回字典中tokens所对应的indexes序列
     def convert_tokens_to_ids(self, tokens):
         """Converts a sequence of tokens into ids using the vocab."""
@@ -375,16 +545,65 @@ class BasicTokenizer(object):
 class WordpieceTokenizer(object):
     """Runs WordPiece tokenization."""
 
-    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100):
+    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100, cache_size=WORDPIECE_CACHE_SIZE):
+        """Constructs a WordpieceTokenizer.
+
+        Args:
+          vocab: Dictionary from wordpiece to id.
+          unk_token: Token of the words that cannot be split into wordpieces.
+          max_input_chars_per_word: Longer words become `unk_token`.
+          cache_size: Number of words whose wordpieces are remembered, the least
+                         recently used ones are forgotten first. 0 disables the cache.
+        """
         self.vocab = vocab
         self.unk_token = unk_token  # UNK=unknown 处理不了的token将用[UNK]代替
         self.max_input_chars_per_word = max_input_chars_per_word
+        self.cache_size = cache_size
+        # 单词 -> wordpiece元组的LRU缓存，最近用过的在末尾；多个线程共用一个tokenizer时由锁保护
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_cache_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache_lock = threading.Lock()
+
+    def warm_cache(self):
+        """Fills the cache with the whole words of the vocabulary, each its own single wordpiece.
+
+        Returns:
+          The number of words added.
+        """
+        num_added = 0
+        with self._cache_lock:
+            for token in self.vocab:
+                if len(self._cache) >= self.cache_size:
+                    break
+                if token.startswith("##") or token in self._cache or len(token) > self.max_input_chars_per_word \
+                        or whitespace_tokenize(token) != [token]:
+                    continue
+                self._cache[token] = (token,)
+                num_added += 1
+        return num_added
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+            self.cache_hits = 0
+            self.cache_misses = 0
 
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
 
         This uses a greedy longest-match-first algorithm to perform tokenization
-        using the given vocabulary.
+        using the given vocabulary. The word pieces of the most recently seen words
+        are cached, so a repeated word costs a dictionary lookup.
 
         For example:
           input = "unaffable"
@@ -400,36 +619,48 @@ class WordpieceTokenizer(object):
 
         output_tokens = []
         for token in whitespace_tokenize(text):
-            chars = list(token)  # chars[]中每个元素都是text去掉空格以后分割成的token,text如果是一个英文单词，则每个元素是一个字母
-            if len(chars) > self.max_input_chars_per_word:
-                output_tokens.append(self.unk_token)
+            if self.cache_size <= 0:
+                output_tokens.extend(self._tokenize_word(token))
                 continue
+            with self._cache_lock:
+                sub_tokens = self._cache.get(token)
+                if sub_tokens is not None:
+                    self._cache.move_to_end(token)
+                    self.cache_hits += 1
+                else:
+                    self.cache_misses += 1
+            if sub_tokens is None:
+                sub_tokens = self._tokenize_word(token)
+                with self._cache_lock:
+                    self._cache[token] = sub_tokens
+                    if len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+            output_tokens.extend(sub_tokens)
+        return output_tokens
 
-            is_bad = False
-            start = 0
-            sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
-                    end -= 1
-                if cur_substr is None:
-                    is_bad = True
+    def _tokenize_word(self, token):
+        """Greedy longest-match-first wordpieces of a single word, as a tuple."""
+        if len(token) > self.max_input_chars_per_word:
+            return (self.unk_token,)
+
+        start = 0
+        sub_tokens = []
+        while start < len(token):
+            end = len(token)
+            cur_substr = None
+            while start < end:
+                substr = token[start:end]
+                if start > 0:
+                    substr = "##" + substr
+                if substr in self.vocab:
+                    cur_substr = substr
                     break
-                sub_tokens.append(cur_substr)
-                start = end
-
-            if is_bad:
-                output_tokens.append(self.unk_token)
-            else:
-                output_tokens.extend(sub_tokens)
-        return output_tokens
+                end -= 1
+            if cur_substr is None:
+                return (self.unk_token,)
+            sub_tokens.append(cur_substr)
+            start = end
+        return tuple(sub_tokens)
 
 
 # 检查字符是否是空格（\t, \n, 和 \r被视为空格）
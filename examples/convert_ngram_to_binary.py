@@ -0,0 +1,56 @@
+# encoding="utf-8"
+# Copyright 2019 Sinovation Ventures AI Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compile an ngram frequency file into the binary format loaded by ZenNgramDict."""
+
+import sys
+sys.path.append("..")
+
+from argparse import ArgumentParser
+from pathlib import Path
+
+from ZEN import BertTokenizer, NGRAM_BINARY_NAME, convert_ngram_file_to_binary
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--ngram_list", type=Path, default=Path("./ngram.txt"),
+                        help="The ngram frequency file, or a model directory containing ngram.txt")
+    parser.add_argument("--output", type=Path, default=None,
+                        help="Where to write the binary file. Defaults to ngram.bin next to the ngram file; "
+                             "ZenNgramDict picks it up from there in place of ngram.txt.")
+    parser.add_argument("--bert_model", type=str, default=None,
+                        help="Bert pre-trained model whose tokenizer is used to tokenize the ngrams. "
+                             "Not needed with --dna_ngrams.")
+    parser.add_argument("--do_lower_case", action="store_true")
+    parser.add_argument("--dna_ngrams", action="store_true",
+                        help="The ngrams are DNA k-mers; pack them into 2-bit integer codes.")
+    args = parser.parse_args()
+
+    if not args.dna_ngrams and args.bert_model is None:
+        parser.error("--bert_model is required unless --dna_ngrams is set")
+    tokenizer = None
+    if not args.dna_ngrams:
+        tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    output = args.output
+    if output is None:
+        ngram_dir = args.ngram_list if args.ngram_list.is_dir() else args.ngram_list.parent
+        output = ngram_dir / NGRAM_BINARY_NAME
+    num_ngrams = convert_ngram_file_to_binary(str(args.ngram_list), str(output), tokenizer,
+                                              dna=args.dna_ngrams)
+    print("Wrote {} ngrams to {}".format(num_ngrams, output))
+
+
+if __name__ == '__main__':
+    main()
@@ -21,13 +21,15 @@ from argparse import ArgumentParser
 from pathlib import Path
 from tqdm import tqdm, trange
 from tempfile import TemporaryDirectory
-import shelve
-
-from random import random, randrange, randint, shuffle, choice
+from multiprocessing import Pool
+from contextlib import ExitStack
+import random
+import hashlib
 from ZEN import BertTokenizer, ZenNgramDict
+from utils_pre_train import (JsonShardWriter, ColumnarShardWriter, PackingShardWriter, CorpusStore, CORPUS_BUFFER_BYTES,
+                             MaskingVocab, mask_token_ids, mask_token_id_batch, DYNAMIC_MASKING_NAME)
 import numpy as np
 import json
-import collections
 
 
 class DocumentDatabase():
@@ -52,22 +54,25 @@ class DocumentDatabase():
     docs=[doc1, doc2, doc3, doc4]
     doc_lengths=[1, 2, 1, 2] , 每个元素表示相应的document中有几个句子
     '''
-    def __init__(self, reduce_memory=False):
-        if reduce_memory:  # 当数据量较大时，为减少内存将数据写入硬盘（文件）中
-            self.temp_dir = TemporaryDirectory()  # 创建一个临时目录temp_dir
-            self.working_dir = Path(self.temp_dir.name)  # 用临时目录temp_dir创建一个Path对象working_dir
-            self.document_shelf_filepath = self.working_dir / 'shelf.db'  # 创建working_dir的子目录document_shelf_filepath
-            self.document_shelf = shelve.open(str(self.document_shelf_filepath),
-                                              flag='n', protocol=-1)
-            # 创建一个shelf对象document_shelf，document_shelf_filepath为对象将写入的文件路径，
-            # flag为n表示，每次调用open()都重新创建一个空的文件，可读写
-            # shelf对象用来存放document
+    def __init__(self, reduce_memory=False, vocab=None, corpus_dir=None, corpus_key=None,
+                 buffer_bytes=CORPUS_BUFFER_BYTES):
+        self.temp_dir = None
+        self.ingested = False  # corpus_dir中已有用相同语料和分词器建好的索引，无需重新读入
+        if reduce_memory or corpus_dir is not None:  # 当数据量较大时，为减少内存将数据写入硬盘（文件）中
+            if corpus_dir is None:
+                self.temp_dir = TemporaryDirectory()  # 创建一个临时目录temp_dir
+                corpus_dir = Path(self.temp_dir.name) / 'corpus'
+            # 所有document的token id依次存放在一个扁平数组中，另存句子和document的偏移量，读取时用memmap直接切片，
+            # 不再需要pickle；DNA词表每个碱基只占一个字节
+            self.document_store = CorpusStore.open_existing(corpus_dir, vocab, corpus_key)
+            self.ingested = self.document_store is not None
+            if self.document_store is None:
+                self.document_store = CorpusStore(corpus_dir, vocab, buffer_bytes, key=corpus_key)
             self.documents = None
+            reduce_memory = True
         else:  # 数据量较小时，直接写入内存
             self.documents = []  # 用来存放document
-            self.document_shelf = None
-            self.document_shelf_filepath = None
-            self.temp_dir = None
+            self.document_store = None
         self.doc_lengths = []  # 数组中每个元素对应于一个document的长度，数组元素个数就是document的个数
         self.doc_cumsum = None
         self.cumsum_max = None
@@ -76,45 +81,81 @@ class DocumentDatabase():
     def add_document(self, document):
         if not document:
             return
-        # 如果reduce_document是true，将document加到document_shelf中
+        # 如果reduce_document是true，将document加到document_store中，document的长度在open_for_reading时从中读出
         if self.reduce_memory:
-            current_idx = len(self.doc_lengths)
-            self.document_shelf[str(current_idx)] = document
+            self.document_store.add_document(document)
         # 如果reduce_document是false，将document加到documents中
         else:
             self.documents.append(document)
-        self.doc_lengths.append(len(document))
+            self.doc_lengths.append(len(document))
+        self.doc_cumsum = None
 
     def _precalculate_doc_weights(self):
+        # 读入结束后只计算一次，之后不再改变
         self.doc_cumsum = np.cumsum(self.doc_lengths)
+        self.doc_cumsum.flags.writeable = False
         self.cumsum_max = self.doc_cumsum[-1]
 
     # 随机选出一个document，选出的document序号不能是current_idx，即不能和当前的document重复
-    def sample_doc(self, current_idx, sentence_weighted=True):
+    def sample_doc(self, current_idx, sentence_weighted=True, rng=random):
         # Uses the current iteration counter to ensure we don't sample the same doc twice
         if sentence_weighted:
             # With sentence weighting, we sample docs proportionally to their sentence length
-            if self.doc_cumsum is None or len(self.doc_cumsum) != len(self.doc_lengths):
+            if self.doc_cumsum is None:
                 self._precalculate_doc_weights()
             rand_start = self.doc_cumsum[current_idx]  # 假设current_idx是5，rand_start表示第5个段落的最后一个句子在整篇文章中的index
             rand_end = rand_start + self.cumsum_max - self.doc_lengths[current_idx]
-            sentence_index = randrange(rand_start, rand_end) % self.cumsum_max  # 随机得到一个句子
+            sentence_index = rng.randrange(rand_start, rand_end) % self.cumsum_max  # 随机得到一个句子
             sampled_doc_index = np.searchsorted(self.doc_cumsum, sentence_index, side='right')  # 随机得到的句子在第几个doc中
         else:
             # If we don't use sentence weighting, then every doc has an equal chance to be chosen
-            sampled_doc_index = (current_idx + randrange(1, len(self.doc_lengths))) % len(self.doc_lengths)
+            sampled_doc_index = (current_idx + rng.randrange(1, len(self))) % len(self)
         assert sampled_doc_index != current_idx
-        if self.reduce_memory:
-            return self.document_shelf[str(sampled_doc_index)]
-        else:
-            return self.documents[sampled_doc_index]
+        return self[sampled_doc_index]
+
+    @classmethod
+    def from_corpus_store(cls, store):
+        """Reads the documents of a complete `CorpusStore`, such as one opened with `CorpusStore.open_existing`."""
+        docs = cls()
+        docs.documents = None
+        docs.document_store = store
+        docs.reduce_memory = True
+        docs.open_for_reading()
+        return docs
+
+    # 一次随机选出num_samples个document的序号（都不是current_idx），与sample_doc的分布相同
+    def sample_doc_indices(self, current_idx, num_samples, sentence_weighted=True, rng=random):
+        """Draws `num_samples` indices of documents other than `current_idx` in one vectorized call.
+
+        The documents are drawn as by `sample_doc`, from the cumulative sentence counts computed once reading is
+        done. A NumPy generator seeded from `rng` draws all of them, so `rng` advances by a single draw.
+        """
+        if self.doc_cumsum is None:
+            self._precalculate_doc_weights()
+        np_rng = np.random.default_rng(rng.getrandbits(64))
+        if sentence_weighted:
+            rand_start = self.doc_cumsum[current_idx]
+            rand_end = rand_start + self.cumsum_max - self.doc_lengths[current_idx]
+            sentence_indices = np_rng.integers(rand_start, rand_end, size=num_samples) % self.cumsum_max
+            return np.searchsorted(self.doc_cumsum, sentence_indices, side='right')
+        return (current_idx + np_rng.integers(1, len(self), size=num_samples)) % len(self)
+
+    def open_for_reading(self):
+        # 生成数据前调用：关闭正在写的文件并以只读方式memmap，这样每个子进程都可以各自读取
+        # Map the store read-only, so that the worker processes can read it concurrently
+        if self.document_store is not None:
+            self.document_store.open_for_reading()
+            self.doc_lengths = self.document_store.doc_lengths
+        self._precalculate_doc_weights()
 
     def __len__(self):
+        if self.reduce_memory:
+            return len(self.document_store)
         return len(self.doc_lengths)
 
     def __getitem__(self, item):
         if self.reduce_memory:
-            return self.document_shelf[str(item)]
+            return self.document_store[item]
         else:
             return self.documents[item]
 
@@ -122,13 +163,13 @@ class DocumentDatabase():
         return self
 
     def __exit__(self, exc_type, exc_val, traceback):
-        if self.document_shelf is not None:
-            self.document_shelf.close()
+        if self.document_store is not None:
+            self.document_store.close()
         if self.temp_dir is not None:
             self.temp_dir.cleanup()
 
 
-def truncate_seq_pair(tokens_a, tokens_b, max_num_tokens):
+def truncate_seq_pair(tokens_a, tokens_b, max_num_tokens, rng=random):
     """Truncates a pair of sequences to a maximum sequence length. Lifted from Google's BERT repo."""
     while True:
         total_length = len(tokens_a) + len(tokens_b)
@@ -141,95 +182,24 @@ def truncate_seq_pair(tokens_a, tokens_b, max_num_tokens):
 
         # We want to sometimes truncate from the front and sometimes from the
         # back to add more randomness and avoid biases.
-        if random() < 0.5:
+        if rng.random() < 0.5:
             del trunc_tokens[0]
         else:
             trunc_tokens.pop()
 
 
-MaskedLmInstance = collections.namedtuple("MaskedLmInstance",
-                                          ["index", "label"])
-
-
-def create_masked_lm_predictions(tokens, masked_lm_prob, max_predictions_per_seq, whole_word_mask, vocab_list):
-    """Creates the predictions for the masked LM objective. This is mostly copied from the Google BERT repo, but
-    with several refactors to clean it up and remove a lot of unnecessary variables."""
-    cand_indices = []
-    # 如果tokens = ["[CLS]", "This", "is", "[SEP]", "un", "##aff", "##able", "[SEP]"]
-    # cand_indices = [[1], [2], [4, 5, 6]]
-
-    for (i, token) in enumerate(tokens):
-        if token == "[CLS]" or token == "[SEP]":
-            continue
-        # Whole Word Masking means that if we mask all of the wordpieces
-        # corresponding to an original word. When a word has been split into
-        # WordPieces, the first token does not have any marker and any subsequence
-        # tokens are prefixed with ##. So whenever we see the ## token, we
-        # append it to the previous set of word indexes.
-        #
-        # Note that Whole Word Masking does *not* change the training code
-        # at all -- we still predict each WordPiece independently, softmaxed
-        # over the entire vocabulary.
-        if (whole_word_mask and len(cand_indices) >= 1 and token.startswith("##")):
-            cand_indices[-1].append(i)
-        else:
-            cand_indices.append([i])
-
-    num_to_mask = min(max_predictions_per_seq,
-                      max(1, int(round(len(tokens) * masked_lm_prob))))  # 要进行mask的token数目
-    shuffle(cand_indices)  # 对列表中的元素进行随机排序，因为是随机mask一些tokens
-    masked_lms = []
-    covered_indexes = set()
-    for index_set in cand_indices:
-        if len(masked_lms) >= num_to_mask:
-            break
-        # If adding a whole-word mask would exceed the maximum number of
-        # predictions, then just skip this candidate.
-        # 如果mask当前的whole word会使得被mask掉的tokens数目超过num_to_mask
-        # 则跳过当前的whole word
-        if len(masked_lms) + len(index_set) > num_to_mask:
-            continue
-
-        # 判断当前的whole word的index_set中是否有在covered_indexes中的
-        # 如果有则跳过当前的whole word
-        is_any_index_covered = False
-        for index in index_set:
-            if index in covered_indexes:
-                is_any_index_covered = True
-                break
-        if is_any_index_covered:
-            continue
-
-        # 如果没有，则把index_set中的每一个index加到covered_indexes中
-        for index in index_set:
-            covered_indexes.add(index)
-
-            masked_token = None
-            # 80% of the time, replace with [MASK]
-            # 80%的概率会把当前的token用[MASK]代替
-            if random() < 0.8:
-                masked_token = "[MASK]"
-            else:
-                # 10% of the time, keep original
-                # 10%的概率，当前的token不变
-                if random() < 0.5:
-                    masked_token = tokens[index]
-                # 10% of the time, replace with random word
-                # 10%的概率会用一个随机的word来代替当前的token
-                else:
-                    masked_token = choice(['a','c','t','g'])
-            # 将当前的token以(index, token)的形式加入到masked_lms中
-            # 为什么没有替换成[MASK]的token也会加入？
-            masked_lms.append(MaskedLmInstance(index=index, label=tokens[index]))
-            tokens[index] = masked_token
-
-    assert len(masked_lms) <= num_to_mask
-    masked_lms = sorted(masked_lms, key=lambda x: x.index)  # 将masked_lms中的token按照index排序
-    mask_indices = [p.index for p in masked_lms]
-    masked_token_labels = [p.label for p in masked_lms]
+def create_masked_lm_predictions(tokens, masked_lm_prob, max_predictions_per_seq, whole_word_mask, masking_vocab,
+                                 rng):
+    """Creates the predictions for the masked LM objective on a list of tokens, with `mask_token_ids`.
 
+    :param masking_vocab: the `MaskingVocab` of the vocabulary
+    :param rng: a np.random.Generator
+    :return: (masked tokens, masked positions in increasing order, original tokens at those positions)
+    """
+    masked_ids, positions, label_ids = mask_token_ids(masking_vocab.token_ids(tokens), masking_vocab, masked_lm_prob,
+                                                      max_predictions_per_seq, whole_word_mask, rng)
     # 返回已经被随机屏蔽了部分token的tokens序列，index序列和相应的原token序列
-    return tokens, mask_indices, masked_token_labels
+    return masking_vocab.tokens(masked_ids), positions.tolist(), masking_vocab.tokens(label_ids)
 
 
 # 把一个段落中的句子分为上下句
@@ -238,13 +208,15 @@ def create_masked_lm_predictions(tokens, masked_lm_prob, max_predictions_per_seq
 # 记录以上所有信息，作为一个实例
 # 一个seq代表的是一个实例的seq
 def create_instances_from_document(
-        doc_database, doc_idx, max_seq_length,max_ngram_in_seq, short_seq_prob,
-        masked_lm_prob, max_predictions_per_seq, whole_word_mask, vocab_list, ngram_dict):
+        doc_database, doc_idx, document, max_seq_length,max_ngram_in_seq, short_seq_prob,
+        masked_lm_prob, max_predictions_per_seq, whole_word_mask, masking_vocab, ngram_dict, rng=random):
     """This code is mostly a duplicate of the equivalent function from Google BERT's repo.
     However, we make some changes and improvements. Sampling is improved and no longer requires a loop in this function.
     Also, documents are sampled proportionally to the number of sentences they contain, which means each sentence
-    (rather than each document) has an equal chance of being sampled as a false example for the NextSentence task."""
-    document = doc_database[doc_idx]
+    (rather than each document) has an equal chance of being sampled as a false example for the NextSentence task.
+
+    `document` is doc_database[doc_idx], read once by the caller so that it can be used for every epoch; doc_idx
+    only keeps it from being drawn as the random next document. It is not modified."""
     # Account for [CLS], [SEP], [SEP]
     max_num_tokens = max_seq_length - 3
 
@@ -256,8 +228,8 @@ def create_instances_from_document(
     # The `target_seq_length` is just a rough target however, whereas
     # `max_seq_length` is a hard limit.
     target_seq_length = max_num_tokens
-    if random() < short_seq_prob:
-        target_seq_length = randint(2, max_num_tokens)  # 随机生成一个2到max_num_tokens之间的数
+    if rng.random() < short_seq_prob:
+        target_seq_length = rng.randint(2, max_num_tokens)  # 随机生成一个2到max_num_tokens之间的数
 
     # We DON'T just concatenate all of the tokens from a document into a long
     # sequence and choose an arbitrary split point because this would make the
@@ -265,6 +237,8 @@ def create_instances_from_document(
     # segments "A" and "B" based on the actual "sentences" provided by the user
     # input.
     instances = []
+    # 随机下句所用的document在第一次需要时一次性选出：每个实例至少用掉一个句子，所以最多需要len(document)个
+    random_doc_indices = None
     current_chunk = []  # 存放句子
     current_length = 0  # current_chunk中tokens的数量
     i = 0
@@ -281,7 +255,7 @@ def create_instances_from_document(
                 # (first) sentence.
                 a_end = 1
                 if len(current_chunk) >= 2:  # 如果当前句子个数大于等于2的话
-                    a_end = randrange(1, len(current_chunk))  # 返回1到当前句子个数之间的一个随机数
+                    a_end = rng.randrange(1, len(current_chunk))  # 返回1到当前句子个数之间的一个随机数
 
                 # tokens_a中存放了current_chunk的前a_end个句子中的tokens，作为next sentence任务的上句
                 tokens_a = []
@@ -293,15 +267,18 @@ def create_instances_from_document(
 
                 # 从另一个随机的document中选出随机的句子，将这些tokens加入tokens_b中
                 # Random next
-                if len(current_chunk) == 1 or random() < 0.5:
+                if len(current_chunk) == 1 or rng.random() < 0.5:
                     is_random_next = True
                     target_b_length = target_seq_length - len(tokens_a)
 
                     # Sample a random document, with longer docs being sampled more frequently
                     # 随机选出一个document，含有句子数量多的document被选中的几率更大
-                    random_document = doc_database.sample_doc(current_idx=doc_idx, sentence_weighted=True)
+                    if random_doc_indices is None:
+                        random_doc_indices = iter(doc_database.sample_doc_indices(
+                            current_idx=doc_idx, num_samples=len(document), sentence_weighted=True, rng=rng).tolist())
+                    random_document = doc_database[next(random_doc_indices)]
 
-                    random_start = randrange(0, len(random_document))
+                    random_start = rng.randrange(0, len(random_document))
                     for j in range(random_start, len(random_document)):
                         tokens_b.extend(random_document[j])
                         if len(tokens_b) >= target_b_length:
@@ -317,63 +294,276 @@ def create_instances_from_document(
                     is_random_next = False
                     for j in range(a_end, len(current_chunk)):
                         tokens_b.extend(current_chunk[j])
-                truncate_seq_pair(tokens_a, tokens_b, max_num_tokens)  # 将tokens_a和tokens_b截取，使得它们的总长度等于max_num_tokens
+                truncate_seq_pair(tokens_a, tokens_b, max_num_tokens, rng=rng)  # 将tokens_a和tokens_b截取，使得它们的总长度等于max_num_tokens
 
                 tokens = ["[CLS]"] + tokens_a + ["[SEP]"] + tokens_b + ["[SEP]"]
                 # The segment IDs are 0 for the [CLS] token, the A tokens and the first [SEP]
                 # They are 1 for the B tokens and the final [SEP]
                 segment_ids = [0 for _ in range(len(tokens_a) + 2)] + [1 for _ in range(len(tokens_b) + 1)]
-
-                # tokens: 随机屏蔽了num_to_mask个token后得到的tokens序列，这些tokens中有的被用[MASK]代替，有的保持原样，有的被替换成随机的word
-                # masked_lm_positions：这些tokens在原来的（未进行mask之前的）tokens序列中对应的index
-                # masked_lm_labels：这些tokens的原本对应的token（都未进行替换）
-                tokens, masked_lm_positions, masked_lm_labels = create_masked_lm_predictions(
-                    tokens, masked_lm_prob, max_predictions_per_seq, whole_word_mask, vocab_list)
-
-                ngram_matches = []
-                #  Filter the ngram segment from 2 to 7 to check whether there is a ngram
-                # 挑出当前句子中所有长度在2-7之间的ngram，把它的相关信息加入到ngram_matches中
-                for p in range(2, 8):
-                    for q in range(0, len(tokens) - p + 1):
-                        character_segment = tokens[q:q+p]
-                        # q is the starting position of the ngram
-                        # p is the length of the current ngram
-                        character_segment = tuple(character_segment)
-                        if character_segment in ngram_dict.ngram_to_id_dict:
-                            ngram_index = ngram_dict.ngram_to_id_dict[character_segment]
-                            ngram_matches.append([ngram_index, q, p, character_segment])
-                            # ngram_index：ngram在整个ngram_dict中的index
-                            # q：ngram在句子中的起始位置
-                            # p: ngram的长度
-                            # character_segment：ngram中的所有token（元组形式）
-                shuffle(ngram_matches)  # 将ngram_matches中的元素随机排序
-                if len(ngram_matches) > max_ngram_in_seq:
-                    ngram_matches = ngram_matches[:max_ngram_in_seq]
-                ngram_ids = [ngram[0] for ngram in ngram_matches]  # 每个ngram在整个ngram_dict中的index
-                ngram_positions = [ngram[1] for ngram in ngram_matches]  # 每个ngram在句子中的起始位置
-                ngram_lengths = [ngram[2] for ngram in ngram_matches]  # 每个ngram的长度
-                ngram_tuples = [ngram[3] for ngram in ngram_matches]  # 每个ngram中的所有token（元组形式）
-                # ngram的起始位置如果在上半句则ngram_seg_id为0，否则为1
-                ngram_seg_ids = [0 if position < (len(tokens_a) + 2) else 1 for position in ngram_positions]
-                instance = {
+                instances.append({
                     "tokens": tokens,
                     "segment_ids": segment_ids,
                     "is_random_next": is_random_next,
-                    "masked_lm_positions": masked_lm_positions,
-                    "masked_lm_labels": masked_lm_labels,
-                    "ngram_ids": ngram_ids,
-                    "ngram_positions": ngram_positions,
-                    "ngram_lengths": ngram_lengths,
-                    "ngram_tuples": ngram_tuples,
-                    "ngram_segment_ids": ngram_seg_ids
-                }
-                instances.append(instance)
+                    "num_tokens_a": len(tokens_a),
+                })
             current_chunk = []
             current_length = 0
         i += 1
-
+    if not instances:
+        return instances
+
+    # 一次mask这个document的所有实例
+    # tokens: 随机屏蔽了部分token后得到的tokens序列，这些tokens中有的被用[MASK]代替，有的保持原样，有的被替换成随机的word
+    # masked_lm_positions：这些tokens在原来的（未进行mask之前的）tokens序列中对应的index
+    # masked_lm_labels：这些tokens的原本对应的token（都未进行替换）
+    lengths = [len(instance["tokens"]) for instance in instances]
+    token_ids = np.zeros((len(instances), max(lengths)), dtype=np.int64)
+    for row, instance in enumerate(instances):
+        token_ids[row, :lengths[row]] = masking_vocab.token_ids(instance["tokens"])
+    masked_ids, label_ids = mask_token_id_batch(token_ids, lengths, masking_vocab, masked_lm_prob,
+                                                max_predictions_per_seq, whole_word_mask,
+                                                np.random.default_rng(rng.getrandbits(64)))
+
+    for row, instance in enumerate(instances):
+        tokens = masking_vocab.tokens(masked_ids[row, :lengths[row]])
+        masked_lm_positions = np.flatnonzero(label_ids[row] >= 0)
+        num_tokens_a = instance.pop("num_tokens_a")
+        ngram_matches = []
+        #  Find every ngram of the lexicon lengths in one pass of the compiled matcher
+        # 挑出当前句子中所有长度在ngram词表长度范围内的ngram，把它的相关信息加入到ngram_matches中
+        for ngram_index, q, p in zip(*ngram_dict.matcher.match(tokens)):
+            # ngram_index：ngram在整个ngram_dict中的index
+            # q：ngram在句子中的起始位置
+            # p: ngram的长度
+            # character_segment：ngram中的所有token（元组形式）
+            ngram_matches.append([ngram_index, q, p, tuple(tokens[q:q + p])])
+        rng.shuffle(ngram_matches)  # 将ngram_matches中的元素随机排序
+        if len(ngram_matches) > max_ngram_in_seq:
+            ngram_matches = ngram_matches[:max_ngram_in_seq]
+        ngram_positions = [ngram[1] for ngram in ngram_matches]  # 每个ngram在句子中的起始位置
+        instance.update({
+            "tokens": tokens,
+            "masked_lm_positions": masked_lm_positions.tolist(),
+            "masked_lm_labels": masking_vocab.tokens(label_ids[row, masked_lm_positions]),
+            "ngram_ids": [ngram[0] for ngram in ngram_matches],  # 每个ngram在整个ngram_dict中的index
+            "ngram_positions": ngram_positions,
+            "ngram_lengths": [ngram[2] for ngram in ngram_matches],  # 每个ngram的长度
+            "ngram_tuples": [ngram[3] for ngram in ngram_matches],  # 每个ngram中的所有token（元组形式）
+            # ngram的起始位置如果在上半句则ngram_seg_id为0，否则为1
+            "ngram_segment_ids": [0 if position < (num_tokens_a + 2) else 1 for position in ngram_positions],
+        })
     return instances
 
+# 每批读入并分词的文本量（字节），也是写入索引时token id缓冲区的大小
+INGEST_BATCH_BYTES = 16 << 20
+
+
+def line_batches(lines, batch_bytes=INGEST_BATCH_BYTES):
+    """Yields the stripped lines in lists of about `batch_bytes` of text."""
+    batch = []
+    batch_size = 0
+    for line in lines:
+        line = line.strip()
+        batch.append(line)
+        batch_size += len(line) + 1
+        if batch_size >= batch_bytes:
+            yield batch
+            batch = []
+            batch_size = 0
+    if batch:
+        yield batch
+
+
+def read_documents(lines, tokenizer, num_workers=1, batch_bytes=INGEST_BATCH_BYTES):
+    """Yields the documents of the corpus, each a list of tokenized lines; blank lines separate the documents.
+
+    The lines are tokenized `batch_bytes` of text at a time with `tokenizer.tokenize_batch`, in `num_workers`
+    processes.
+    """
+    doc = []
+    for batch in line_batches(lines, batch_bytes):
+        tokens = iter(tokenizer.tokenize_batch([text for text in batch if text], num_workers, use_processes=True))
+        for line in batch:
+            if line == "":
+                yield doc
+                doc = []
+            else:
+                doc.append(next(tokens))
+    if doc:
+        yield doc  # If the last doc didn't end on a newline, make sure it still gets added
+
+
+def ingest_corpus(lines, tokenizer, store, num_workers=1, batch_bytes=INGEST_BATCH_BYTES):
+    """Tokenizes the corpus into the `CorpusStore`, streaming: only `batch_bytes` of text are held at a time.
+
+    DNA reads go straight to ids through the lookup table of the tokenizer; other text is tokenized with
+    `tokenizer.tokenize_batch` in `num_workers` processes.
+    """
+    vocab = tokenizer.vocab
+    for batch in line_batches(lines, batch_bytes):
+        texts = [text for text in batch if text]
+        if tokenizer.dna:
+            sentence_ids = (tokenizer.convert_dna_to_ids(text) for text in texts)
+        else:
+            sentence_ids = ([vocab[token] for token in tokens]
+                            for tokens in tokenizer.tokenize_batch(texts, num_workers, use_processes=True))
+        for line in batch:
+            if line == "":
+                store.end_document()
+            else:
+                store.add_sentence_ids(next(sentence_ids))
+    store.end_document()  # If the last doc didn't end on a newline, make sure it still gets added
+
+
+def corpus_key(corpus_path, tokenizer):
+    """Identifies the corpus file and the tokenizer settings an indexed corpus was built from."""
+    sha = hashlib.sha1()
+    stat = corpus_path.stat()
+    sha.update(json.dumps([str(corpus_path.resolve()), stat.st_size, stat.st_mtime_ns, tokenizer.dna,
+                           getattr(getattr(tokenizer, "basic_tokenizer", None), "do_lower_case", None)]).encode())
+    sha.update("\n".join(tokenizer.vocab).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def open_data_writer(args, name, vocab):
+    """Opens the writer of one data file (or columnar shard directory) in the output directory."""
+    max_segments = args.max_segments_per_sequence if args.pack_sequences else None
+    if args.output_format == "columnar":
+        writer = ColumnarShardWriter(args.output_dir / name, vocab, args.max_seq_len, args.max_ngram_in_sequence,
+                                     max_segments)
+    else:
+        writer = JsonShardWriter(args.output_dir / f"{name}.json")
+    if args.pack_sequences:
+        # 把连续的几个实例拼成一条序列，减少padding
+        writer = PackingShardWriter(writer, args.max_seq_len, args.max_ngram_in_sequence, max_segments)
+    return writer
+
+
+def data_file_name(args, name):
+    return name if args.output_format == "columnar" else f"{name}.json"
+
+
+def write_instances(docs, doc_indices, epoch_writers, rngs, args, vocab_list, ngram_dict):
+    """Writes the instances of every epoch created from the documents `doc_indices`.
+
+    Each document is read once and used for all epochs: the instances of epoch i are drawn with `rngs[i]` and
+    added to `epoch_writers[i]`.
+    """
+    masking_vocab = MaskingVocab(vocab_list)
+    for doc_idx in doc_indices:
+        document = docs[doc_idx]  # 每个document只读取一次，用于所有epoch
+        for epoch, (epoch_writer, rng) in enumerate(zip(epoch_writers, rngs)):
+            doc_instances = create_instances_from_document(
+                docs, doc_idx, document, max_seq_length=args.max_seq_len, max_ngram_in_seq=args.max_ngram_in_sequence,
+                short_seq_prob=args.short_seq_prob,
+                masked_lm_prob=args.masked_lm_prob, max_predictions_per_seq=args.max_predictions_per_seq,
+                whole_word_mask=args.do_whole_word_mask, masking_vocab=masking_vocab, ngram_dict=ngram_dict,
+                rng=rng)
+            # 把每一个instance写入该epoch的文件
+            for instance in doc_instances:
+                epoch_writer.add(instance)
+
+
+# 估计每个epoch的实例数时抽样的document数
+ESTIMATE_SAMPLE_DOCS = 1000
+
+
+def estimate_num_instances(docs, args, vocab_list, ngram_dict, sample_size=ESTIMATE_SAMPLE_DOCS, seed=0):
+    """Estimates the number of instances of one epoch from those created from a random sample of the documents.
+
+    The count of the sample is scaled by the number of sentences, which the number of instances follows.
+    """
+    rng = random.Random(seed)
+    sample = rng.sample(range(len(docs)), min(sample_size, len(docs)))
+    masking_vocab = MaskingVocab(vocab_list)
+    num_instances = 0
+    for doc_idx in sample:
+        num_instances += len(create_instances_from_document(
+            docs, doc_idx, docs[doc_idx], max_seq_length=args.max_seq_len, max_ngram_in_seq=args.max_ngram_in_sequence,
+            short_seq_prob=args.short_seq_prob,
+            masked_lm_prob=args.masked_lm_prob, max_predictions_per_seq=args.max_predictions_per_seq,
+            whole_word_mask=args.do_whole_word_mask, masking_vocab=masking_vocab, ngram_dict=ngram_dict, rng=rng))
+    sample_sentences = int(np.sum(np.asarray(docs.doc_lengths)[sample]))
+    return int(num_instances * float(docs.cumsum_max) / max(sample_sentences, 1))
+
+
+def write_dynamic_masking_settings(args, docs, vocab_list, ngram_dict, key):
+    """Writes what run_pre_train.py needs to create the instances of every epoch itself."""
+    corpus_dir = args.corpus_dir.resolve()
+    output_dir = args.output_dir.resolve()
+    settings = {
+        # relative to the output directory when inside it, so that the directory can be moved
+        "corpus_dir": str(corpus_dir.relative_to(output_dir) if output_dir in corpus_dir.parents else corpus_dir),
+        "corpus_key": key,
+        "ngram_file": str(Path(ngram_dict.ngram_freq_path).resolve()),
+        "dna": args.dna_ngrams,
+        "max_seq_len": args.max_seq_len,
+        "max_ngram_in_sequence": args.max_ngram_in_sequence,
+        "short_seq_prob": args.short_seq_prob,
+        "masked_lm_prob": args.masked_lm_prob,
+        "max_predictions_per_seq": args.max_predictions_per_seq,
+        "do_whole_word_mask": args.do_whole_word_mask,
+        "num_training_examples": estimate_num_instances(docs, args, vocab_list, ngram_dict),
+    }
+    with (args.output_dir / DYNAMIC_MASKING_NAME).open('w') as settings_file:
+        settings_file.write(json.dumps(settings))
+
+
+def shard_seed(seed, epoch, shard):
+    """The seed of one shard of one epoch, derived from the global seed."""
+    return int(np.random.SeedSequence([seed, epoch, shard]).generate_state(1)[0])
+
+
+def epoch_rngs(seed, num_epochs, shard=0):
+    # 每个epoch使用独立的随机数生成器，所以一次遍历documents就能生成所有epoch的实例
+    if seed is None:
+        return [random.Random() for _ in range(num_epochs)]
+    return [random.Random(shard_seed(seed, epoch, shard)) for epoch in range(num_epochs)]
+
+
+# 子进程中用到的数据，由_init_worker在每个子进程启动时设置
+_worker_context = {}
+
+
+def _init_worker(docs, args, vocab, ngram_dict):
+    _worker_context.update(docs=docs, args=args, vocab=vocab, ngram_dict=ngram_dict)
+    if docs.reduce_memory:
+        docs.open_for_reading()
+
+
+def _write_shard(task):
+    # 每个分片每个epoch的随机数种子只由全局种子、epoch和分片序号决定，所以输出与进程调度无关
+    shard, doc_start, doc_end = task
+    context = _worker_context
+    args = context["args"]
+    with ExitStack() as stack:
+        shard_writers = [stack.enter_context(open_data_writer(args, f"epoch_{epoch}_shard_{shard}", context["vocab"]))
+                         for epoch in range(args.epochs_to_generate)]
+        write_instances(context["docs"], range(doc_start, doc_end), shard_writers,
+                        epoch_rngs(args.seed, args.epochs_to_generate, shard), args,
+                        list(context["vocab"].keys()), context["ngram_dict"])
+    # 写入的样本数在关闭writer之后才确定（打包时最后一条序列在关闭时写入）
+    return shard, [shard_writer.num_examples for shard_writer in shard_writers]
+
+
+def write_metrics(args, epoch, num_instances, data_files=None):
+    metrics_file = args.output_dir / f"epoch_{epoch}_metrics.json"
+    with metrics_file.open('w') as metrics_file:
+        metrics = {
+            "num_training_examples": num_instances,  # 实例数目
+            "max_seq_len": args.max_seq_len,  # 一个实例中最多有多少token
+            "max_ngram_in_sequence": args.max_ngram_in_sequence,  # 一个实例中最多有多少个ngram
+            "data_format": args.output_format
+        }
+        if args.pack_sequences:
+            # 每条序列最多拼接多少个实例
+            metrics["max_segments_per_sequence"] = args.max_segments_per_sequence
+        if data_files is not None:
+            # 多进程生成时，该epoch的实例按顺序分布在这些分片中
+            metrics["data_files"] = data_files
+        metrics_file.write(json.dumps(metrics))
+
+
 def main():
     parser = ArgumentParser()
     parser.add_argument('--train_corpus', type=Path, required=True)
@@ -386,6 +576,13 @@ def main():
                         help="Whether to use whole word masking rather than per-WordPiece masking.")
     parser.add_argument("--reduce_memory", action="store_true",
                         help="Reduce memory usage for large datasets by keeping data on disc rather than in memory")
+    parser.add_argument("--corpus_dir", type=Path, default=None,
+                        help="Directory of the indexed corpus (implies --reduce_memory). It is kept after the run and "
+                             "reused, without reading the corpus again, while the corpus file and tokenizer are the "
+                             "same.")
+    parser.add_argument("--ingest_buffer_mb", type=int, default=16,
+                        help="Megabytes of text read and tokenized at a time, and of token ids buffered before they "
+                             "are written to the indexed corpus. Bounds the memory used to read the corpus.")
 
     parser.add_argument("--epochs_to_generate", type=int, default=3,
                         help="Number of epochs of data to pregenerate")
@@ -398,26 +595,59 @@ def main():
                         help="Maximum number of tokens to mask in each sequence")
     parser.add_argument("--ngram_list", type=str, default="/data/zhwiki/ngram.txt")
     parser.add_argument("--max_ngram_in_sequence", type=int, default=20)
+    parser.add_argument("--dna_ngrams", action="store_true",
+                        help="The corpus and ngram list are DNA: tokenize the reads base by base with a lookup table, and "
+                             "pack the k-mers into 2-bit codes matched with a rolling hash")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="Number of processes tokenizing the corpus and generating the instances. With more than one, "
+                             "the documents are split into one shard per worker and every shard is written to its own "
+                             "file.")
+    parser.add_argument("--output_format", choices=["columnar", "json"], default="columnar",
+                        help="columnar: one directory per epoch (or shard) with a fixed-width binary file per field, "
+                             "memory mapped by run_pre_train.py without parsing; json: one json instance per line.")
+    parser.add_argument("--pack_sequences", action="store_true",
+                        help="Pack consecutive short instances into one sequence of at most max_seq_len tokens and "
+                             "max_ngram_in_sequence ngrams. The boundaries of the instances are kept, so that "
+                             "run_pre_train.py can stop them from attending to each other.")
+    parser.add_argument("--max_segments_per_sequence", type=int, default=8,
+                        help="Maximum number of instances packed into one sequence with --pack_sequences")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Random seed. The output is deterministic for a given seed and number of workers.")
+    parser.add_argument("--dynamic_masking", action="store_true",
+                        help="Do not pregenerate epochs: only index the corpus (in --corpus_dir, by default "
+                             "output_dir/corpus) and write the instance settings, so that run_pre_train.py creates "
+                             "the instances while training, with fresh masks and random next sentences every epoch.")
 
     args = parser.parse_args()
 
-    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)  # 一个分词器
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case,
+                                              dna=args.dna_ngrams)  # 一个分词器
     vocab_list = list(tokenizer.vocab.keys())  # 列表中每个元素都是一个分词器分好的token
-    ngram_dict = ZenNgramDict("./ngram.txt", tokenizer=tokenizer)  # 参数为什么是bert_model？
-
-    with DocumentDatabase(reduce_memory=args.reduce_memory) as docs:
-        with args.train_corpus.open(encoding='utf-8') as f:
-            doc = []
-            for line in tqdm(f, desc="Loading Dataset", unit=" lines"):
-                line = line.strip()
-                if line == "":
-                    docs.add_document(doc)
-                    doc = []
+    ngram_dict = ZenNgramDict("./ngram.txt", tokenizer=tokenizer, dna=args.dna_ngrams)  # 参数为什么是bert_model？
+
+    if args.dynamic_masking:
+        if args.pack_sequences:
+            parser.error("--pack_sequences cannot be used with --dynamic_masking")
+        if args.corpus_dir is None:
+            args.corpus_dir = args.output_dir / "corpus"
+    # 第一步：把语料流式读入一个紧凑的索引（--reduce_memory或--corpus_dir时），第二步：从索引生成实例
+    key = corpus_key(args.train_corpus, tokenizer) if args.corpus_dir is not None else None
+    batch_bytes = args.ingest_buffer_mb << 20
+    with DocumentDatabase(reduce_memory=args.reduce_memory, vocab=tokenizer.vocab, corpus_dir=args.corpus_dir,
+                          corpus_key=key, buffer_bytes=batch_bytes) as docs:
+        if docs.ingested:
+            print(f"Reusing the corpus indexed in {args.corpus_dir}")
+        else:
+            with args.train_corpus.open(encoding='utf-8') as f:
+                lines = tqdm(f, desc="Loading Dataset", unit=" lines")
+                # DNA reads are tokenized by a lookup table, faster than sending them to other processes
+                num_workers = 1 if args.dna_ngrams else args.num_workers
+                if docs.reduce_memory:
+                    ingest_corpus(lines, tokenizer, docs.document_store, num_workers, batch_bytes)
                 else:
-                    tokens = tokenizer.tokenize(line)
-                    doc.append(tokens)
-            if doc:
-                docs.add_document(doc)  # If the last doc didn't end on a newline, make sure it still gets added
+                    for doc in read_documents(lines, tokenizer, num_workers, batch_bytes):
+                        docs.add_document(doc)
+        docs.open_for_reading()
         if len(docs) <= 1:
             exit("ERROR: No document breaks were found in the input file! These are necessary to allow the script to "
                  "ensure that random NextSentences are not sampled from the same document. Please add blank lines to "
@@ -426,30 +656,40 @@ def main():
                  "sections or paragraphs.")
 
         args.output_dir.mkdir(exist_ok=True)
+        if args.dynamic_masking:
+            # 不预先生成实例，由run_pre_train.py在训练时从索引生成，每个epoch的mask和随机下句都不同
+            write_dynamic_masking_settings(args, docs, vocab_list, ngram_dict, key)
+            return
+        if args.num_workers > 1:
+            if args.seed is None:
+                args.seed = random.randrange(2 ** 32)
+                print(f"Using random seed {args.seed}")
+            # 把documents按顺序切成num_workers个分片，每个分片是一个任务，生成所有epoch的实例
+            shard_bounds = np.linspace(0, len(docs), args.num_workers + 1).astype(int).tolist()
+            tasks = [(shard, shard_bounds[shard], shard_bounds[shard + 1]) for shard in range(args.num_workers)]
+            num_instances = np.zeros((args.epochs_to_generate, args.num_workers), dtype=np.int64)
+            with Pool(args.num_workers, initializer=_init_worker,
+                      initargs=(docs, args, tokenizer.vocab, ngram_dict)) as pool:
+                for shard, shard_instances in tqdm(pool.imap_unordered(_write_shard, tasks),
+                                                   total=len(tasks), desc="Shard"):
+                    num_instances[:, shard] = shard_instances
+            for epoch in range(args.epochs_to_generate):
+                write_metrics(args, epoch, int(num_instances[epoch].sum()),
+                              data_files=[data_file_name(args, f"epoch_{epoch}_shard_{shard}")
+                                          for shard in range(args.num_workers)])
+            return
+
         # 因为create_instances_from_document方法中具有随机性，每个epoch会产生不同的训练实例，用于多次训练
-        for epoch in trange(args.epochs_to_generate, desc="Epoch"):  # trange用法同range，只是输出的时候会打印进度条
-            epoch_filename = args.output_dir / f"epoch_{epoch}.json"  # 以f开头表示在字符串内支持大括号内的python表达式
-            num_instances = 0
-            with epoch_filename.open('w') as epoch_file:
-                for doc_idx in trange(len(docs), desc="Document"):  # 遍历docs中的每一个document
-                    doc_instances = create_instances_from_document(
-                        docs, doc_idx, max_seq_length=args.max_seq_len, max_ngram_in_seq=args.max_ngram_in_sequence,
-                        short_seq_prob=args.short_seq_prob,
-                        masked_lm_prob=args.masked_lm_prob, max_predictions_per_seq=args.max_predictions_per_seq,
-                        whole_word_mask=args.do_whole_word_mask, vocab_list=vocab_list, ngram_dict=ngram_dict)
-                    doc_instances = [json.dumps(instance) for instance in doc_instances]  # json.dumps将字典转成字符串
-                    # 把每一个instance信息字符串作为一行写入epoch_file
-                    for instance in doc_instances:
-                        epoch_file.write(instance + '\n')
-                        num_instances += 1
-            metrics_file = args.output_dir / f"epoch_{epoch}_metrics.json"
-            with metrics_file.open('w') as metrics_file:
-                metrics = {
-                    "num_training_examples": num_instances,  # 实例数目
-                    "max_seq_len": args.max_seq_len,  # 一个实例中最多有多少token
-                    "max_ngram_in_sequence": args.max_ngram_in_sequence  # 一个实例中最多有多少个ngram
-                }
-                metrics_file.write(json.dumps(metrics))
+        # 只遍历一次documents，同时写所有epoch的文件
+        with ExitStack() as stack:
+            # 以f开头表示在字符串内支持大括号内的python表达式
+            epoch_writers = [stack.enter_context(open_data_writer(args, f"epoch_{epoch}", tokenizer.vocab))
+                             for epoch in range(args.epochs_to_generate)]
+            # 遍历docs中的每一个document
+            write_instances(docs, trange(len(docs), desc="Document"), epoch_writers,
+                            epoch_rngs(args.seed, args.epochs_to_generate), args, vocab_list, ngram_dict)
+        for epoch, epoch_writer in enumerate(epoch_writers):
+            write_metrics(args, epoch, epoch_writer.num_examples)
 
 
 if __name__ == '__main__':
@@ -27,25 +27,32 @@ from collections import namedtuple
 import time
 import datetime
 
-from torch.utils.data import DataLoader, Dataset, RandomSampler
+from torch.utils.data import DataLoader, Dataset, IterableDataset, RandomSampler, get_worker_info
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 
 from ZEN import WEIGHTS_NAME, CONFIG_NAME
-from ZEN import ZenConfig, ZenForPreTraining
-from ZEN import BertTokenizer
+from ZEN import ZenConfig, ZenForPreTraining, build_ngram_position_matrix
+from ZEN import BertTokenizer, ZenNgramDict
 from ZEN import BertAdam, WarmupLinearSchedule
+from utils_pre_train import open_columnar_shard, ShardedColumn, CorpusStore, MaskingVocab, DYNAMIC_MASKING_NAME
+from create_pre_train_data import DocumentDatabase, create_instances_from_document
 
 InputFeatures = namedtuple(
     "InputFeatures",
-    "input_ids input_mask segment_ids lm_label_ids is_next ngram_ids ngram_masks ngram_positions ngram_starts "
-    "ngram_lengths ngram_segment_ids")
+    "input_ids input_mask segment_ids lm_label_ids is_next ngram_ids ngram_masks ngram_starts "
+    "ngram_lengths ngram_segment_ids segment_starts segment_lengths")
+
+# the fields of an example, in the order of the tensors of a batch; packed examples also have PACKED_FIELDS
+EXAMPLE_FIELDS = ("input_ids", "input_masks", "segment_ids", "lm_label_ids", "is_nexts", "ngram_ids", "ngram_masks",
+                  "ngram_starts", "ngram_lengths", "ngram_segment_ids")
+PACKED_FIELDS = ("segment_starts", "segment_lengths")
 
 log_format = '%(asctime)-10s: %(message)s'
 logging.basicConfig(level=logging.INFO, format=log_format)
 
 
-def convert_example_to_features(example, tokenizer, max_seq_length, max_ngram_in_sequence):
+def convert_example_to_features(example, tokenizer, max_seq_length, max_ngram_in_sequence, max_segments=None):
     tokens = example["tokens"]
     segment_ids = example["segment_ids"]
     is_random_next = example["is_random_next"]
@@ -63,30 +70,26 @@ def convert_example_to_features(example, tokenizer, max_seq_length, max_ngram_in
     # print(input_ids)
     masked_label_ids = tokenizer.convert_tokens_to_ids(masked_lm_labels)
 
-    input_array = np.zeros(max_seq_length, dtype=np.int)
+    input_array = np.zeros(max_seq_length, dtype=np.int64)
     input_array[:len(input_ids)] = input_ids
 
-    mask_array = np.zeros(max_seq_length, dtype=np.bool)
+    mask_array = np.zeros(max_seq_length, dtype=bool)
     mask_array[:len(input_ids)] = 1
 
-    segment_array = np.zeros(max_seq_length, dtype=np.bool)
+    segment_array = np.zeros(max_seq_length, dtype=bool)
     segment_array[:len(segment_ids)] = segment_ids
 
-    lm_label_array = np.full(max_seq_length, dtype=np.int, fill_value=-1)
+    lm_label_array = np.full(max_seq_length, dtype=np.int64, fill_value=-1)
     lm_label_array[masked_lm_positions] = masked_label_ids
 
     # add ngram pads
-    ngram_id_array = np.zeros(max_ngram_in_sequence, dtype=np.int)
+    ngram_id_array = np.zeros(max_ngram_in_sequence, dtype=np.int64)
     ngram_id_array[:len(ngram_ids)] = ngram_ids
 
     # record the masked positions
 
-    # The matrix here take too much space either in disk or in memory, so the usage have to be lazily convert the
-    # the start position and length to the matrix at training time.
-
-    ngram_positions_matrix = np.zeros(shape=(max_seq_length, max_ngram_in_sequence), dtype=np.bool)
-    for i in range(len(ngram_ids)):
-        ngram_positions_matrix[ngram_positions[i]:ngram_positions[i]+ngram_lengths[i], i] = 1
+    # The position matrix would take too much space either in disk or in memory, so only the start position and
+    # length are kept here, and the matrix of a batch is built from them on the device at training time.
 
     ngram_start_array = np.zeros(max_ngram_in_sequence, dtype=np.int32)
     ngram_start_array[:len(ngram_ids)] = ngram_positions
@@ -94,11 +97,22 @@ def convert_example_to_features(example, tokenizer, max_seq_length, max_ngram_in
     ngram_length_array = np.zeros(max_ngram_in_sequence, dtype=np.int32)
     ngram_length_array[:len(ngram_ids)] = ngram_lengths
 
-    ngram_mask_array = np.zeros(max_ngram_in_sequence, dtype=np.bool)
+    ngram_mask_array = np.zeros(max_ngram_in_sequence, dtype=bool)
     ngram_mask_array[:len(ngram_ids)] = 1
 
-    ngram_segment_array = np.zeros(max_ngram_in_sequence, dtype=np.bool)
+    ngram_segment_array = np.zeros(max_ngram_in_sequence, dtype=bool)
     ngram_segment_array[:len(ngram_ids)] = ngram_segment_ids
+
+    # packed examples hold several instances, each with its own is_next label
+    segment_start_array = segment_length_array = None
+    if max_segments is not None:
+        num_segments = len(example["segment_starts"])
+        is_random_next = np.zeros(max_segments, dtype=bool)
+        is_random_next[:num_segments] = example["is_random_next"]
+        segment_start_array = np.zeros(max_segments, dtype=np.int32)
+        segment_start_array[:num_segments] = example["segment_starts"]
+        segment_length_array = np.zeros(max_segments, dtype=np.int32)
+        segment_length_array[:num_segments] = example["segment_lengths"]
     features = InputFeatures(input_ids=input_array,
                              input_mask=mask_array,
                              segment_ids=segment_array,
@@ -106,29 +120,101 @@ def convert_example_to_features(example, tokenizer, max_seq_length, max_ngram_in
                              is_next=is_random_next,
                              ngram_ids=ngram_id_array,
                              ngram_masks=ngram_mask_array,
-                             ngram_positions=ngram_positions_matrix,
                              ngram_starts=ngram_start_array,
                              ngram_lengths=ngram_length_array,
-                             ngram_segment_ids=ngram_segment_array)
+                             ngram_segment_ids=ngram_segment_array,
+                             segment_starts=segment_start_array,
+                             segment_lengths=segment_length_array)
     return features
 
 
+def feature_row(features):
+    """Field name -> array of one example converted by convert_example_to_features."""
+    return {"input_ids": features.input_ids, "input_masks": features.input_mask, "segment_ids": features.segment_ids,
+            "lm_label_ids": features.lm_label_ids, "is_nexts": features.is_next, "ngram_ids": features.ngram_ids,
+            "ngram_masks": features.ngram_masks, "ngram_starts": features.ngram_starts,
+            "ngram_lengths": features.ngram_lengths, "ngram_segment_ids": features.ngram_segment_ids,
+            "segment_starts": features.segment_starts, "segment_lengths": features.segment_lengths}
+
+
+def example_tensors(row, packed):
+    """The tensors of one example, from its row of every field."""
+    # the ngram position matrix is not stored, it is built for the whole batch from ngram_starts and
+    # ngram_lengths by build_ngram_position_matrix on the training device
+    is_next = np.asarray(row["is_nexts"]).astype(np.int64)
+    if packed:
+        # padding segments are ignored by the next sentence loss
+        is_next[np.asarray(row["segment_lengths"]) == 0] = -1
+    fields = EXAMPLE_FIELDS + PACKED_FIELDS if packed else EXAMPLE_FIELDS
+    return tuple(torch.tensor(is_next) if name == "is_nexts" else torch.tensor(np.asarray(row[name]).astype(np.int64))
+                 for name in fields)
+
+
+def shuffle_buffered(examples, buffer_size, rng):
+    """Yields the examples in an order shuffled within a buffer of `buffer_size` examples.
+
+    :param rng: a np.random.Generator
+    """
+    buffer = []
+    for example in examples:
+        if len(buffer) < buffer_size:
+            buffer.append(example)
+            continue
+        # yield a random example of the buffer and put the new one in its place
+        i = rng.integers(len(buffer))
+        buffer[i], example = example, buffer[i]
+        yield example
+    for i in rng.permutation(len(buffer)):
+        yield buffer[i]
+
+
+def epoch_data_files(training_path, epoch, metrics):
+    # create_pre_train_data.py --num_workers writes an epoch as several shards, listed in its metrics
+    default_name = f"epoch_{epoch}" if metrics.get("data_format") == "columnar" else f"epoch_{epoch}.json"
+    return [training_path / name for name in metrics.get("data_files", [default_name])]
+
+
+def read_epoch_lines(data_files):
+    for data_file in data_files:
+        with data_file.open() as f:
+            for line in f:
+                yield line
+
+
 class PregeneratedDataset(Dataset):
     def __init__(self, training_path, epoch, tokenizer, num_data_epochs, reduce_memory=False, fp16=False):
         self.vocab = tokenizer.vocab
         self.tokenizer = tokenizer
         self.epoch = epoch
         self.data_epoch = epoch % num_data_epochs
-        data_file = training_path / f"epoch_{self.data_epoch}.json"
         metrics_file = training_path / f"epoch_{self.data_epoch}_metrics.json"
-        assert data_file.is_file() and metrics_file.is_file()
+        assert metrics_file.is_file()
         metrics = json.loads(metrics_file.read_text())
+        data_files = epoch_data_files(training_path, self.data_epoch, metrics)
+        assert all(data_file.exists() for data_file in data_files)
         num_samples = metrics['num_training_examples']
         seq_len = metrics['max_seq_len']
         max_ngram_in_sequence = metrics['max_ngram_in_sequence']
+        self.fp16 = fp16
+        self.num_samples = num_samples
+        self.seq_len = seq_len
+        self.columnar = metrics.get("data_format") == "columnar"
+        self.max_ngram_in_sequence = max_ngram_in_sequence
+        # set when create_pre_train_data.py --pack_sequences packed several instances into each example
+        max_segments = metrics.get("max_segments_per_sequence")
+        self.packed = max_segments is not None
+        is_next_shape = (num_samples,) if max_segments is None else (num_samples, max_segments)
+        if self.columnar:
+            # the shards are already in the layout of the arrays below, so they are only mapped, never parsed
+            logging.info(f"Mapping training examples for epoch {epoch}")
+            shards = [open_columnar_shard(data_file)[1] for data_file in data_files]
+            for name in shards[0]:
+                column = ShardedColumn([shard[name] for shard in shards])
+                setattr(self, name, column.arrays[0] if len(shards) == 1 else column)
+            assert sum(len(shard["input_ids"]) for shard in shards) == num_samples
+            return
         self.temp_dir = None
         self.working_dir = None
-        self.fp16 = fp16
         if reduce_memory:
             self.temp_dir = "/tmp"
             # TemporaryDirectory()
@@ -136,23 +222,20 @@ class PregeneratedDataset(Dataset):
             input_ids = np.memmap(filename=self.working_dir / 'input_ids.memmap',
                                   mode='w+', dtype=np.int32, shape=(num_samples, seq_len))
             input_masks = np.memmap(filename=self.working_dir / 'input_masks.memmap',
-                                    shape=(num_samples, seq_len), mode='w+', dtype=np.bool)
+                                    shape=(num_samples, seq_len), mode='w+', dtype=bool)
             segment_ids = np.memmap(filename=self.working_dir / 'segment_ids.memmap',
-                                    shape=(num_samples, seq_len), mode='w+', dtype=np.bool)
+                                    shape=(num_samples, seq_len), mode='w+', dtype=bool)
             lm_label_ids = np.memmap(filename=self.working_dir / 'lm_label_ids.memmap',
                                      shape=(num_samples, seq_len), mode='w+', dtype=np.int32)
             lm_label_ids[:] = -1
             is_nexts = np.memmap(filename=self.working_dir / 'is_nexts.memmap',
-                                 shape=(num_samples,), mode='w+', dtype=np.bool)
+                                 shape=is_next_shape, mode='w+', dtype=bool)
             # add ngram level features
             ngram_ids = np.memmap(filename=self.working_dir / 'ngram_ids.memmap',
                                  mode='w+', dtype=np.int32, shape=(num_samples, max_ngram_in_sequence))
 
             ngram_masks = np.memmap(filename=self.working_dir / 'ngram_masks.memmap',
-                                   mode='w+', dtype=np.bool, shape=(num_samples, max_ngram_in_sequence))
-
-            ngram_positions = np.memmap(filename=self.working_dir / 'ngram_positions.memmap',
-                                      mode='w+', dtype=np.bool, shape=(num_samples, seq_len, max_ngram_in_sequence))
+                                   mode='w+', dtype=bool, shape=(num_samples, max_ngram_in_sequence))
 
             ngram_starts = np.memmap(filename=self.working_dir / 'ngram_starts.memmap',
                                     mode='w+', dtype=np.int32, shape=(num_samples, max_ngram_in_sequence))
@@ -161,48 +244,55 @@ class PregeneratedDataset(Dataset):
                                      mode='w+', dtype=np.int32, shape=(num_samples, max_ngram_in_sequence))
 
             ngram_segment_ids = np.memmap(filename=self.working_dir / 'ngram_segment_ids.memmap',
-                                         mode='w+', dtype=np.bool, shape=(num_samples, max_ngram_in_sequence))
+                                         mode='w+', dtype=bool, shape=(num_samples, max_ngram_in_sequence))
+            if self.packed:
+                segment_starts = np.memmap(filename=self.working_dir / 'segment_starts.memmap',
+                                           mode='w+', dtype=np.int32, shape=(num_samples, max_segments))
+                segment_lengths = np.memmap(filename=self.working_dir / 'segment_lengths.memmap',
+                                            mode='w+', dtype=np.int32, shape=(num_samples, max_segments))
 
         else:
             input_ids = np.zeros(shape=(num_samples, seq_len), dtype=np.int32)
-            input_masks = np.zeros(shape=(num_samples, seq_len), dtype=np.bool)
-            segment_ids = np.zeros(shape=(num_samples, seq_len), dtype=np.bool)
+            input_masks = np.zeros(shape=(num_samples, seq_len), dtype=bool)
+            segment_ids = np.zeros(shape=(num_samples, seq_len), dtype=bool)
             lm_label_ids = np.full(shape=(num_samples, seq_len), dtype=np.int32, fill_value=-1)
-            is_nexts = np.zeros(shape=(num_samples,), dtype=np.bool)
+            is_nexts = np.zeros(shape=is_next_shape, dtype=bool)
             # add ngram level features
 
             ngram_ids = np.zeros(shape=(num_samples, max_ngram_in_sequence), dtype=np.int32)
-            ngram_masks = np.zeros(shape=(num_samples, max_ngram_in_sequence), dtype=np.bool)
+            ngram_masks = np.zeros(shape=(num_samples, max_ngram_in_sequence), dtype=bool)
 
-            ngram_positions = np.zeros(shape=(num_samples, seq_len, max_ngram_in_sequence), dtype=np.bool)
             ngram_starts = np.zeros(shape=(num_samples, max_ngram_in_sequence), dtype=np.int32)
             ngram_lengths = np.zeros(shape=(num_samples, max_ngram_in_sequence), dtype=np.int32)
 
-            ngram_segment_ids = np.zeros(shape=(num_samples, max_ngram_in_sequence), dtype=np.bool)
+            ngram_segment_ids = np.zeros(shape=(num_samples, max_ngram_in_sequence), dtype=bool)
+            if self.packed:
+                segment_starts = np.zeros(shape=(num_samples, max_segments), dtype=np.int32)
+                segment_lengths = np.zeros(shape=(num_samples, max_segments), dtype=np.int32)
 
         logging.info(f"Loading training examples for epoch {epoch}")
-        with data_file.open() as f:
-            for i, line in enumerate(tqdm(f, total=num_samples, desc="Training examples")):
-                line = line.strip()
-                example = json.loads(line)
-                features = convert_example_to_features(example, tokenizer, seq_len, max_ngram_in_sequence)
-                input_ids[i] = features.input_ids
-                segment_ids[i] = features.segment_ids
-                input_masks[i] = features.input_mask
-                lm_label_ids[i] = features.lm_label_ids
-                is_nexts[i] = features.is_next
-                # add ngram related ids
-                ngram_ids[i] = features.ngram_ids
-                ngram_masks[i] = features.ngram_masks
-                ngram_positions[i] = features.ngram_positions
-                ngram_starts[i] = features.ngram_starts
-                ngram_lengths[i] = features.ngram_lengths
-                ngram_segment_ids[i] = features.ngram_segment_ids
+        for i, line in enumerate(tqdm(read_epoch_lines(data_files), total=num_samples, desc="Training examples")):
+            line = line.strip()
+            example = json.loads(line)
+            features = convert_example_to_features(example, tokenizer, seq_len, max_ngram_in_sequence,
+                                                   max_segments)
+            input_ids[i] = features.input_ids
+            segment_ids[i] = features.segment_ids
+            input_masks[i] = features.input_mask
+            lm_label_ids[i] = features.lm_label_ids
+            is_nexts[i] = features.is_next
+            # add ngram related ids
+            ngram_ids[i] = features.ngram_ids
+            ngram_masks[i] = features.ngram_masks
+            ngram_starts[i] = features.ngram_starts
+            ngram_lengths[i] = features.ngram_lengths
+            ngram_segment_ids[i] = features.ngram_segment_ids
+            if self.packed:
+                segment_starts[i] = features.segment_starts
+                segment_lengths[i] = features.segment_lengths
 
         assert i == num_samples - 1  # Assert that the sample count metric was true
         logging.info("Loading complete!")
-        self.num_samples = num_samples
-        self.seq_len = seq_len
         self.input_ids = input_ids
         self.input_masks = input_masks
         self.segment_ids = segment_ids
@@ -210,33 +300,157 @@ class PregeneratedDataset(Dataset):
         self.is_nexts = is_nexts
         self.ngram_ids = ngram_ids
         self.ngram_masks = ngram_masks
-        self.ngram_positions = ngram_positions
         self.ngram_segment_ids = ngram_segment_ids
         self.ngram_starts = ngram_starts
         self.ngram_lengths = ngram_lengths
+        if self.packed:
+            self.segment_starts = segment_starts
+            self.segment_lengths = segment_lengths
 
     def __len__(self):
         return self.num_samples
 
     def __getitem__(self, item):
+        fields = EXAMPLE_FIELDS + PACKED_FIELDS if self.packed else EXAMPLE_FIELDS
+        return example_tensors({name: getattr(self, name)[item] for name in fields}, self.packed)
 
-        position = torch.tensor(self.ngram_positions[item].astype(np.double))
-        if self.fp16:
-            position = position.half()
-        else:
-            position = position.float()
 
-        return (torch.tensor(self.input_ids[item].astype(np.int64)),
-                torch.tensor(self.input_masks[item].astype(np.int64)),
-                torch.tensor(self.segment_ids[item].astype(np.int64)),
-                torch.tensor(self.lm_label_ids[item].astype(np.int64)),
-                torch.tensor(self.is_nexts[item].astype(np.int64)),
-                torch.tensor(self.ngram_ids[item].astype(np.int64)),
-                torch.tensor(self.ngram_masks[item].astype(np.int64)),
-                position,
-                torch.tensor(self.ngram_starts[item].astype(np.int64)),
-                torch.tensor(self.ngram_lengths[item].astype(np.int64)),
-                torch.tensor(self.ngram_segment_ids[item].astype(np.int64)))
+class StreamingPregeneratedDataset(IterableDataset):
+    """Streams the examples of one epoch from its data files, without loading the epoch first.
+
+    The data files are read one after another and each example is converted when it is read, so the first batch is
+    ready at once and the memory used does not grow with the corpus. Example i goes to distributed rank
+    i % world_size, and the examples of a rank are dealt in turn to its DataLoader workers; every rank gets the same
+    number of examples. The order is shuffled within a buffer of `shuffle_buffer_size` examples.
+    """
+    def __init__(self, training_path, epoch, tokenizer, num_data_epochs, shuffle_buffer_size=10000, seed=42,
+                 rank=0, world_size=1):
+        self.tokenizer = tokenizer
+        self.epoch = epoch
+        self.data_epoch = epoch % num_data_epochs
+        metrics_file = training_path / f"epoch_{self.data_epoch}_metrics.json"
+        assert metrics_file.is_file()
+        metrics = json.loads(metrics_file.read_text())
+        self.data_files = epoch_data_files(training_path, self.data_epoch, metrics)
+        assert all(data_file.exists() for data_file in self.data_files)
+        self.seq_len = metrics['max_seq_len']
+        self.max_ngram_in_sequence = metrics['max_ngram_in_sequence']
+        self.max_segments = metrics.get("max_segments_per_sequence")
+        self.packed = self.max_segments is not None
+        self.columnar = metrics.get("data_format") == "columnar"
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        # drop the last few examples so that all ranks run the same number of steps
+        self.num_samples = metrics['num_training_examples'] // world_size
+
+    def __len__(self):
+        return self.num_samples
+
+    def _rows(self, first, step):
+        """Yields the row of every step-th example of the epoch from `first` on."""
+        end = self.num_samples * self.world_size
+        if self.columnar:
+            shards = [open_columnar_shard(data_file)[1] for data_file in self.data_files]
+            columns = {name: ShardedColumn([shard[name] for shard in shards]) for name in shards[0]}
+            for i in range(first, end, step):
+                yield {name: column[i] for name, column in columns.items()}
+            return
+        for i, line in enumerate(read_epoch_lines(self.data_files)):
+            if i >= end:
+                break
+            if i % step == first:
+                features = convert_example_to_features(json.loads(line.strip()), self.tokenizer, self.seq_len,
+                                                       self.max_ngram_in_sequence, self.max_segments)
+                yield feature_row(features)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank, worker_id])
+        rows = self._rows(worker_id * self.world_size + self.rank, num_workers * self.world_size)
+        return shuffle_buffered((example_tensors(row, self.packed) for row in rows), self.shuffle_buffer_size, rng)
+
+
+class DynamicMaskingDataset(IterableDataset):
+    """Creates the examples of each epoch while training, from the corpus indexed by create_pre_train_data.py
+    --dynamic_masking.
+
+    Only the unmasked token ids of the corpus are on disk. The DataLoader workers split the documents into sentence
+    pairs, draw the random next sentences, mask the tokens and match the ngrams, so every epoch gets new masks and
+    pairs and no epoch has to be pregenerated. Document i goes to the worker slot i % (num_workers * world_size);
+    each slot cycles over its documents in a shuffled order until it has made its share of the
+    `num_training_examples` estimated by create_pre_train_data.py, so every rank runs the same number of steps.
+    Call `set_epoch` before each epoch.
+    """
+    def __init__(self, training_path, tokenizer, shuffle_buffer_size=10000, seed=42, rank=0, world_size=1):
+        settings = json.loads((training_path / DYNAMIC_MASKING_NAME).read_text())
+        self.settings = settings
+        # the corpus directory is relative to training_path when it is inside it
+        corpus_dir = training_path / settings["corpus_dir"]
+        store = CorpusStore.open_existing(corpus_dir, tokenizer.vocab, settings["corpus_key"])
+        if store is None:
+            raise ValueError(f"No corpus indexed with the vocabulary of the tokenizer was found in {corpus_dir}")
+        self.docs = DocumentDatabase.from_corpus_store(store)
+        self.tokenizer = tokenizer
+        self.masking_vocab = MaskingVocab(list(tokenizer.vocab.keys()))
+        self.ngram_dict = ZenNgramDict(settings["ngram_file"], tokenizer=tokenizer, dna=settings["dna"])
+        self.seq_len = settings["max_seq_len"]
+        self.max_ngram_in_sequence = settings["max_ngram_in_sequence"]
+        self.packed = False
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = 0
+        self.rank = rank
+        self.world_size = world_size
+        self.num_samples = settings["num_training_examples"] // world_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def _instances(self, doc_indices, num_instances, rng):
+        """Yields `num_instances` instances created from the documents of `doc_indices`, in shuffled passes."""
+        settings = self.settings
+        doc_indices = list(doc_indices)
+        while num_instances > 0:
+            rng.shuffle(doc_indices)
+            num_before = num_instances
+            for doc_idx in doc_indices:
+                instances = create_instances_from_document(
+                    self.docs, doc_idx, self.docs[doc_idx], max_seq_length=self.seq_len, max_ngram_in_seq=self.max_ngram_in_sequence,
+                    short_seq_prob=settings["short_seq_prob"], masked_lm_prob=settings["masked_lm_prob"],
+                    max_predictions_per_seq=settings["max_predictions_per_seq"],
+                    whole_word_mask=settings["do_whole_word_mask"], masking_vocab=self.masking_vocab,
+                    ngram_dict=self.ngram_dict, rng=rng)
+                for instance in instances[:num_instances]:
+                    yield instance
+                num_instances -= min(len(instances), num_instances)
+                if num_instances == 0:
+                    return
+            if num_instances == num_before:
+                # the documents are too short to make any instance
+                return
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        slot, num_slots = worker_id * self.world_size + self.rank, num_workers * self.world_size
+        doc_indices = range(slot, len(self.docs), num_slots)
+        if len(doc_indices) == 0:
+            # more slots than documents: every slot draws from all of them, with its own random generator
+            doc_indices = range(len(self.docs))
+        num_instances = self.num_samples // num_workers + (worker_id < self.num_samples % num_workers)
+        seed = int(np.random.SeedSequence([self.seed, self.epoch, self.rank, worker_id]).generate_state(1)[0])
+        instances = self._instances(doc_indices, num_instances, random.Random(seed))
+        rows = (feature_row(convert_example_to_features(instance, self.tokenizer, self.seq_len,
+                                                        self.max_ngram_in_sequence))
+                for instance in instances)
+        return shuffle_buffered((example_tensors(row, self.packed) for row in rows), self.shuffle_buffer_size,
+                                np.random.default_rng([self.seed, self.epoch, self.rank, worker_id]))
 
 
 def main():
@@ -250,6 +464,17 @@ def main():
     parser.add_argument("--reduce_memory", action="store_true",
                         help="Store training data as on-disc memmaps to massively reduce memory usage")
 
+    parser.add_argument("--streaming", action="store_true",
+                        help="Stream the examples of each epoch from the pregenerated files while training, instead "
+                             "of loading the whole epoch first. The order is shuffled within --shuffle_buffer_size "
+                             "examples.")
+    parser.add_argument("--shuffle_buffer_size", type=int, default=10000,
+                        help="Number of examples the --streaming and dynamic masking datasets shuffle among")
+    parser.add_argument("--num_workers", type=int, default=0,
+                        help="Number of DataLoader worker processes preparing the batches during training. With "
+                             "data written by create_pre_train_data.py --dynamic_masking, they also mask the "
+                             "examples.")
+
     parser.add_argument("--epochs", type=int, default=3, help="Number of epochs to train for")
     parser.add_argument("--local_rank",
                         type=int,
@@ -272,6 +497,12 @@ def main():
     parser.add_argument('--scratch',
                         action='store_true',
                         help="Whether to train from scratch")
+    parser.add_argument('--ngram_fusion',
+                        choices=["dense", "sparse"],
+                        default=None,
+                        help="How the encoder adds the ngram states to the characters: dense position matrix "
+                             "products, or index_add over the (character, ngram) pairs built from the ngram starts "
+                             "and lengths. Defaults to the model config.")
     parser.add_argument('--loss_scale',
                         type=float, default=0,
                         help="Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True.\n"
@@ -303,22 +534,31 @@ def main():
     assert args.pregenerated_data.is_dir(), \
         "--pregenerated_data should point to the folder of files made by pregenerate_training_data.py!"
 
+    # create_pre_train_data.py --dynamic_masking只写了索引好的语料和生成实例的参数，每个epoch的实例在训练时生成
+    dynamic_settings_file = args.pregenerated_data / DYNAMIC_MASKING_NAME
+    dynamic_settings = json.loads(dynamic_settings_file.read_text()) if dynamic_settings_file.is_file() else None
     samples_per_epoch = []
-    for i in range(args.epochs):
-        epoch_file = args.pregenerated_data / f"epoch_{i}.json"
-        metrics_file = args.pregenerated_data / f"epoch_{i}_metrics.json"
-        if epoch_file.is_file() and metrics_file.is_file():
-            metrics = json.loads(metrics_file.read_text())  # 将字符串转化为字典
-            samples_per_epoch.append(metrics['num_training_examples'])  # 训练实例的数目
-        else:
-            if i == 0:
-                exit("No training data was found!")
-            print(f"Warning! There are fewer epochs of pregenerated data ({i}) than training epochs ({args.epochs}).")
-            print("This script will loop over the available data, but training diversity may be negatively impacted.")
-            num_data_epochs = i
-            break
+    if dynamic_settings is not None:
+        samples_per_epoch.append(dynamic_settings['num_training_examples'])
+        num_data_epochs = args.epochs
     else:
-        num_data_epochs = args.epochs  # epoch的数目
+        for i in range(args.epochs):
+            metrics_file = args.pregenerated_data / f"epoch_{i}_metrics.json"
+            metrics = json.loads(metrics_file.read_text()) if metrics_file.is_file() else None  # 将字符串转化为字典
+            if metrics is not None and all(data_file.exists()
+                                           for data_file in epoch_data_files(args.pregenerated_data, i, metrics)):
+                samples_per_epoch.append(metrics['num_training_examples'])  # 训练实例的数目
+            else:
+                if i == 0:
+                    exit("No training data was found!")
+                print(f"Warning! There are fewer epochs of pregenerated data ({i}) than training epochs "
+                      f"({args.epochs}).")
+                print("This script will loop over the available data, but training diversity may be negatively "
+                      "impacted.")
+                num_data_epochs = i
+                break
+        else:
+            num_data_epochs = args.epochs  # epoch的数目
 
     if args.local_rank == -1 or args.no_cuda:
         device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
@@ -344,7 +584,8 @@ def main():
     if n_gpu > 0:
         torch.cuda.manual_seed_all(args.seed)
     print(args.bert_model)
-    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case,
+                                              dna=dynamic_settings is not None and dynamic_settings["dna"])
 
     total_train_examples = 0  # 所有epochs加起来总的训练实例数目
     for i in range(args.epochs):
@@ -361,6 +602,9 @@ def main():
         model = ZenForPreTraining(config)
     else:
         model = ZenForPreTraining.from_pretrained(args.bert_model)
+    if args.ngram_fusion is not None:
+        model.config.ngram_fusion = args.ngram_fusion
+        model.bert.encoder.ngram_fusion = args.ngram_fusion
 
     if args.fp16:
         model.half()
@@ -409,32 +653,63 @@ def main():
                              t_total=num_train_optimization_steps)
 
     global_step = 0
+    model_ngram_fusion = (model.module if hasattr(model, 'module') else model).bert.encoder.ngram_fusion
     logging.info("***** Running training *****")
     logging.info("  Num examples = %d", total_train_examples)
     logging.info("  Batch size = %d", args.train_batch_size)
     logging.info("  Num steps = %d", num_train_optimization_steps)
     model.train()
+    if dynamic_settings is not None:
+        dynamic_dataset = DynamicMaskingDataset(
+            args.pregenerated_data, tokenizer, shuffle_buffer_size=args.shuffle_buffer_size, seed=args.seed,
+            rank=0 if args.local_rank == -1 else torch.distributed.get_rank(),
+            world_size=1 if args.local_rank == -1 else torch.distributed.get_world_size())
     for epoch in range(args.epochs):
 
-        epoch_dataset = PregeneratedDataset(epoch=epoch,
-                                            training_path=args.pregenerated_data,
-                                            tokenizer=tokenizer,
-                                            num_data_epochs=num_data_epochs,
-                                            reduce_memory=args.reduce_memory,
-                                            fp16=args.fp16)
-        if args.local_rank == -1:
-            train_sampler = RandomSampler(epoch_dataset)
+        if dynamic_settings is not None:
+            # 动态mask：在DataLoader的worker中从语料生成实例，每个epoch的mask和随机下句都不同
+            epoch_dataset = dynamic_dataset
+            epoch_dataset.set_epoch(epoch)
+            train_dataloader = DataLoader(epoch_dataset, batch_size=args.train_batch_size,
+                                          num_workers=args.num_workers)
+        elif args.streaming:
+            # 边读边训练：数据在DataLoader的worker中读取和转换，与训练并行
+            epoch_dataset = StreamingPregeneratedDataset(
+                epoch=epoch, training_path=args.pregenerated_data, tokenizer=tokenizer,
+                num_data_epochs=num_data_epochs, shuffle_buffer_size=args.shuffle_buffer_size, seed=args.seed,
+                rank=0 if args.local_rank == -1 else torch.distributed.get_rank(),
+                world_size=1 if args.local_rank == -1 else torch.distributed.get_world_size())
+            train_dataloader = DataLoader(epoch_dataset, batch_size=args.train_batch_size,
+                                          num_workers=args.num_workers)
         else:
-            train_sampler = DistributedSampler(epoch_dataset)
-        train_dataloader = DataLoader(epoch_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+            epoch_dataset = PregeneratedDataset(epoch=epoch,
+                                                training_path=args.pregenerated_data,
+                                                tokenizer=tokenizer,
+                                                num_data_epochs=num_data_epochs,
+                                                reduce_memory=args.reduce_memory,
+                                                fp16=args.fp16)
+            if args.local_rank == -1:
+                train_sampler = RandomSampler(epoch_dataset)
+            else:
+                train_sampler = DistributedSampler(epoch_dataset)
+            train_dataloader = DataLoader(epoch_dataset, sampler=train_sampler, batch_size=args.train_batch_size,
+                                          num_workers=args.num_workers)
         tr_loss = 0
         nb_tr_examples, nb_tr_steps = 0, 0
         with tqdm(total=len(train_dataloader), desc=f"Epoch {epoch}") as pbar:
             for step, batch in enumerate(train_dataloader):
                 batch = tuple(t.to(device) for t in batch)
-                input_ids, input_mask, segment_ids, lm_label_ids, is_next, ngram_ids, ngram_masks,  ngram_positions, \
+                input_ids, input_mask, segment_ids, lm_label_ids, is_next, ngram_ids, ngram_masks, \
                 ngram_starts, \
-                ngram_lengths, ngram_segment_ids = batch
+                ngram_lengths, ngram_segment_ids = batch[:10]
+                # packed examples also carry the start and length of each of their instances
+                packed_segments = batch[10:] if epoch_dataset.packed else None
+                if model_ngram_fusion == "sparse":
+                    # the encoder indexes the characters of each ngram directly from its start and length
+                    ngram_positions = (ngram_starts, ngram_lengths)
+                else:
+                    ngram_positions = build_ngram_position_matrix(ngram_starts, ngram_lengths, input_ids.size(1),
+                                                                  dtype=torch.half if args.fp16 else torch.float)
 
                 loss = model(input_ids,
                              ngram_ids,
@@ -444,7 +719,8 @@ def main():
                              input_mask,
                              ngram_masks,
                              lm_label_ids,
-                             is_next)
+                             is_next,
+                             packed_segments=packed_segments)
 
                 if n_gpu > 1:
                     loss = loss.mean()  # mean() to average on multi-gpu.
@@ -17,7 +17,6 @@
 from __future__ import absolute_import, division, print_function
 
 import argparse
-import sys
 import logging
 import os
 import random
@@ -30,38 +29,46 @@ import datetime
 
 from tensorboardX import SummaryWriter
 
-from utils_sequence_level_task import processors, convert_examples_to_features, compute_metrics
+from utils_sequence_level_task import processors, convert_examples_to_arrays, compute_metrics
+from utils_batching import LengthBucketSampler, TrimBatchCollator, SEQ, NGRAM, SEQ_NGRAM
+from utils_feature_cache import cached_feature_tensors
 from ZEN import BertTokenizer, BertAdam, WarmupLinearSchedule
 from ZEN import ZenForSequenceClassification, ZenNgramDict
 from ZEN import WEIGHTS_NAME, CONFIG_NAME, NGRAM_DICT_NAME
 
 logger = logging.getLogger(__name__)
 
-if sys.version_info[0] == 2:
-    import cPickle as pickle
-else:
-    import pickle
-
 def load_examples(args, tokenizer, ngram_dict, processor, label_list, mode):
-    if mode == "train":
-        examples = processor.get_train_examples(args.data_dir)
-    elif mode == "test":
-        examples = processor.get_test_examples(args.data_dir)
-
-    features = convert_examples_to_features(examples, label_list, args.max_seq_length, tokenizer, ngram_dict)
-
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-    all_label_ids = torch.tensor([f.label_id for f in features], dtype=torch.long)
-    all_ngram_ids = torch.tensor([f.ngram_ids for f in features], dtype=torch.long)
-    all_ngram_positions = torch.tensor([f.ngram_positions for f in features], dtype=torch.long)
-    all_ngram_lengths = torch.tensor([f.ngram_lengths for f in features], dtype=torch.long)
-    all_ngram_seg_ids = torch.tensor([f.ngram_seg_ids for f in features], dtype=torch.long)
-    all_ngram_masks = torch.tensor([f.ngram_masks for f in features], dtype=torch.long)
-
-    return TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids, all_ngram_ids,
-                              all_ngram_positions, all_ngram_lengths, all_ngram_seg_ids, all_ngram_masks)
+    def build_tensors():
+        if mode == "train":
+            examples = processor.get_train_examples(args.data_dir)
+        elif mode == "test":
+            examples = processor.get_test_examples(args.data_dir)
+        # featurized straight into one preallocated array per field, which the tensors share without a copy
+        arrays = convert_examples_to_arrays(examples, label_list, args.max_seq_length, tokenizer, ngram_dict,
+                                            num_workers=args.preprocess_workers)
+        return [torch.from_numpy(array) for array in arrays.values()]
+
+    # 特征缓存在磁盘上，数据、词表、ngram词典或长度设置改变时自动重新生成
+    return TensorDataset(*cached_feature_tensors(args, mode, label_list, tokenizer, ngram_dict, build_tensors))
+
+
+# padding kind of every tensor returned by load_examples, for trimming batches with --dynamic_padding
+FEATURE_FIELD_KINDS = (SEQ, SEQ, SEQ, None, NGRAM, SEQ_NGRAM, NGRAM, NGRAM, NGRAM)
+
+
+def make_dataloader(args, dataset, batch_size, train):
+    collate_fn = TrimBatchCollator(FEATURE_FIELD_KINDS, input_mask_index=1, ngram_mask_index=8) \
+        if args.dynamic_padding else None
+    if train and args.bucket_by_length and args.local_rank == -1:
+        lengths = dataset.tensors[1].sum(1).numpy()
+        batch_sampler = LengthBucketSampler(lengths, batch_size, seed=args.seed)
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn)
+    if args.local_rank == -1:
+        sampler = RandomSampler(dataset) if train else SequentialSampler(dataset)
+    else:
+        sampler = DistributedSampler(dataset)  # Note that this sampler samples randomly
+    return DataLoader(dataset, sampler=sampler, batch_size=batch_size, collate_fn=collate_fn)
 
 def save_zen_model(save_zen_model_path, model, tokenizer, ngram_dict, args):
     # Save a trained model, configuration and tokenizer
@@ -80,11 +87,7 @@ def save_zen_model(save_zen_model_path, model, tokenizer, ngram_dict, args):
 def evaluate(args, model, tokenizer, ngram_dict, processor, label_list):
     eval_dataset = load_examples(args, tokenizer, ngram_dict, processor, label_list, mode="test")
     # Run prediction for full data
-    if args.local_rank == -1:
-        eval_sampler = SequentialSampler(eval_dataset)
-    else:
-        eval_sampler = DistributedSampler(eval_dataset)  # Note that this sampler samples randomly
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    eval_dataloader = make_dataloader(args, eval_dataset, args.eval_batch_size, train=False)
 
     # Eval!
     logger.info("***** Running evaluation *****")
@@ -123,11 +126,7 @@ def train(args, model, tokenizer, ngram_dict, processor, label_list):
         tb_writer = SummaryWriter()
 
     train_dataset = load_examples(args, tokenizer, ngram_dict, processor, label_list, mode="train")
-    if args.local_rank == -1:
-        train_sampler = RandomSampler(train_dataset)
-    else:
-        train_sampler = DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    train_dataloader = make_dataloader(args, train_dataset, args.train_batch_size, train=True)
 
     num_train_optimization_steps = len(train_dataloader) // args.gradient_accumulation_steps * args.num_train_epochs
 
@@ -262,10 +261,33 @@ def main():
     parser.add_argument("--do_lower_case",
                         action='store_true',
                         help="Set this flag if you are using an uncased model.")
+    parser.add_argument("--dna_ngrams",
+                        action='store_true',
+                        help="The text and ngram lexicon are DNA: tokenize the reads base by base with a lookup "
+                             "table, and pack the k-mers into 2-bit codes matched with a rolling hash.")
     parser.add_argument("--train_batch_size",
                         default=32,
                         type=int,
                         help="Total batch size for training.")
+    parser.add_argument("--dynamic_padding",
+                        action='store_true',
+                        help="Trim every batch to its longest sequence and its largest number of ngrams.")
+    parser.add_argument("--bucket_by_length",
+                        action='store_true',
+                        help="Batch training examples of similar length together (use with --dynamic_padding). "
+                             "Not applied in distributed training.")
+    parser.add_argument("--preprocess_workers",
+                        default=1,
+                        type=int,
+                        help="Number of processes tokenizing the examples and matching their ngrams")
+    parser.add_argument("--feature_cache_dir",
+                        default=None,
+                        type=str,
+                        help="Where the featurized examples are cached, keyed by a hash of the data, vocabulary, "
+                             "ngram lexicon and sequence lengths. Defaults to cached_features in the data dir.")
+    parser.add_argument("--no_feature_cache",
+                        action='store_true',
+                        help="Featurize the examples on every run instead of caching them")
     parser.add_argument("--eval_batch_size",
                         default=8,
                         type=int,
@@ -366,8 +388,9 @@ def main():
 
     if args.local_rank not in [-1, 0]:
         torch.distributed.barrier()  # Make sure only the first process in distributed training will download model & vocab
-    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
-    ngram_dict = ZenNgramDict(args.bert_model, tokenizer=tokenizer)
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case,
+                                              dna=args.dna_ngrams)
+    ngram_dict = ZenNgramDict(args.bert_model, tokenizer=tokenizer, dna=args.dna_ngrams)
     model = ZenForSequenceClassification.from_pretrained(args.bert_model, num_labels=num_labels, multift = args.multift)
     if args.local_rank == 0:
         torch.distributed.barrier()
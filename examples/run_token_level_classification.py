@@ -32,7 +32,9 @@ from seqeval.metrics import classification_report, f1_score
 import datetime
 
 
-from utils_token_level_task import processors, convert_examples_to_features
+from utils_token_level_task import processors, convert_examples_to_arrays
+from utils_batching import LengthBucketSampler, TrimBatchCollator, SEQ, NGRAM, SEQ_NGRAM
+from utils_feature_cache import cached_feature_tensors
 from ZEN import BertTokenizer, BertAdam, WarmupLinearSchedule
 from ZEN import ZenForTokenClassification
 from ZEN import ZenNgramDict
@@ -48,26 +50,37 @@ def set_seed(args):
         torch.cuda.manual_seed_all(args.seed)
 
 def load_examples(args, tokenizer, ngram_dict, processor, label_list, mode):
-    if mode == "train":
-        examples = processor.get_train_examples(args.data_dir)
-    elif mode == "test":
-        examples = processor.get_test_examples(args.data_dir)
-    features = convert_examples_to_features(examples, label_list, args.max_seq_length, tokenizer, ngram_dict)
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-    all_label_ids = torch.tensor([f.label_id for f in features], dtype=torch.long)
-    all_valid_ids = torch.tensor([f.valid_ids for f in features], dtype=torch.long)
-    all_lmask_ids = torch.tensor([f.label_mask for f in features], dtype=torch.long)
-
-    all_ngram_ids = torch.tensor([f.ngram_ids for f in features], dtype=torch.long)
-    all_ngram_positions = torch.tensor([f.ngram_positions for f in features], dtype=torch.long)
-    all_ngram_lengths = torch.tensor([f.ngram_lengths for f in features], dtype=torch.long)
-    all_ngram_seg_ids = torch.tensor([f.ngram_seg_ids for f in features], dtype=torch.long)
-    all_ngram_masks = torch.tensor([f.ngram_masks for f in features], dtype=torch.long)
-
-    return TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids, all_ngram_ids,all_ngram_positions,
-                         all_ngram_lengths, all_ngram_seg_ids, all_ngram_masks, all_valid_ids, all_lmask_ids)
+    def build_tensors():
+        if mode == "train":
+            examples = processor.get_train_examples(args.data_dir)
+        elif mode == "test":
+            examples = processor.get_test_examples(args.data_dir)
+        # featurized straight into one preallocated array per field, which the tensors share without a copy
+        arrays = convert_examples_to_arrays(examples, label_list, args.max_seq_length, tokenizer, ngram_dict,
+                                            num_workers=args.preprocess_workers)
+        return [torch.from_numpy(array) for array in arrays.values()]
+
+    # 特征缓存在磁盘上，数据、词表、ngram词典或长度设置改变时自动重新生成
+    return TensorDataset(*cached_feature_tensors(args, mode, label_list, tokenizer, ngram_dict, build_tensors))
+
+
+# padding kind of every tensor returned by load_examples, for trimming batches with --dynamic_padding
+FEATURE_FIELD_KINDS = (SEQ, SEQ, SEQ, SEQ, NGRAM, SEQ_NGRAM, NGRAM, NGRAM, NGRAM, SEQ, SEQ)
+
+def make_dataloader(args, dataset, batch_size, train):
+    collate_fn = TrimBatchCollator(FEATURE_FIELD_KINDS, input_mask_index=1, ngram_mask_index=8) \
+        if args.dynamic_padding else None
+    if train and args.bucket_by_length and args.local_rank == -1:
+        lengths = dataset.tensors[1].sum(1).numpy()
+        batch_sampler = LengthBucketSampler(lengths, batch_size, seed=args.seed)
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn)
+    if not train:
+        sampler = SequentialSampler(dataset)
+    elif args.local_rank == -1:
+        sampler = RandomSampler(dataset)
+    else:
+        sampler = DistributedSampler(dataset)
+    return DataLoader(dataset, sampler=sampler, batch_size=batch_size, collate_fn=collate_fn)
 
 def cws_evaluate_word_PRF(y_pred, y):
     #dict = {'E': 2, 'S': 3, 'B':0, 'I':1}
@@ -115,8 +128,7 @@ def evaluate(args, model, tokenizer, ngram_dict, processor, label_list):
     num_labels = len(label_list) + 1
     eval_dataset = load_examples(args, tokenizer, ngram_dict, processor, label_list, mode="test")
     # Run prediction for full data
-    eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    eval_dataloader = make_dataloader(args, eval_dataset, args.eval_batch_size, train=False)
 
     # Eval!
     logger.info("***** Running evaluation *****")
@@ -220,11 +232,7 @@ def train(args, model, tokenizer, ngram_dict, processor, label_list):
     logger.info("  Batch size = %d", args.train_batch_size)
     logger.info("  Num steps = %d", num_train_optimization_steps)
 
-    if args.local_rank == -1:
-        train_sampler = RandomSampler(train_dataset)
-    else:
-        train_sampler = DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    train_dataloader = make_dataloader(args, train_dataset, args.train_batch_size, train=True)
 
     best_f1 = -1
     best_epoch = -1
@@ -318,10 +326,33 @@ def main():
     parser.add_argument("--do_lower_case",
                         action='store_true',
                         help="Set this flag if you are using an uncased model.")
+    parser.add_argument("--dna_ngrams",
+                        action='store_true',
+                        help="The text and ngram lexicon are DNA: tokenize the reads base by base with a lookup "
+                             "table, and pack the k-mers into 2-bit codes matched with a rolling hash.")
     parser.add_argument("--train_batch_size",
                         default=32,
                         type=int,
                         help="Total batch size for training.")
+    parser.add_argument("--dynamic_padding",
+                        action='store_true',
+                        help="Trim every batch to its longest sequence and its largest number of ngrams.")
+    parser.add_argument("--bucket_by_length",
+                        action='store_true',
+                        help="Batch training examples of similar length together (use with --dynamic_padding). "
+                             "Not applied in distributed training.")
+    parser.add_argument("--preprocess_workers",
+                        default=1,
+                        type=int,
+                        help="Number of processes tokenizing the examples and matching their ngrams")
+    parser.add_argument("--feature_cache_dir",
+                        default=None,
+                        type=str,
+                        help="Where the featurized examples are cached, keyed by a hash of the data, vocabulary, "
+                             "ngram lexicon and sequence lengths. Defaults to cached_features in the data dir.")
+    parser.add_argument("--no_feature_cache",
+                        action='store_true',
+                        help="Featurize the examples on every run instead of caching them")
     parser.add_argument("--eval_batch_size",
                         default=32,
                         type=int,
@@ -414,8 +445,9 @@ def main():
     num_labels = len(label_list) + 1
 
     # Prepare model tokenizer
-    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
-    ngram_dict = ZenNgramDict(args.bert_model, tokenizer=tokenizer)
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case,
+                                              dna=args.dna_ngrams)
+    ngram_dict = ZenNgramDict(args.bert_model, tokenizer=tokenizer, dna=args.dna_ngrams)
     cache_dir = args.cache_dir if args.cache_dir else os.path.join(str(PYTORCH_PRETRAINED_BERT_CACHE),
                                                                    'distributed_{}'.format(args.local_rank))
     model = ZenForTokenClassification.from_pretrained(args.bert_model,
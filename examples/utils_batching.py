@@ -0,0 +1,96 @@
+# coding: utf-8
+# Copyright 2019 Sinovation Ventures AI Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""utils for batching the fine-tuning features with dynamic padding."""
+
+import numpy as np
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
+
+# how each field of a feature tensor is padded: along the tokens, along the ngrams, along both (the ngram position
+# matrix), or not at all
+SEQ = "seq"
+NGRAM = "ngram"
+SEQ_NGRAM = "seq_ngram"
+
+
+class LengthBucketSampler(Sampler):
+    """Batch sampler that puts examples of similar length in the same batch.
+
+    Every epoch the examples are shuffled and cut into buckets of `batch_size * bucket_size_multiplier`; each
+    bucket is sorted by length and cut into batches, and the batches of all buckets are shuffled. Batches then
+    mostly hold sequences of similar length, so trimming them to their longest sequence removes most of the padding,
+    while the order of the batches stays random.
+    """
+    def __init__(self, lengths, batch_size, bucket_size_multiplier=100, drop_last=False, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+        order = rng.permutation(len(self.lengths))
+        batches = []
+        for bucket_start in range(0, len(order), self.bucket_size):
+            bucket = order[bucket_start:bucket_start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            for batch_start in range(0, len(bucket), self.batch_size):
+                batch = bucket[batch_start:batch_start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch.tolist())
+        for i in rng.permutation(len(batches)):
+            yield batches[i]
+
+    def __len__(self):
+        num_batches = 0
+        for bucket_start in range(0, len(self.lengths), self.bucket_size):
+            bucket_len = min(self.bucket_size, len(self.lengths) - bucket_start)
+            num_batches += bucket_len // self.batch_size if self.drop_last else -(-bucket_len // self.batch_size)
+        return num_batches
+
+
+class TrimBatchCollator(object):
+    """Collate function that trims a batch to its longest sequence and its largest number of ngrams.
+
+    :param field_kinds: the padding kind (SEQ, NGRAM, SEQ_NGRAM or None) of each tensor of an example
+    :param input_mask_index: index of the input mask, whose row sums are the sequence lengths
+    :param ngram_mask_index: index of the ngram mask, whose row sums are the ngram counts
+    """
+    def __init__(self, field_kinds, input_mask_index, ngram_mask_index):
+        self.field_kinds = field_kinds
+        self.input_mask_index = input_mask_index
+        self.ngram_mask_index = ngram_mask_index
+
+    def __call__(self, examples):
+        batch = default_collate(examples)
+        seq_len = int(batch[self.input_mask_index].sum(1).max())
+        # keep at least one ngram column, so that the ngram tensors are never empty
+        num_ngrams = max(int(batch[self.ngram_mask_index].sum(1).max()), 1)
+        trimmed = []
+        for tensor, kind in zip(batch, self.field_kinds):
+            if kind == SEQ:
+                tensor = tensor[:, :seq_len]
+            elif kind == NGRAM:
+                tensor = tensor[:, :num_ngrams]
+            elif kind == SEQ_NGRAM:
+                tensor = tensor[:, :seq_len, :num_ngrams]
+            trimmed.append(tensor.contiguous())
+        return tuple(trimmed)
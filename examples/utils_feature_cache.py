@@ -0,0 +1,134 @@
+# coding: utf-8
+# Copyright 2019 Sinovation Ventures AI Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""utils for caching the featurized fine-tuning examples on disk."""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# bump when the features of an example change, so that older caches are not used any more
+FEATURE_CACHE_VERSION = 1
+FEATURE_CACHE_MANIFEST_NAME = "manifest.json"
+
+
+def _update_with_file(sha, path, chunk_size=1 << 20):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+
+
+def feature_cache_key(data_dir, mode, label_list, tokenizer, ngram_dict, max_seq_length, exclude_dir=None):
+    """Hash of everything the features of `mode` depend on.
+
+    It covers the files of the data directory, the vocabulary, casing and DNA mode of the tokenizer, the ngram lexicon with
+    its length limits, the labels and the sequence lengths, so the key changes whenever any of them does.
+
+    :param exclude_dir: directory inside `data_dir` that is not data, such as the cache itself
+    """
+    sha = hashlib.sha1()
+
+    def update(*values):
+        sha.update(json.dumps(values, ensure_ascii=False).encode("utf-8"))
+        sha.update(b"\0")
+
+    update("version", FEATURE_CACHE_VERSION, mode, list(label_list), max_seq_length)
+    exclude_dir = os.path.abspath(exclude_dir) if exclude_dir is not None else None
+    for root, dirs, files in os.walk(data_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) != exclude_dir)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            update("data", os.path.relpath(path, data_dir))
+            _update_with_file(sha, path)
+    basic_tokenizer = getattr(tokenizer, "basic_tokenizer", None)
+    update("tokenizer", getattr(tokenizer, "do_basic_tokenize", None),
+           getattr(basic_tokenizer, "do_lower_case", None), getattr(tokenizer, "dna", False))
+    sha.update("\n".join(tokenizer.vocab).encode("utf-8"))
+    update("ngrams", ngram_dict.max_ngram_in_seq, ngram_dict.min_ngram_len, ngram_dict.max_ngram_len,
+           ngram_dict.dna)
+    _update_with_file(sha, ngram_dict.ngram_freq_path)
+    return sha.hexdigest()
+
+
+def load_feature_cache(cache_dir, key):
+    """Maps the cached feature tensors of `key` copy-on-write, or returns None if there are none."""
+    path = os.path.join(cache_dir, key)
+    manifest_file = os.path.join(path, FEATURE_CACHE_MANIFEST_NAME)
+    if not os.path.isfile(manifest_file):
+        return None
+    with open(manifest_file, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    tensors = []
+    for i in range(manifest["num_tensors"]):
+        array = np.load(os.path.join(path, "{}.npy".format(i)), mmap_mode="c")
+        tensors.append(torch.from_numpy(array))
+    logger.info("Loaded %d cached features from %s", manifest["num_examples"], path)
+    return tensors
+
+
+def save_feature_cache(cache_dir, key, tensors, prefix=None):
+    """Writes the feature tensors of `key` to the cache.
+
+    The files are written to a temporary directory that is then renamed, so a cache is never seen half written.
+    With `prefix`, the other caches whose key starts with it (older versions of the same data) are removed.
+    Failing to write the cache is only logged.
+    """
+    path = os.path.join(cache_dir, key)
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    try:
+        os.makedirs(tmp_path, exist_ok=True)
+        for i, tensor in enumerate(tensors):
+            np.save(os.path.join(tmp_path, "{}.npy".format(i)), tensor.numpy())
+        with open(os.path.join(tmp_path, FEATURE_CACHE_MANIFEST_NAME), "w", encoding="utf-8") as f:
+            json.dump({"version": FEATURE_CACHE_VERSION, "num_tensors": len(tensors),
+                       "num_examples": len(tensors[0]) if tensors else 0}, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+    except OSError as e:
+        logger.warning("Could not write the feature cache %s: %s", path, e)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+    logger.info("Saved features to %s", path)
+    if prefix is not None:
+        for name in os.listdir(cache_dir):
+            if name.startswith(prefix) and name != key and \
+                    os.path.isfile(os.path.join(cache_dir, name, FEATURE_CACHE_MANIFEST_NAME)):
+                shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+
+def cached_feature_tensors(args, mode, label_list, tokenizer, ngram_dict, build_tensors):
+    """The feature tensors of `mode`, from the cache when it is up to date, else from `build_tensors()`.
+
+    The cache lives in args.feature_cache_dir (by default `cached_features` in args.data_dir) and is not used
+    with args.no_feature_cache.
+    """
+    if getattr(args, "no_feature_cache", False):
+        return build_tensors()
+    cache_dir = args.feature_cache_dir or os.path.join(args.data_dir, "cached_features")
+    prefix = "{}_{}_".format(args.task_name, mode)
+    key = prefix + feature_cache_key(args.data_dir, mode, label_list, tokenizer, ngram_dict, args.max_seq_length,
+                                     exclude_dir=cache_dir)
+    tensors = load_feature_cache(cache_dir, key)
+    if tensors is None:
+        tensors = build_tensors()
+        save_feature_cache(cache_dir, key, tensors, prefix=prefix)
+    return tensors
@@ -0,0 +1,73 @@
+# coding: utf-8
+# Copyright 2019 Sinovation Ventures AI Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""utils for featurizing the fine-tuning examples in a process pool."""
+
+import random
+import logging
+import collections
+from multiprocessing import Pool
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# number of examples featurized by one task of the pool
+FEATURIZE_CHUNK_SIZE = 1024
+
+# set in every worker by _init_worker, so that the tokenizer and the ngram dict are sent once per worker rather than
+# with every chunk
+_worker_context = {}
+
+
+def _init_worker(convert, label_list, max_seq_length, tokenizer, ngram_dict):
+    _worker_context.update(convert=convert, label_list=label_list, max_seq_length=max_seq_length,
+                           tokenizer=tokenizer, ngram_dict=ngram_dict)
+
+
+def _convert_chunk(task):
+    chunk_index, seed, examples = task
+    context = _worker_context
+    arrays = context["convert"](examples, context["label_list"], context["max_seq_length"], context["tokenizer"],
+                                context["ngram_dict"], rng=random.Random(seed))
+    return chunk_index, arrays
+
+
+def convert_examples_in_pool(convert, examples, label_list, max_seq_length, tokenizer, ngram_dict, num_workers,
+                             chunk_size=FEATURIZE_CHUNK_SIZE):
+    """Featurizes the examples with `convert` in `num_workers` processes.
+
+    The examples are cut into chunks of `chunk_size`, each converted to arrays by a worker and copied back in place,
+    so the rows keep the order of the examples. The random draws of chunk i come from their own generator, seeded
+    from the global `random` state and i, so the output depends on the seed but not on the number of workers.
+
+    :param convert: convert_examples_to_arrays of the task, called with the keyword argument `rng`
+    :return: the arrays of all examples, as returned by `convert`
+    """
+    base_seed = random.getrandbits(32)
+    tasks = [(chunk_index, base_seed + chunk_index, examples[start:start + chunk_size])
+             for chunk_index, start in enumerate(range(0, len(examples), chunk_size))]
+    arrays = None
+    with Pool(num_workers, initializer=_init_worker,
+              initargs=(convert, label_list, max_seq_length, tokenizer, ngram_dict)) as pool:
+        for num_done, (chunk_index, chunk_arrays) in enumerate(pool.imap_unordered(_convert_chunk, tasks), 1):
+            if arrays is None:
+                arrays = collections.OrderedDict(
+                    (name, np.empty((len(examples),) + array.shape[1:], dtype=array.dtype))
+                    for name, array in chunk_arrays.items())
+            start = chunk_index * chunk_size
+            for name, array in chunk_arrays.items():
+                arrays[name][start:start + len(array)] = array
+            logger.info("Featurized %d of %d chunks", num_done, len(tasks))
+    return arrays
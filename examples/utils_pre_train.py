@@ -0,0 +1,536 @@
+# coding: utf-8
+# Copyright 2019 Sinovation Ventures AI Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""utils for the pregenerated pretraining data written by create_pre_train_data.py and read by run_pre_train.py."""
+
+import json
+import collections
+from pathlib import Path
+
+import numpy as np
+
+# A columnar shard is a directory holding one raw file per field, <field>.bin, with the rows of all examples one
+# after another, and header.json with the number of examples and the dtype and per-example shape of every field.
+# The header is written last, so a shard without it is incomplete.
+COLUMNAR_HEADER_NAME = "header.json"
+COLUMNAR_VERSION = 1
+
+
+def columnar_fields(vocab_size, seq_len, max_ngram_in_sequence, max_segments=None):
+    """Field name -> (dtype, per-example shape) of a columnar shard.
+
+    With `max_segments`, every example packs up to that many instances, and the shard also holds the start and
+    length of each of them, and one is_next label per instance.
+    """
+    id_dtype = np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.int32
+    start_dtype = np.uint16 if seq_len <= np.iinfo(np.uint16).max else np.int32
+    fields = collections.OrderedDict([
+        ("input_ids", (id_dtype, (seq_len,))),
+        ("input_masks", (np.bool_, (seq_len,))),
+        ("segment_ids", (np.bool_, (seq_len,))),
+        ("lm_label_ids", (np.int32, (seq_len,))),
+        ("is_nexts", (np.bool_, () if max_segments is None else (max_segments,))),
+        ("ngram_ids", (np.int32, (max_ngram_in_sequence,))),
+        ("ngram_masks", (np.bool_, (max_ngram_in_sequence,))),
+        ("ngram_starts", (start_dtype, (max_ngram_in_sequence,))),
+        ("ngram_lengths", (np.uint8, (max_ngram_in_sequence,))),
+        ("ngram_segment_ids", (np.bool_, (max_ngram_in_sequence,))),
+    ])
+    if max_segments is not None:
+        fields["segment_starts"] = (start_dtype, (max_segments,))
+        fields["segment_lengths"] = (start_dtype, (max_segments,))
+    return fields
+
+
+def pack_instances(instances):
+    """Concatenates several instances into one, shifting their token positions.
+
+    The packed instance keeps one is_random_next label per instance, and records where each instance starts and
+    how long it is in segment_starts and segment_lengths.
+    """
+    packed = collections.OrderedDict((key, []) for key in (
+        "tokens", "segment_ids", "is_random_next", "masked_lm_positions", "masked_lm_labels", "ngram_ids",
+        "ngram_positions", "ngram_lengths", "ngram_segment_ids", "segment_starts", "segment_lengths"))
+    offset = 0
+    for instance in instances:
+        num_tokens = len(instance["tokens"])
+        packed["tokens"].extend(instance["tokens"])
+        packed["segment_ids"].extend(instance["segment_ids"])
+        packed["is_random_next"].append(instance["is_random_next"])
+        packed["masked_lm_positions"].extend(position + offset for position in instance["masked_lm_positions"])
+        packed["masked_lm_labels"].extend(instance["masked_lm_labels"])
+        packed["ngram_ids"].extend(instance["ngram_ids"])
+        packed["ngram_positions"].extend(position + offset for position in instance["ngram_positions"])
+        packed["ngram_lengths"].extend(instance["ngram_lengths"])
+        packed["ngram_segment_ids"].extend(instance["ngram_segment_ids"])
+        packed["segment_starts"].append(offset)
+        packed["segment_lengths"].append(num_tokens)
+        offset += num_tokens
+    return packed
+
+
+# Settings written by create_pre_train_data.py --dynamic_masking in place of pregenerated epochs: the indexed corpus,
+# the ngram lexicon and the parameters of create_instances_from_document, with which run_pre_train.py creates the
+# instances of every epoch while training
+DYNAMIC_MASKING_NAME = "dynamic_masking.json"
+
+# tokens a masked token is replaced with in the 10% of random replacements, when the vocabulary has them
+DNA_RANDOM_TOKENS = ['a', 'c', 't', 'g']
+
+
+class MaskingVocab(object):
+    """Per-id lookup tables of a vocabulary (token list in id order) for masking arrays of token ids."""
+    def __init__(self, vocab_list):
+        self.vocab = {token: i for i, token in enumerate(vocab_list)}
+        self.id_to_token = np.array(vocab_list, dtype=object)
+        self.mask_id = self.vocab["[MASK]"]
+        # [CLS] and [SEP] are never masked
+        self.special = np.zeros(len(vocab_list), dtype=np.bool_)
+        self.special[[self.vocab["[CLS]"], self.vocab["[SEP]"]]] = True
+        # wordpieces continuing a word, masked with it under whole word masking
+        self.continuation = np.array([token.startswith("##") for token in vocab_list], dtype=np.bool_)
+        random_ids = [self.vocab[token] for token in DNA_RANDOM_TOKENS if token in self.vocab]
+        if not random_ids:
+            random_ids = [i for i, token in enumerate(vocab_list)
+                          if not (token.startswith("[") and token.endswith("]"))]
+        self.random_ids = np.array(random_ids, dtype=np.int64)
+
+    def token_ids(self, tokens):
+        return np.array([self.vocab[token] for token in tokens], dtype=np.int64)
+
+    def tokens(self, token_ids):
+        return self.id_to_token[token_ids].tolist()
+
+
+def mask_token_id_batch(token_ids, lengths, masking_vocab, masked_lm_prob, max_predictions_per_seq, whole_word_mask,
+                        rng):
+    """Masks a batch of sequences of token ids for the masked LM objective.
+
+    The NumPy counterpart of create_masked_lm_predictions: in every sequence, round(length * masked_lm_prob) tokens
+    (at least 1, at most `max_predictions_per_seq`) other than [CLS] and [SEP] are chosen in random order, whole
+    words at a time with `whole_word_mask` (a word is skipped if it does not fit any more). Each chosen token
+    becomes [MASK] 80% of the time, stays 10% of the time and is replaced by a random token 10% of the time.
+
+    :param token_ids: array of shape (batch size, sequence length), not modified
+    :param lengths: number of tokens of every sequence, the rest is padding
+    :param rng: a np.random.Generator
+    :return: (masked token ids, label ids: the original id of every chosen token and -1 elsewhere)
+    """
+    token_ids = np.asarray(token_ids)
+    batch_size, seq_len = token_ids.shape
+    lengths = np.asarray(lengths)
+    candidates = (np.arange(seq_len) < lengths[:, None]) & ~masking_vocab.special[token_ids]
+    num_to_mask = np.minimum(max_predictions_per_seq,
+                             np.maximum(1, np.rint(lengths * masked_lm_prob).astype(np.int64)))
+    keys = rng.random((batch_size, seq_len))
+    starts = candidates
+    if whole_word_mask:
+        # a ## wordpiece joins the word of the candidate before it, if there is one
+        has_previous = (np.cumsum(candidates, axis=1) - candidates) > 0
+        starts = candidates & ~(masking_vocab.continuation[token_ids] & has_previous)
+    if not whole_word_mask or np.array_equal(starts, candidates):
+        # every word is a single token: the first num_to_mask candidates in the random order
+        ranks = np.argsort(np.argsort(np.where(candidates, keys, 2.0), axis=1, kind="stable"), axis=1)
+        chosen = candidates & (ranks < num_to_mask[:, None])
+    else:
+        chosen = np.zeros_like(candidates)
+        for row in range(batch_size):
+            word_of_token = np.cumsum(starts[row]) - 1
+            word_starts = np.flatnonzero(starts[row])
+            word_sizes = np.bincount(word_of_token[candidates[row]], minlength=len(word_starts))
+            chosen_words = np.zeros(len(word_starts), dtype=np.bool_)
+            num_chosen = 0
+            for word in np.argsort(keys[row, word_starts], kind="stable"):
+                if num_chosen >= num_to_mask[row]:
+                    break
+                if num_chosen + word_sizes[word] <= num_to_mask[row]:
+                    chosen_words[word] = True
+                    num_chosen += word_sizes[word]
+            chosen[row] = candidates[row] & chosen_words[np.maximum(word_of_token, 0)]
+    label_ids = np.where(chosen, token_ids, -1).astype(np.int64)
+    masked_ids = token_ids.copy()
+    draws = rng.random((batch_size, seq_len))
+    masked_ids[chosen & (draws < 0.8)] = masking_vocab.mask_id
+    replaced = chosen & (draws >= 0.9)
+    masked_ids[replaced] = rng.choice(masking_vocab.random_ids, size=int(replaced.sum()))
+    return masked_ids, label_ids
+
+
+def mask_token_ids(token_ids, masking_vocab, masked_lm_prob, max_predictions_per_seq, whole_word_mask, rng):
+    """Masks one sequence of token ids, see `mask_token_id_batch`.
+
+    :return: (masked token ids, masked positions in increasing order, original ids at those positions)
+    """
+    masked_ids, label_ids = mask_token_id_batch(np.asarray(token_ids)[None], [len(token_ids)], masking_vocab,
+                                                masked_lm_prob, max_predictions_per_seq, whole_word_mask, rng)
+    positions = np.flatnonzero(label_ids[0] >= 0)
+    return masked_ids[0], positions, label_ids[0, positions]
+
+
+class JsonShardWriter(object):
+    """Writes instances as json, one per line."""
+    def __init__(self, path):
+        self.path = path
+        self.num_examples = 0
+        self._file = path.open('w')
+
+    def add(self, instance):
+        self._file.write(json.dumps(instance) + '\n')
+        self.num_examples += 1
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
+
+
+class PackingShardWriter(object):
+    """Packs consecutive instances into examples of at most `seq_len` tokens, and hands these to `writer`.
+
+    Instances are added to the current example as long as its tokens, ngrams and number of instances fit, so
+    short instances no longer fill most of a sequence with padding.
+    """
+    def __init__(self, writer, seq_len, max_ngram_in_sequence, max_segments):
+        self.writer = writer
+        self.seq_len = seq_len
+        self.max_ngram_in_sequence = max_ngram_in_sequence
+        self.max_segments = max_segments
+        self._instances = []
+        self._num_tokens = 0
+        self._num_ngrams = 0
+
+    @property
+    def num_examples(self):
+        return self.writer.num_examples
+
+    def add(self, instance):
+        num_tokens = len(instance["tokens"])
+        num_ngrams = len(instance["ngram_ids"])
+        if self._instances and (len(self._instances) == self.max_segments
+                                or self._num_tokens + num_tokens > self.seq_len
+                                or self._num_ngrams + num_ngrams > self.max_ngram_in_sequence):
+            self._flush()
+        self._instances.append(instance)
+        self._num_tokens += num_tokens
+        self._num_ngrams += num_ngrams
+
+    def _flush(self):
+        self.writer.add(pack_instances(self._instances))
+        self._instances = []
+        self._num_tokens = 0
+        self._num_ngrams = 0
+
+    def close(self):
+        if self._instances:
+            self._flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
+
+
+class ColumnarShardWriter(object):
+    """Writes instances as a columnar shard, converting the tokens to ids on the way."""
+    def __init__(self, path, vocab, seq_len, max_ngram_in_sequence, max_segments=None):
+        self.path = path
+        self.vocab = vocab
+        self.seq_len = seq_len
+        self.max_ngram_in_sequence = max_ngram_in_sequence
+        self.max_segments = max_segments
+        self.num_examples = 0
+        self.fields = columnar_fields(len(vocab), seq_len, max_ngram_in_sequence, max_segments)
+        path.mkdir(exist_ok=True)
+        header_file = path / COLUMNAR_HEADER_NAME
+        if header_file.exists():
+            header_file.unlink()
+        self._files = collections.OrderedDict(
+            (name, (path / f"{name}.bin").open('wb')) for name in self.fields)
+        # one example of every field, reused for each instance
+        self._rows = collections.OrderedDict(
+            (name, np.zeros(shape, dtype=dtype)) for name, (dtype, shape) in self.fields.items())
+
+    def add(self, instance):
+        rows = self._rows
+        for row in rows.values():
+            row.fill(0)
+        tokens = instance["tokens"]
+        assert len(tokens) <= self.seq_len  # The preprocessed data should be already truncated
+        rows["input_ids"][:len(tokens)] = [self.vocab[token] for token in tokens]
+        rows["input_masks"][:len(tokens)] = 1
+        rows["segment_ids"][:len(tokens)] = instance["segment_ids"]
+        rows["lm_label_ids"].fill(-1)
+        rows["lm_label_ids"][instance["masked_lm_positions"]] = [self.vocab[token]
+                                                                 for token in instance["masked_lm_labels"]]
+        if self.max_segments is None:
+            rows["is_nexts"][...] = instance["is_random_next"]
+        else:
+            num_segments = len(instance["segment_starts"])
+            rows["is_nexts"][:num_segments] = instance["is_random_next"]
+            rows["segment_starts"][:num_segments] = instance["segment_starts"]
+            rows["segment_lengths"][:num_segments] = instance["segment_lengths"]
+        num_ngrams = len(instance["ngram_ids"])
+        rows["ngram_ids"][:num_ngrams] = instance["ngram_ids"]
+        rows["ngram_masks"][:num_ngrams] = 1
+        rows["ngram_starts"][:num_ngrams] = instance["ngram_positions"]
+        rows["ngram_lengths"][:num_ngrams] = instance["ngram_lengths"]
+        rows["ngram_segment_ids"][:num_ngrams] = instance["ngram_segment_ids"]
+        for name, row in rows.items():
+            self._files[name].write(row.tobytes())
+        self.num_examples += 1
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        header = {
+            "version": COLUMNAR_VERSION,
+            "num_examples": self.num_examples,
+            "fields": collections.OrderedDict(
+                (name, [np.dtype(dtype).str, list(shape)]) for name, (dtype, shape) in self.fields.items()),
+        }
+        with (self.path / COLUMNAR_HEADER_NAME).open('w') as header_file:
+            header_file.write(json.dumps(header))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
+
+
+def is_columnar_shard(path):
+    return (path / COLUMNAR_HEADER_NAME).is_file()
+
+
+def open_columnar_shard(path):
+    """Maps the fields of a columnar shard read-only, without reading them.
+
+    :return: (number of examples, field name -> array of shape (num_examples,) + per-example shape)
+    """
+    header = json.loads((path / COLUMNAR_HEADER_NAME).read_text())
+    if header["version"] != COLUMNAR_VERSION:
+        raise ValueError("Unsupported columnar shard version {} in {}".format(header["version"], path))
+    num_examples = header["num_examples"]
+    arrays = collections.OrderedDict()
+    for name, (dtype, shape) in header["fields"].items():
+        shape = (num_examples,) + tuple(shape)
+        if num_examples == 0:
+            # np.memmap cannot map an empty file
+            arrays[name] = np.zeros(shape, dtype=np.dtype(dtype))
+        else:
+            arrays[name] = np.memmap(path / f"{name}.bin", dtype=np.dtype(dtype), mode='r', shape=shape)
+    return num_examples, arrays
+
+
+class ShardedColumn(object):
+    """One field of several columnar shards, indexed by example as if they were a single array."""
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.offsets = np.cumsum([0] + [len(array) for array in arrays])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, item):
+        shard = int(np.searchsorted(self.offsets, item, side='right')) - 1
+        return self.arrays[shard][item - self.offsets[shard]]
+
+
+# A corpus store is a directory holding the token ids of all sentences one after another in tokens.bin, and the
+# offsets of the sentences (in tokens) and of the documents (in sentences) in sentence_offsets.bin and
+# doc_offsets.bin, each starting with 0, so that sentence i is tokens[sentence_offsets[i]:sentence_offsets[i + 1]].
+# As for columnar shards, header.json is written last, so a store without it is incomplete.
+CORPUS_VERSION = 1
+CORPUS_OFFSET_DTYPE = np.int64
+# size of the buffer of token ids, written out whenever it is full
+CORPUS_BUFFER_BYTES = 1 << 24
+
+
+def corpus_id_dtype(vocab_size):
+    """Smallest unsigned dtype holding the ids of the vocabulary: one byte per token for DNA vocabularies."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if vocab_size <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    raise ValueError("Vocabulary of {} tokens is too large".format(vocab_size))
+
+
+class CorpusStore(object):
+    """Append-only store of tokenized documents, memory-mapped for reading.
+
+    Sentences are appended with `add_sentence_ids` (or whole documents with `add_document`) and closed into
+    documents with `end_document`, while at most `buffer_bytes` of ids are held in memory. The first read (or
+    `open_for_reading`) flushes the buffers, writes the header and maps the files read-only; a document is then
+    sliced out of the token array and its ids turned back into tokens, without any unpickling.
+
+    :param key: any string identifying what the store was built from, kept in the header (see `open_existing`)
+    """
+    def __init__(self, path, vocab, buffer_bytes=CORPUS_BUFFER_BYTES, key=None):
+        self.path = Path(path)
+        self.vocab = vocab
+        self.key = key
+        self.id_dtype = corpus_id_dtype(len(vocab))
+        self.id_to_token = np.empty(max(vocab.values()) + 1, dtype=object)
+        for token, token_id in vocab.items():
+            self.id_to_token[token_id] = token
+        self.num_tokens = 0
+        self.num_sentences = 0
+        self.num_documents = 0
+        self.tokens = None
+        self.sentence_offsets = None
+        self.doc_offsets = None
+        self._files = None
+        if buffer_bytes is None:
+            # opened by open_existing, read only
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        header_file = self.path / COLUMNAR_HEADER_NAME
+        if header_file.exists():
+            header_file.unlink()
+        self._files = collections.OrderedDict(
+            (name, (self.path / f"{name}.bin").open('wb')) for name in ("tokens", "sentence_offsets", "doc_offsets"))
+        zero = np.zeros(1, dtype=CORPUS_OFFSET_DTYPE).tobytes()
+        self._files["sentence_offsets"].write(zero)
+        self._files["doc_offsets"].write(zero)
+        self._buffer = np.empty(max(buffer_bytes // self.id_dtype.itemsize, 1), dtype=self.id_dtype)
+        self._num_buffered = 0
+        self._sentence_ends = []
+        self._doc_ends = []
+        self._num_doc_sentences = 0
+
+    @classmethod
+    def open_existing(cls, path, vocab, key=None):
+        """Opens a complete store for reading, or returns None if there is none at `path` built with `key`."""
+        header_file = Path(path) / COLUMNAR_HEADER_NAME
+        if not header_file.is_file():
+            return None
+        header = json.loads(header_file.read_text())
+        if header["version"] != CORPUS_VERSION or header["key"] != key or header["vocab_size"] != len(vocab):
+            return None
+        store = cls(path, vocab, buffer_bytes=None, key=key)
+        store.num_tokens = header["num_tokens"]
+        store.num_sentences = header["num_sentences"]
+        store.num_documents = header["num_documents"]
+        store._map()
+        return store
+
+    def add_sentence_ids(self, ids):
+        """Appends a sentence, given as token ids, to the current document."""
+        ids = np.asarray(ids)
+        if self._num_buffered + len(ids) > len(self._buffer) or len(self._sentence_ends) >= len(self._buffer):
+            self._flush()
+        if len(ids) > len(self._buffer):
+            self._files["tokens"].write(ids.astype(self.id_dtype).tobytes())
+        else:
+            self._buffer[self._num_buffered:self._num_buffered + len(ids)] = ids
+            self._num_buffered += len(ids)
+        self.num_tokens += len(ids)
+        self._sentence_ends.append(self.num_tokens)
+        self._num_doc_sentences += 1
+
+    def end_document(self):
+        """Closes the current document; does nothing if it has no sentences."""
+        if self._num_doc_sentences == 0:
+            return
+        self.num_sentences += self._num_doc_sentences
+        self._num_doc_sentences = 0
+        self._doc_ends.append(self.num_sentences)
+        self.num_documents += 1
+
+    def add_document(self, document):
+        """Appends a document, a list of sentences that are each a list of tokens."""
+        for sentence in document:
+            self.add_sentence_ids([self.vocab[token] for token in sentence])
+        self.end_document()
+
+    def _flush(self):
+        self._files["tokens"].write(self._buffer[:self._num_buffered].tobytes())
+        self._files["sentence_offsets"].write(np.array(self._sentence_ends, dtype=CORPUS_OFFSET_DTYPE).tobytes())
+        self._files["doc_offsets"].write(np.array(self._doc_ends, dtype=CORPUS_OFFSET_DTYPE).tobytes())
+        self._num_buffered = 0
+        self._sentence_ends = []
+        self._doc_ends = []
+
+    def open_for_reading(self):
+        """Finishes writing, if the store is being written, and maps the files read-only."""
+        if self._files is not None:
+            # an unfinished document is closed
+            self.end_document()
+            self._flush()
+            for f in self._files.values():
+                f.close()
+            self._files = None
+            self._buffer = None
+            header = {
+                "version": CORPUS_VERSION,
+                "key": self.key,
+                "vocab_size": len(self.vocab),
+                "id_dtype": self.id_dtype.str,
+                "num_tokens": self.num_tokens,
+                "num_sentences": self.num_sentences,
+                "num_documents": self.num_documents,
+            }
+            with (self.path / COLUMNAR_HEADER_NAME).open('w') as header_file:
+                header_file.write(json.dumps(header))
+        self._map()
+
+    def _map(self):
+        # np.memmap cannot map an empty file
+        self.tokens = np.memmap(self.path / "tokens.bin", dtype=self.id_dtype, mode='r') if self.num_tokens \
+            else np.zeros(0, dtype=self.id_dtype)
+        self.sentence_offsets = np.memmap(self.path / "sentence_offsets.bin", dtype=CORPUS_OFFSET_DTYPE, mode='r')
+        self.doc_offsets = np.memmap(self.path / "doc_offsets.bin", dtype=CORPUS_OFFSET_DTYPE, mode='r')
+
+    @property
+    def doc_lengths(self):
+        """Number of sentences of every document."""
+        if self._files is not None:
+            self.open_for_reading()
+        return np.diff(self.doc_offsets)
+
+    def __len__(self):
+        return self.num_documents
+
+    def __getitem__(self, item):
+        if self._files is not None:
+            self.open_for_reading()
+        first, last = self.doc_offsets[item], self.doc_offsets[item + 1]
+        bounds = self.sentence_offsets[first:last + 1]
+        tokens = self.id_to_token[self.tokens[bounds[0]:bounds[-1]]].tolist()
+        bounds = (bounds - bounds[0]).tolist()
+        return [tokens[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def __getstate__(self):
+        # only a store opened for reading can be sent to other processes, which map the files again
+        if self._files is not None:
+            self.open_for_reading()
+        state = self.__dict__.copy()
+        state.update(tokens=None, sentence_offsets=None, doc_offsets=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._map()
+
+    def close(self):
+        if self._files is not None:
+            for f in self._files.values():
+                f.close()
+            self._files = None
+        self.tokens = self.sentence_offsets = self.doc_offsets = None
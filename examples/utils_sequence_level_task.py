@@ -20,12 +20,19 @@ import logging
 import os
 import csv
 import math
-from random import shuffle
+import collections
+import random
+import numpy as np
 from scipy.stats import pearsonr, spearmanr
 from sklearn.metrics import matthews_corrcoef, f1_score
 
+from utils_parallel import convert_examples_in_pool, FEATURIZE_CHUNK_SIZE
+
 logger = logging.getLogger(__name__)
 
+# number of examples whose ngrams are matched in one call of the batch matcher
+MATCH_CHUNK_SIZE = 1024
+
 
 class InputExample(object):
     """A single training/test example for simple sequence classification."""
@@ -618,144 +625,108 @@ class WnliProcessor(DataProcessor):
         return examples
 
 
-def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, ngram_dict):
-    """Loads a data file into a list of `InputBatch`s."""
+def convert_examples_to_arrays(examples, label_list, max_seq_length, tokenizer, ngram_dict, num_workers=1,
+                               rng=None):
+    """Featurizes the examples straight into preallocated arrays, one row per example.
 
-    label_map = {label: i for i, label in enumerate(label_list)}
+    Returns an OrderedDict from the name of each field of `InputFeatures` (but ngram_tuples) to its array, in the
+    order load_examples returns the tensors. The ngram position matrices are uint8, the other fields int64.
+    With `num_workers` > 1, chunks of examples are featurized in that many processes (see
+    `convert_examples_in_pool`). `rng` draws the ngrams kept of each example, the `random` module by default.
+    """
+    if num_workers > 1 and len(examples) > FEATURIZE_CHUNK_SIZE:
+        return convert_examples_in_pool(convert_examples_to_arrays, examples, label_list, max_seq_length, tokenizer,
+                                        ngram_dict, num_workers)
+    shuffle = (rng or random).shuffle
 
+    label_map = {label: i for i, label in enumerate(label_list)}
+    num_examples = len(examples)
+    max_ngram_in_seq = ngram_dict.max_ngram_in_seq
+    # The convention in BERT is:
+    # (a) For sequence pairs:
+    #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
+    #  type_ids: 0   0  0    0    0     0       0 0    1  1  1  1   1 1
+    # (b) For single sequences:
+    #  tokens:   [CLS] the dog is hairy . [SEP]
+    #  type_ids: 0   0   0   0  0     0 0
+    #
+    # Where "type_ids" are used to indicate whether this is the first
+    # sequence or the second sequence. The embedding vectors for `type=0` and
+    # `type=1` were learned during pre-training and are added to the wordpiece
+    # embedding vector (and position vector). This is not *strictly* necessary
+    # since the [SEP] token unambiguously separates the sequences, but it makes
+    # it easier for the model to learn the concept of sequences.
+    #
+    # For classification tasks, the first vector (corresponding to [CLS]) is
+    # used as as the "sentence vector". Note that this only makes sense because
+    # the entire model is fine-tuned.
+    logger.info("Encoding %d examples" % num_examples)
+    input_ids, input_mask, segment_ids = tokenizer.encode_batch(
+        [example.text_a for example in examples], max_seq_length,
+        pair_texts=[example.text_b for example in examples])
+    arrays = collections.OrderedDict([
+        ("input_ids", input_ids),
+        ("input_mask", input_mask),
+        ("segment_ids", segment_ids),
+        ("label_id", np.array([label_map[example.label] for example in examples], dtype=np.int64)),
+        ("ngram_ids", np.zeros((num_examples, max_ngram_in_seq), dtype=np.int64)),
+        ("ngram_positions", np.zeros((num_examples, max_seq_length, max_ngram_in_seq), dtype=np.uint8)),
+        ("ngram_lengths", np.zeros((num_examples, max_ngram_in_seq), dtype=np.int64)),
+        ("ngram_seg_ids", np.zeros((num_examples, max_ngram_in_seq), dtype=np.int64)),
+        ("ngram_masks", np.zeros((num_examples, max_ngram_in_seq), dtype=np.int64)),
+    ])
+    seq_lengths = arrays["input_mask"].sum(1)
+
+    # ----------- code for ngram BEGIN-----------
+    # Find every ngram (word) of the lexicon lengths in all examples of a chunk at once; each row of the
+    # results is ordered as the per-sequence matcher orders it
+    matcher = ngram_dict.batch_matcher(tokenizer.vocab)
+    positions = np.arange(max_seq_length)[:, None]
+    for chunk_start in range(0, num_examples, MATCH_CHUNK_SIZE):
+        chunk = slice(chunk_start, min(chunk_start + MATCH_CHUNK_SIZE, num_examples))
+        chunk_ngram_ids, chunk_starts, chunk_lengths, chunk_num_matches = matcher.match(
+            arrays["input_ids"][chunk], seq_lengths[chunk])
+        for row, ex_index in enumerate(range(chunk.start, chunk.stop)):
+            # shuffling the match indices draws the same permutation as shuffling the matches themselves
+            order = list(range(chunk_num_matches[row]))
+            shuffle(order)
+            # max_word_in_seq_proportion = max_word_in_seq
+            max_word_in_seq_proportion = math.ceil((seq_lengths[ex_index] / max_seq_length) * max_ngram_in_seq)
+            order = order[:max_word_in_seq_proportion]
+            num_ngrams = len(order)
+            ngram_positions = chunk_starts[row, order]
+            ngram_lengths = chunk_lengths[row, order]
+            arrays["ngram_ids"][ex_index, :num_ngrams] = chunk_ngram_ids[row, order]
+            arrays["ngram_lengths"][ex_index, :num_ngrams] = ngram_lengths
+            # the ngrams of the second sequence start on its tokens, whose segment id is 1
+            arrays["ngram_seg_ids"][ex_index, :num_ngrams] = arrays["segment_ids"][ex_index, ngram_positions]
+            arrays["ngram_masks"][ex_index, :num_ngrams] = 1
+
+            # record the masked positions
+            arrays["ngram_positions"][ex_index, :, :num_ngrams] = (positions >= ngram_positions) & \
+                                                                  (positions < ngram_positions + ngram_lengths)
+    # ----------- code for ngram END-----------
+    return arrays
+
+
+def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, ngram_dict, num_workers=1):
+    """Loads a data file into a list of `InputBatch`s.
+
+    The fields of every feature are its rows of the arrays of `convert_examples_to_arrays`.
+    """
+    arrays = convert_examples_to_arrays(examples, label_list, max_seq_length, tokenizer, ngram_dict, num_workers)
     features = []
-    for (ex_index, example) in enumerate(examples):
-        if ex_index % 10000 == 0:
-            logger.info("Writing example %d of %d" % (ex_index, len(examples)))
-
-        tokens_a = tokenizer.tokenize(example.text_a)
-
-        tokens_b = None
-        if example.text_b:
-            tokens_b = tokenizer.tokenize(example.text_b)
-            # Modifies `tokens_a` and `tokens_b` in place so that the total
-            # length is less than the specified length.
-            # Account for [CLS], [SEP], [SEP] with "- 3"
-            _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
-        else:
-            # Account for [CLS] and [SEP] with "- 2"
-            if len(tokens_a) > max_seq_length - 2:
-                tokens_a = tokens_a[:(max_seq_length - 2)]
-
-        # The convention in BERT is:
-        # (a) For sequence pairs:
-        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-        #  type_ids: 0   0  0    0    0     0       0 0    1  1  1  1   1 1
-        # (b) For single sequences:
-        #  tokens:   [CLS] the dog is hairy . [SEP]
-        #  type_ids: 0   0   0   0  0     0 0
-        #
-        # Where "type_ids" are used to indicate whether this is the first
-        # sequence or the second sequence. The embedding vectors for `type=0` and
-        # `type=1` were learned during pre-training and are added to the wordpiece
-        # embedding vector (and position vector). This is not *strictly* necessary
-        # since the [SEP] token unambiguously separates the sequences, but it makes
-        # it easier for the model to learn the concept of sequences.
-        #
-        # For classification tasks, the first vector (corresponding to [CLS]) is
-        # used as as the "sentence vector". Note that this only makes sense because
-        # the entire model is fine-tuned.
-        tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
-        segment_ids = [0] * len(tokens)
-
-        if tokens_b:
-            tokens += tokens_b + ["[SEP]"]
-            segment_ids += [1] * (len(tokens_b) + 1)
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        padding = [0] * (max_seq_length - len(input_ids))
-        input_ids += padding
-        input_mask += padding
-        segment_ids += padding
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-
-        label_id = label_map[example.label]
-
-        # ----------- code for ngram BEGIN-----------
-        ngram_matches = []
-        #  Filter the word segment from 2 to 7 to check whether there is a word
-        for p in range(2, 8):
-            for q in range(0, len(tokens) - p + 1):
-                character_segment = tokens[q:q + p]
-                # j is the starting position of the word
-                # i is the length of the current word
-                character_segment = tuple(character_segment)
-                if character_segment in ngram_dict.ngram_to_id_dict:
-                    ngram_index = ngram_dict.ngram_to_id_dict[character_segment]
-                    ngram_matches.append([ngram_index, q, p, character_segment])
-
-        shuffle(ngram_matches)
-        # max_word_in_seq_proportion = max_word_in_seq
-        max_word_in_seq_proportion = math.ceil((len(tokens) / max_seq_length) * ngram_dict.max_ngram_in_seq)
-        if len(ngram_matches) > max_word_in_seq_proportion:
-            ngram_matches = ngram_matches[:max_word_in_seq_proportion]
-        ngram_ids = [ngram[0] for ngram in ngram_matches]
-        ngram_positions = [ngram[1] for ngram in ngram_matches]
-        ngram_lengths = [ngram[2] for ngram in ngram_matches]
-        ngram_tuples = [ngram[3] for ngram in ngram_matches]
-        ngram_seg_ids = [0 if position < (len(tokens_a) + 2) else 1 for position in ngram_positions]
-
-        import numpy as np
-        ngram_mask_array = np.zeros(ngram_dict.max_ngram_in_seq, dtype=np.bool)
-        ngram_mask_array[:len(ngram_ids)] = 1
-
-        # record the masked positions
-        ngram_positions_matrix = np.zeros(shape=(max_seq_length, ngram_dict.max_ngram_in_seq), dtype=np.int32)
-        for i in range(len(ngram_ids)):
-            ngram_positions_matrix[ngram_positions[i]:ngram_positions[i] + ngram_lengths[i], i] = 1.0
-
-        # Zero-pad up to the max word in seq length.
-        padding = [0] * (ngram_dict.max_ngram_in_seq - len(ngram_ids))
-        ngram_ids += padding
-        ngram_lengths += padding
-        ngram_seg_ids += padding
-
-        # ----------- code for ngram END-----------
-
-        features.append(
-            InputFeatures(input_ids=input_ids,
-                          input_mask=input_mask,
-                          segment_ids=segment_ids,
-                          label_id=label_id,
-                          ngram_ids=ngram_ids,
-                          ngram_positions=ngram_positions_matrix,
-                          ngram_lengths=ngram_lengths,
-                          ngram_tuples=ngram_tuples,
-                          ngram_seg_ids=ngram_seg_ids,
-                          ngram_masks=ngram_mask_array))
+    for ex_index in range(len(examples)):
+        row = {name: array[ex_index] for name, array in arrays.items()}
+        num_ngrams = int(row["ngram_masks"].sum())
+        ngram_starts = row["ngram_positions"][:, :num_ngrams].argmax(0)
+        tokens = tokenizer.convert_ids_to_tokens(row["input_ids"].tolist())
+        row["ngram_tuples"] = [tuple(tokens[q:q + p])
+                               for q, p in zip(ngram_starts.tolist(), row["ngram_lengths"][:num_ngrams].tolist())]
+        features.append(InputFeatures(**row))
     return features
 
 
-def _truncate_seq_pair(tokens_a, tokens_b, max_length):
-    """Truncates a sequence pair in place to the maximum length."""
-
-    # This is a simple heuristic which will always truncate the longer sequence
-    # one token at a time. This makes more sense than truncating an equal percent
-    # of tokens from each, since if one sequence is very short then each token
-    # that's truncated likely contains more information than a longer sequence.
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        if len(tokens_a) > len(tokens_b):
-            tokens_a.pop()
-        else:
-            tokens_b.pop()
-
 def simple_accuracy(preds, labels):
     return (preds == labels).mean()
 
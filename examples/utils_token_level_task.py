@@ -19,7 +19,12 @@ from __future__ import absolute_import, division, print_function
 import logging
 import os
 import math
-from random import shuffle
+import collections
+import random
+import numpy as np
+
+from utils_parallel import convert_examples_in_pool, FEATURIZE_CHUNK_SIZE
+
 logger = logging.getLogger(__name__)
 
 class InputExample(object):
@@ -293,19 +298,43 @@ class ConllProcessor(DataProcessor):
         return examples
 
 
-def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, ngram_dict):
-    """Loads a data file into a list of `InputBatch`s."""
+def convert_examples_to_arrays(examples, label_list, max_seq_length, tokenizer, ngram_dict, num_workers=1,
+                               rng=None):
+    """Featurizes the examples straight into preallocated arrays, one row per example.
 
-    label_map = {label: i for i, label in enumerate(label_list, 1)}
+    Returns an OrderedDict from the name of each field of `InputFeatures` (but ngram_tuples) to its array, in the
+    order load_examples returns the tensors. The ngram position matrices are uint8, the other fields int64.
+    With `num_workers` > 1, chunks of examples are featurized in that many processes (see
+    `convert_examples_in_pool`). `rng` draws the ngrams kept of each example, the `random` module by default.
+    """
+    if num_workers > 1 and len(examples) > FEATURIZE_CHUNK_SIZE:
+        return convert_examples_in_pool(convert_examples_to_arrays, examples, label_list, max_seq_length, tokenizer,
+                                        ngram_dict, num_workers)
+    shuffle = (rng or random).shuffle
 
-    features = []
+    label_map = {label: i for i, label in enumerate(label_list, 1)}
+    num_examples = len(examples)
+    max_ngram_in_seq = ngram_dict.max_ngram_in_seq
+    arrays = collections.OrderedDict([
+        ("input_ids", np.zeros((num_examples, max_seq_length), dtype=np.int64)),
+        ("input_mask", np.zeros((num_examples, max_seq_length), dtype=np.int64)),
+        ("segment_ids", np.zeros((num_examples, max_seq_length), dtype=np.int64)),
+        ("label_id", np.zeros((num_examples, max_seq_length), dtype=np.int64)),
+        ("ngram_ids", np.zeros((num_examples, max_ngram_in_seq), dtype=np.int64)),
+        ("ngram_positions", np.zeros((num_examples, max_seq_length, max_ngram_in_seq), dtype=np.uint8)),
+        ("ngram_lengths", np.zeros((num_examples, max_ngram_in_seq), dtype=np.int64)),
+        ("ngram_seg_ids", np.zeros((num_examples, max_ngram_in_seq), dtype=np.int64)),
+        ("ngram_masks", np.zeros((num_examples, max_ngram_in_seq), dtype=np.int64)),
+        # padding positions are valid
+        ("valid_ids", np.ones((num_examples, max_seq_length), dtype=np.int64)),
+        ("label_mask", np.zeros((num_examples, max_seq_length), dtype=np.int64)),
+    ])
     for (ex_index, example) in enumerate(examples):
         textlist = example.text_a.split(' ')
         labellist = example.label
         tokens = []
         labels = []
         valid = []
-        label_mask = []
         for i, word in enumerate(textlist):
             token = tokenizer.tokenize(word)
             tokens.extend(token)
@@ -314,107 +343,67 @@ def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer
                 if m == 0:
                     labels.append(label_1)
                     valid.append(1)
-                    label_mask.append(1)
                 else:
                     valid.append(0)
         if len(tokens) >= max_seq_length - 1:
             tokens = tokens[0:(max_seq_length - 2)]
             labels = labels[0:(max_seq_length - 2)]
             valid = valid[0:(max_seq_length - 2)]
-            label_mask = label_mask[0:(max_seq_length - 2)]
-        ntokens = []
-        segment_ids = []
-        label_ids = []
-        ntokens.append("[CLS]")
-        segment_ids.append(0)
-        valid.insert(0, 1)
-        label_mask.insert(0, 1)
-        label_ids.append(label_map["[CLS]"])
-        for i, token in enumerate(tokens):
-            ntokens.append(token)
-            segment_ids.append(0)
-            if len(labels) > i:
-                label_ids.append(label_map[labels[i]])
-        ntokens.append("[SEP]")
-        segment_ids.append(0)
-        valid.append(1)
-        label_mask.append(1)
-        label_ids.append(label_map["[SEP]"])
-        input_ids = tokenizer.convert_tokens_to_ids(ntokens)
-        input_mask = [1] * len(input_ids)
-        label_mask = [1] * len(label_ids)
-        while len(input_ids) < max_seq_length:
-            input_ids.append(0)
-            input_mask.append(0)
-            segment_ids.append(0)
-            label_ids.append(0)
-            valid.append(1)
-            label_mask.append(0)
-        while len(label_ids) < max_seq_length:
-            label_ids.append(0)
-            label_mask.append(0)
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-        assert len(label_ids) == max_seq_length
-        assert len(valid) == max_seq_length
-        assert len(label_mask) == max_seq_length
+        ntokens = ["[CLS]"] + tokens + ["[SEP]"]
+        label_ids = [label_map["[CLS]"]] + [label_map[label] for label in labels[:len(tokens)]] + \
+                    [label_map["[SEP]"]]
+        # The rest of every row stays padded: 0 for the ids, masks and labels, 1 for valid_ids
+        arrays["input_ids"][ex_index, :len(ntokens)] = tokenizer.convert_tokens_to_ids(ntokens)
+        arrays["input_mask"][ex_index, :len(ntokens)] = 1
+        arrays["label_id"][ex_index, :len(label_ids)] = label_ids
+        arrays["valid_ids"][ex_index, :len(ntokens)] = [1] + valid + [1]
+        arrays["label_mask"][ex_index, :len(label_ids)] = 1
 
         # ----------- code for ngram BEGIN-----------
-        ngram_matches = []
-        #  Filter the ngram segment from 2 to 7 to check whether there is a ngram
-        for p in range(2, 8):
-            for q in range(0, len(tokens) - p + 1):
-                character_segment = tokens[q:q + p]
-                # j is the starting position of the ngram
-                # i is the length of the current ngram
-                character_segment = tuple(character_segment)
-                if character_segment in ngram_dict.ngram_to_id_dict:
-                    ngram_index = ngram_dict.ngram_to_id_dict[character_segment]
-                    ngram_matches.append([ngram_index, q, p, character_segment])
-
-        shuffle(ngram_matches)
-
-        max_ngram_in_seq_proportion = math.ceil((len(tokens) / max_seq_length) * ngram_dict.max_ngram_in_seq)
-        if len(ngram_matches) > max_ngram_in_seq_proportion:
-            ngram_matches = ngram_matches[:max_ngram_in_seq_proportion]
-
-        ngram_ids = [ngram[0] for ngram in ngram_matches]
-        ngram_positions = [ngram[1] for ngram in ngram_matches]
-        ngram_lengths = [ngram[2] for ngram in ngram_matches]
-        ngram_tuples = [ngram[3] for ngram in ngram_matches]
-        ngram_seg_ids = [0 if position < (len(tokens) + 2) else 1 for position in ngram_positions]
-
-        import numpy as np
-        ngram_mask_array = np.zeros(ngram_dict.max_ngram_in_seq, dtype=np.bool)
-        ngram_mask_array[:len(ngram_ids)] = 1
+        #  Find every ngram of the lexicon lengths in one pass of the compiled matcher
+        ngram_ids, ngram_positions, ngram_lengths = ngram_dict.matcher.match(tokens)
 
-        # record the masked positions
-        ngram_positions_matrix = np.zeros(shape=(max_seq_length, ngram_dict.max_ngram_in_seq), dtype=np.int32)
-        for i in range(len(ngram_ids)):
-            ngram_positions_matrix[ngram_positions[i]:ngram_positions[i] + ngram_lengths[i], i] = 1.0
+        # shuffling the match indices draws the same permutation as shuffling the matches themselves
+        order = list(range(len(ngram_ids)))
+        shuffle(order)
 
-        # Zero-pad up to the max ngram in seq length.
-        padding = [0] * (ngram_dict.max_ngram_in_seq - len(ngram_ids))
-        ngram_ids += padding
-        ngram_lengths += padding
-        ngram_seg_ids += padding
+        max_ngram_in_seq_proportion = math.ceil((len(tokens) / max_seq_length) * max_ngram_in_seq)
+        order = order[:max_ngram_in_seq_proportion]
+        num_ngrams = len(order)
+        ngram_ids = np.asarray(ngram_ids, dtype=np.int64)[order]
+        ngram_positions = np.asarray(ngram_positions, dtype=np.int64)[order]
+        ngram_lengths = np.asarray(ngram_lengths, dtype=np.int64)[order]
+
+        arrays["ngram_ids"][ex_index, :num_ngrams] = ngram_ids
+        arrays["ngram_lengths"][ex_index, :num_ngrams] = ngram_lengths
+        arrays["ngram_seg_ids"][ex_index, :num_ngrams] = ngram_positions >= len(tokens) + 2
+        arrays["ngram_masks"][ex_index, :num_ngrams] = 1
+
+        # record the masked positions
+        ngram_positions_matrix = arrays["ngram_positions"][ex_index]
+        for i in range(num_ngrams):
+            ngram_positions_matrix[ngram_positions[i]:ngram_positions[i] + ngram_lengths[i], i] = 1
 
         # ----------- code for ngram END-----------
+    return arrays
 
-        features.append(
-            InputFeatures(input_ids=input_ids,
-                          input_mask=input_mask,
-                          segment_ids=segment_ids,
-                          label_id=label_ids,
-                          ngram_ids=ngram_ids,
-                          ngram_positions=ngram_positions_matrix,
-                          ngram_lengths=ngram_lengths,
-                          ngram_tuples=ngram_tuples,
-                          ngram_seg_ids=ngram_seg_ids,
-                          ngram_masks=ngram_mask_array,
-                          valid_ids=valid,
-                          label_mask=label_mask))
+
+def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, ngram_dict, num_workers=1):
+    """Loads a data file into a list of `InputBatch`s.
+
+    The fields of every feature are its rows of the arrays of `convert_examples_to_arrays`.
+    """
+    arrays = convert_examples_to_arrays(examples, label_list, max_seq_length, tokenizer, ngram_dict, num_workers)
+    features = []
+    for ex_index in range(len(examples)):
+        row = {name: array[ex_index] for name, array in arrays.items()}
+        num_ngrams = int(row["ngram_masks"].sum())
+        ngram_starts = row["ngram_positions"][:, :num_ngrams].argmax(0)
+        # the ngram positions do not count [CLS]
+        tokens = tokenizer.convert_ids_to_tokens(row["input_ids"][1:].tolist())
+        row["ngram_tuples"] = [tuple(tokens[q:q + p])
+                               for q, p in zip(ngram_starts.tolist(), row["ngram_lengths"][:num_ngrams].tolist())]
+        features.append(InputFeatures(**row))
     return features
 
 processors = {